@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import secrets
+from collections import deque
+from dataclasses import dataclass, field, replace
+from typing import AsyncGenerator, Awaitable, Callable
+
+from fastapi import Request
+
+from .store import ModifiedFlag
+from .store.changes import Cursor, Feed
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class Snapshot[T]:
+    version: int
+    """Bumped on every load by the hub, which numbers the events it sends."""
+    flag: ModifiedFlag
+    value: T
+
+
+type Message = dict[str, str]
+"""An event to be sent by `sse_starlette.EventSourceResponse`."""
+
+
+@dataclass(eq=False, slots=True)
+class _Subscriber:
+    request: Request
+    queue: asyncio.Queue[Message]
+
+
+@dataclass(slots=True)
+class _Group:
+    """Subscribers sharing a base URL, and thus the same rendered bytes."""
+
+    request: Request
+    since: int
+    """The version after which every event sent to the group is in `replay`."""
+    replay: deque[tuple[int, Message]]
+    subscribers: set[_Subscriber] = field(default_factory=set)
+    initial: tuple[int, str] | None = None
+
+    def record(self, version: int, message: Message) -> None:
+        if len(self.replay) == self.replay.maxlen:
+            if not self.replay:
+                self.since = version
+                return
+            self.since = self.replay[0][0]
+        self.replay.append((version, message))
+
+    def missed(self, last_version: int, version: int) -> list[Message] | None:
+        """
+        Returns the events sent after `last_version` up to `version`, or None
+        if they are no longer retained.
+        """
+        if not self.since <= last_version <= version:
+            return None
+        missed = [message for v, message in self.replay if v > last_version]
+        # Events before the latest full content are of no use
+        for i in reversed(range(len(missed))):
+            if missed[i]["event"] == "message":
+                return missed[i:]
+        return missed
+
+
+class Hub[T]:
+    """
+    Loads and renders the content of a stream once per change and pushes the
+    same rendered fragment to every subscriber.
+
+    Changes are read from a `Feed` with a cursor, so a change made while the
+    previous one is being loaded is picked up right after, and a burst of
+    changes results in a single load. Changes arriving within `coalesce`
+    seconds of each other are merged as well, as long as the first of them has
+    been waiting for less than `max_latency` seconds. If `interval` is given,
+    the content is also loaded again after that many seconds without changes,
+    for content that changes with time, and pushed in full if its value has
+    changed.
+
+    The latest loaded value is kept as a versioned `Snapshot` so that newly
+    connected subscribers are served without touching the database. Each
+    subscriber gets a bounded queue so that a slow client cannot stall the rest.
+    Subscribers are grouped by base URL as fragments embed absolute URLs built
+    by `url_for`.
+
+    The full content is sent as a "message" event on connect. On every change,
+    subscribers receive either the full content again or, if `render_patch` is
+    given, a "patch" event rendered from the previous and the current snapshot.
+    When a subscriber falls behind, its pending events are replaced by the full
+    content to resynchronize it.
+
+    Events carry ids, and the latest `replay` events of each group are kept so
+    that a client reconnecting with `Last-Event-ID` is only sent what it has
+    missed. The hub keeps running for `linger` seconds after the last
+    subscriber leaves so that clients reconnecting all at once can resume.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[], Awaitable[T]],
+        render: Callable[[Request, Snapshot[T]], str],
+        feed: Feed,
+        *,
+        render_patch: Callable[[Request, Snapshot[T], Snapshot[T]], str] | None = None,
+        maxsize: int = 4,
+        replay: int = 0,
+        linger: float = 0,
+        coalesce: float = 0,
+        max_latency: float = 0,
+        interval: float = 0,
+    ):
+        self._load = load
+        self._render = render
+        self._render_patch = render_patch
+        self._feed = feed
+        self._maxsize = maxsize
+        self._replay = replay
+        self._linger = linger
+        self._coalesce = coalesce
+        self._max_latency = max(max_latency, coalesce)
+        self._interval = interval
+        # Tells the event ids issued by this hub from those of other processes
+        self._epoch = secrets.token_hex(4)
+        self._groups: dict[str, _Group] = {}
+        self._snapshot: Snapshot[T] | None = None
+        self._version = 0
+        self._cursor: Cursor | None = None
+        self._lock = asyncio.Lock()
+        self._pump_task: asyncio.Task | None = None
+        self._stop_handle: asyncio.TimerHandle | None = None
+
+    async def subscribe(self, request: Request) -> AsyncGenerator[Message, None]:
+        if self._snapshot is None:
+            await self._start()
+        snapshot = self._snapshot
+        assert snapshot is not None
+        if self._stop_handle is not None:
+            self._stop_handle.cancel()
+            self._stop_handle = None
+
+        subscriber = _Subscriber(request, asyncio.Queue(self._maxsize))
+        key = str(request.base_url)
+        if (group := self._groups.get(key)) is None:
+            group = _Group(request, snapshot.version, deque(maxlen=self._replay))
+            self._groups[key] = group
+        group.subscribers.add(subscriber)
+        try:
+            missed = None
+            last_event_id = request.headers.get("last-event-id")
+            if (last_version := self._parse_event_id(last_event_id)) is not None:
+                missed = group.missed(last_version, snapshot.version)
+            if missed is None:
+                data = self._render_initial(group, snapshot)
+                yield self._message("message", data, snapshot.version)
+            else:
+                for message in missed:
+                    yield message
+            while True:
+                yield await subscriber.queue.get()
+        finally:
+            group.subscribers.discard(subscriber)
+            self._release()
+
+    def _message(self, event: str, data: str, version: int) -> Message:
+        return {"event": event, "data": data, "id": f"{self._epoch}.{version}"}
+
+    def _parse_event_id(self, event_id: str | None) -> int | None:
+        if event_id is None:
+            return None
+        epoch, _, version = event_id.partition(".")
+        if epoch != self._epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def _render_initial(self, group: _Group, snapshot: Snapshot[T]) -> str:
+        if group.initial is None or group.initial[0] != snapshot.version:
+            initial = replace(snapshot, flag=ModifiedFlag.ORIGINAL)
+            group.initial = (snapshot.version, self._render(group.request, initial))
+        return group.initial[1]
+
+    async def _start(self) -> None:
+        async with self._lock:
+            if self._snapshot is not None:
+                return
+            # Take the cursor before loading so that no change is missed
+            self._cursor = self._feed.cursor()
+            value = await self._load()
+            self._snapshot = Snapshot(
+                self._next_version(), ModifiedFlag.ORIGINAL, value
+            )
+            self._start_pump()
+
+    def _start_pump(self) -> None:
+        self._pump_task = asyncio.create_task(self._pump())
+        self._pump_task.add_done_callback(self._pump_done)
+
+    def _pump_done(self, task: asyncio.Task) -> None:
+        if task.cancelled() or task is not self._pump_task:
+            return
+        # Errors are caught per change, so this is a bug in the pump itself
+        logger.error("Stream pump stopped", exc_info=task.exception())
+        self._start_pump()
+
+    def _release(self) -> None:
+        if any(group.subscribers for group in self._groups.values()):
+            return
+        if self._linger <= 0:
+            self._stop()
+        elif self._stop_handle is None:
+            loop = asyncio.get_running_loop()
+            self._stop_handle = loop.call_later(self._linger, self._stop)
+
+    def _stop(self) -> None:
+        self._stop_handle = None
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            self._pump_task = None
+        self._snapshot = None
+        self._groups.clear()
+
+    async def _pump(self) -> None:
+        assert self._cursor is not None
+        while True:
+            flag = await self._next_change()
+            if flag and self._coalesce > 0:
+                flag |= await self._coalesce_changes()
+            try:
+                value = await self._load()
+                assert self._snapshot is not None
+                if not flag and value == self._snapshot.value:
+                    continue
+                self._publish(Snapshot(self._next_version(), flag, value))
+            except Exception:
+                # Keep serving the previous snapshot until the next change
+                logger.exception("Failed to load or render a stream update")
+
+    def _next_version(self) -> int:
+        # Kept across restarts so that no event id is ever reused
+        self._version += 1
+        return self._version
+
+    async def _next_change(self) -> ModifiedFlag:
+        """Waits for a change, or returns an empty flag after `interval`."""
+        assert self._cursor is not None
+        if self._interval <= 0:
+            return await self._cursor.next()
+        try:
+            return await asyncio.wait_for(self._cursor.next(), self._interval)
+        except TimeoutError:
+            return ModifiedFlag(0)
+
+    async def _coalesce_changes(self) -> ModifiedFlag:
+        assert self._cursor is not None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._max_latency
+        flag = ModifiedFlag(0)
+        while (timeout := min(self._coalesce, deadline - loop.time())) > 0:
+            try:
+                flag |= await asyncio.wait_for(self._cursor.next(), timeout)
+            except TimeoutError:
+                break
+        return flag
+
+    def _publish(self, snapshot: Snapshot[T]) -> None:
+        prev = self._snapshot
+        assert prev is not None
+        # Render for every group before sending any, so that a failed render
+        # leaves every subscriber on the previous snapshot
+        messages: list[tuple[_Group, Message]] = []
+        for group in self._groups.values():
+            # Reloads on `interval` have no change to render a patch for
+            if self._render_patch is None or not snapshot.flag:
+                data = self._render(group.request, snapshot)
+                message = self._message("message", data, snapshot.version)
+            elif data := self._render_patch(group.request, prev, snapshot):
+                message = self._message("patch", data, snapshot.version)
+            else:
+                continue
+            messages.append((group, message))
+
+        self._snapshot = snapshot
+        for group, message in messages:
+            group.record(snapshot.version, message)
+
+            for subscriber in group.subscribers:
+                queue = subscriber.queue
+                if not queue.full():
+                    queue.put_nowait(message)
+                elif message["event"] == "message":
+                    queue.get_nowait()
+                    queue.put_nowait(message)
+                else:
+                    while not queue.empty():
+                        queue.get_nowait()
+                    data = self._render_initial(group, snapshot)
+                    queue.put_nowait(self._message("message", data, snapshot.version))
@@ -0,0 +1,29 @@
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import pytest
+import sqlalchemy
+from databases import Database
+
+from .store import TableBase
+
+type Connect = Callable[[], Awaitable[Database]]
+
+
+@pytest.fixture
+def connect(tmp_path: Path) -> Connect:
+    """
+    Connects to a database in a temporary file with every table created. Call
+    it in the event loop of the test, as many times as connections are needed.
+    """
+    url = f"sqlite:///{tmp_path / 'test.db'}"
+
+    async def connect() -> Database:
+        database = Database(url)
+        await database.connect()
+        for table in TableBase.metadata.tables.values():
+            schema = sqlalchemy.schema.CreateTable(table, if_not_exists=True)
+            await database.execute(str(schema.compile()))
+        return database
+
+    return connect
@@ -1,3 +1,45 @@
 import os
 
 DEBUG = True if os.environ.get("MURCHACE_DEBUG") else False
+
+# A directory to keep compiled templates in across restarts, or empty to
+# compile them on every startup.
+TEMPLATE_CACHE_DIR = os.environ.get("MURCHACE_TEMPLATE_CACHE_DIR", "")
+
+# SQLite pragmas applied to every connection. Set a variable to an empty string
+# to leave the corresponding SQLite default untouched.
+SQLITE_JOURNAL_MODE = os.environ.get("MURCHACE_SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("MURCHACE_SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = os.environ.get("MURCHACE_SQLITE_BUSY_TIMEOUT", "5000")  # ms
+SQLITE_MMAP_SIZE = os.environ.get("MURCHACE_SQLITE_MMAP_SIZE", str(256 * 1024**2))
+SQLITE_CACHE_SIZE = os.environ.get("MURCHACE_SQLITE_CACHE_SIZE", "-16000")  # KiB
+SQLITE_TEMP_STORE = os.environ.get("MURCHACE_SQLITE_TEMP_STORE", "MEMORY")
+
+# The number of read-only connections shared by loaders and statistics
+SQLITE_READERS = int(os.environ.get("MURCHACE_SQLITE_READERS", "4"))
+
+# How changes are notified to the streams: "local" to this process only, or
+# "sqlite" to every process sharing the database by polling it.
+CHANGE_BUS = os.environ.get("MURCHACE_CHANGE_BUS", "local")
+CHANGE_POLL_INTERVAL = float(os.environ.get("MURCHACE_CHANGE_POLL_INTERVAL", "0.2"))
+
+# Changes to the streamed content arriving within the window are rendered at
+# once, but no later than the max latency after the first of them.
+STREAM_COALESCE_MS = int(os.environ.get("MURCHACE_STREAM_COALESCE_MS", "100"))
+STREAM_MAX_LATENCY_MS = int(os.environ.get("MURCHACE_STREAM_MAX_LATENCY_MS", "300"))
+
+# Wait estimates are based on the orders completed within this many minutes
+SERVICE_TIME_WINDOW_MINUTES = int(
+    os.environ.get("MURCHACE_SERVICE_TIME_WINDOW_MINUTES", "30")
+)
+
+# Order sessions left untouched for the TTL are dropped, and so are the least
+# recently used ones beyond the max count.
+SESSION_TTL_MINUTES = int(os.environ.get("MURCHACE_SESSION_TTL_MINUTES", "240"))
+SESSION_MAX_COUNT = int(os.environ.get("MURCHACE_SESSION_MAX_COUNT", "256"))
+
+# Where order sessions are kept: "local" in the memory of this process, or
+# "sqlite" in the database shared by every process, to which changes are
+# written in a batch once per flush interval.
+SESSION_STORE = os.environ.get("MURCHACE_SESSION_STORE", "local")
+SESSION_FLUSH_INTERVAL = float(os.environ.get("MURCHACE_SESSION_FLUSH_INTERVAL", "0.5"))
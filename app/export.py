@@ -0,0 +1,191 @@
+import asyncio
+import csv
+import io
+import json
+import time
+import zlib
+from enum import StrEnum
+from typing import AsyncGenerator, AsyncIterable, Iterable, Mapping, Sequence
+
+from databases import Database
+
+ORDERS_QUERY = """
+SELECT
+    orders.order_id,
+    ordered_items.item_no,
+    unixepoch(orders.ordered_at) AS ordered_at,
+    unixepoch(orders.completed_at) AS completed_at,
+    ordered_items.product_id,
+    products.name,
+    products.price
+FROM
+    orders
+INNER JOIN
+    ordered_items ON orders.order_id = ordered_items.order_id
+INNER JOIN
+    products ON ordered_items.product_id = products.product_id
+WHERE
+    orders.canceled_at IS NULL AND orders.order_id > :since
+    AND (orders.order_id, ordered_items.item_no) > (:order_id, :item_no)
+ORDER BY
+    orders.order_id ASC, ordered_items.item_no ASC
+LIMIT :limit;
+"""
+COLUMNS = (
+    "order_id",
+    "item_no",
+    "ordered_at",
+    "completed_at",
+    "product_id",
+    "name",
+    "price",
+)
+TIMESTAMP_COLUMNS = ("ordered_at", "completed_at")
+
+
+class Format(StrEnum):
+    CSV = "csv"
+    CSV_GZIP = "csv.gz"
+    JSON_LINES = "jsonl"
+    COLUMNAR = "columns.jsonl.gz"
+    """
+    Gzipped JSON Lines, each line of which holds a batch of rows as a mapping
+    from column names to arrays. Timestamps are kept in unix epoch, and
+    repetitive columns such as product names compress well laid out this way.
+    """
+
+    @property
+    def media_type(self) -> str:
+        match self:
+            case Format.CSV:
+                return "text/csv"
+            case Format.JSON_LINES:
+                return "application/x-ndjson"
+            case Format.CSV_GZIP | Format.COLUMNAR:
+                return "application/gzip"
+
+
+class TimestampFormatter:
+    """
+    Formats unix epochs as local time.
+
+    Orders are placed minutes apart at most, so the formatted date, hour and
+    minute are cached per minute and only the seconds are formatted per value.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self._maxsize = maxsize
+        self._minutes: dict[int, str] = {}
+
+    def __call__(self, epoch: int | None) -> str | None:
+        if epoch is None:
+            return None
+        minute, second = divmod(epoch, 60)
+        if (prefix := self._minutes.get(minute)) is None:
+            if len(self._minutes) >= self._maxsize:
+                self._minutes.clear()
+            local_time = time.localtime(minute * 60)
+            prefix = self._minutes[minute] = time.strftime("%Y-%m-%d %H:%M", local_time)
+        return f"{prefix}:{second:02}"
+
+    def format_many(self, epochs: Iterable[int | None]) -> list[str | None]:
+        return list(map(self, epochs))
+
+
+type Columns = dict[str, list]
+
+
+def _to_columns(rows: Sequence[Mapping], formatter: TimestampFormatter | None):
+    columns: Columns = {name: [row[name] for row in rows] for name in COLUMNS}
+    if formatter is not None:
+        for name in TIMESTAMP_COLUMNS:
+            columns[name] = formatter.format_many(columns[name])
+    return columns
+
+
+def _encode_csv(columns: Columns) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(zip(*columns.values()))
+    return buffer.getvalue()
+
+
+def _encode_json_lines(columns: Columns) -> str:
+    names = tuple(columns)
+    return "".join(
+        json.dumps(dict(zip(names, values)), ensure_ascii=False) + "\n"
+        for values in zip(*columns.values())
+    )
+
+
+def _encode_columns(columns: Columns) -> str:
+    return json.dumps(columns, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+async def _batches[T](
+    items: AsyncIterable[T], size: int
+) -> AsyncGenerator[list[T], None]:
+    batch: list[T] = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def fetch_orders(
+    database: Database, since: int = 0, batch_size: int = 512
+) -> AsyncGenerator[Mapping, None]:
+    """
+    Yields the rows of `ORDERS_QUERY` fetched in batches of `batch_size`, each
+    continuing after the last row of the previous one. No connection is held
+    between batches, so a slow download doesn't keep one from the pool.
+    """
+    values = {"since": since, "order_id": since, "item_no": -1, "limit": batch_size}
+    while True:
+        rows = await database.fetch_all(ORDERS_QUERY, values)
+        for row in rows:
+            yield row._mapping
+        if len(rows) < batch_size:
+            return
+        last = rows[-1]
+        values |= {"order_id": last["order_id"], "item_no": last["item_no"]}
+
+
+async def _gzipped(chunks: AsyncIterable[str]) -> AsyncGenerator[bytes, None]:
+    # A gzip header and trailer are written with the window bits offset by 16
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    async for chunk in chunks:
+        # zlib releases the GIL while compressing, unlike the formatting above
+        data = await asyncio.to_thread(compressor.compress, chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def encode(
+    rows: AsyncIterable[Mapping], format: Format, batch_size: int = 512
+) -> AsyncGenerator[str | bytes, None]:
+    """Encodes the rows of `ORDERS_QUERY` in batches of `batch_size` rows."""
+    match format:
+        case Format.CSV | Format.CSV_GZIP:
+            header, encoder = ",".join(COLUMNS) + "\r\n", _encode_csv
+        case Format.JSON_LINES:
+            header, encoder = "", _encode_json_lines
+        case Format.COLUMNAR:
+            header, encoder = "", _encode_columns
+    formatter = None if format == Format.COLUMNAR else TimestampFormatter()
+
+    async def chunks() -> AsyncGenerator[str, None]:
+        if header:
+            yield header
+        async for batch in _batches(rows, batch_size):
+            yield encoder(_to_columns(batch, formatter))
+
+    if format in (Format.CSV_GZIP, Format.COLUMNAR):
+        async for data in _gzipped(chunks()):
+            yield data
+    else:
+        async for chunk in chunks():
+            yield chunk
@@ -1,21 +1,27 @@
 import asyncio
 from datetime import datetime
-from functools import partial
 from typing import Annotated, Any, AsyncGenerator, Awaitable, Callable, Literal, Mapping
 
 import sqlalchemy
 import sqlmodel
 from fastapi import APIRouter, Form, Header, HTTPException, Request, status
 from fastapi.responses import HTMLResponse
+from markupsafe import Markup
 from sqlmodel import col
 from sse_starlette.sse import EventSourceResponse
 
+from ..broadcast import Hub, Snapshot
+from ..env import STREAM_COALESCE_MS, STREAM_MAX_LATENCY_MS
 from ..store import (
+    ChangeFeed,
+    IncomingOrder,
+    IncomingQueue,
     Order,
     OrderedItem,
     OrderTable,
     Product,
     database,
+    reader,
     supply_all_and_complete,
     supply_and_complete_order_if_done,
     unixepoch,
@@ -39,7 +45,7 @@ async def _agen_query_executor[T](
 ):
     prev_unique_id = -1
     lst: list[T] = list()
-    async for map in database.iterate(query):
+    async for map in reader.iterate(query):
         if (unique_id := map[unique_key]) != prev_unique_id:
             if prev_unique_id != -1:
                 list_cb(lst)
@@ -51,95 +57,88 @@ async def _agen_query_executor[T](
         list_cb(lst)
 
 
-query_ordered_items_incoming: sqlalchemy.Select = (
-    sqlmodel.select(OrderedItem.order_id, OrderedItem.product_id)
-    .add_columns(sqlmodel.func.count(col(OrderedItem.product_id)).label("count"))
-    .where(col(OrderedItem.supplied_at).is_(None))  # Filter out supplied items
-    .group_by(col(OrderedItem.order_id), col(OrderedItem.product_id))
-    .select_from(sqlmodel.join(OrderedItem, Product))
-    .add_columns(col(Product.name), col(Product.filename))
-    .join(Order)
-    .add_columns(unixepoch(col(Order.ordered_at)))
-    .where(col(Order.canceled_at).is_(None) & col(Order.completed_at).is_(None))
-    .order_by(col(OrderedItem.product_id).asc(), col(OrderedItem.order_id).asc())
-)
-
 type ordered_item_t = dict[str, int | str | list[dict[str, int | str]]]
 
 
-def _ordered_items_loader() -> Callable[[], Awaitable[list[ordered_item_t]]]:
-    query_str = str(query_ordered_items_incoming.compile())
-
-    ordered_items: list[ordered_item_t] = []
-
-    def init_cb(product_id: int, map: Mapping):
-        ordered_items.append(
-            {"product_id": product_id, "name": map["name"], "filename": map["filename"]}
-        )
-
-    def elem_cb(map: Mapping) -> dict[str, int | str]:
-        return {
-            "order_id": map["order_id"],
-            "count": map["count"],
-            "ordered_at": _to_time(map["ordered_at"]),
-        }
-
-    def list_cb(orders: list[dict[str, int | str]]):
-        ordered_items[-1]["orders"] = orders
-
-    load_ordered_products = partial(
-        _agen_query_executor, query_str, "product_id", init_cb, elem_cb, list_cb
-    )
-
-    async def load():
-        ordered_items.clear()
-        await load_ordered_products()
-        return ordered_items
-
-    return load
-
-
-load_ordered_items_incoming = _ordered_items_loader()
+def _single_flight[T](
+    load: Callable[[], Awaitable[T]], version: Callable[[], int]
+) -> Callable[[], Awaitable[T]]:
+    """
+    Lets concurrent callers share one in-flight `load`.
+
+    A caller only joins the in-flight load if `version()` has not changed since
+    the load started; otherwise the load may predate the latest write and a
+    fresh one is started.
+    """
+    in_flight: tuple[int, asyncio.Future[T]] | None = None
+
+    def clear(future: asyncio.Future[T]) -> None:
+        nonlocal in_flight
+        if in_flight is not None and in_flight[1] is future:
+            in_flight = None
+
+    async def shared() -> T:
+        nonlocal in_flight
+        if in_flight is None or in_flight[0] != version():
+            future = asyncio.ensure_future(load())
+            future.add_done_callback(clear)
+            in_flight = (version(), future)
+        # Shield the shared load so that a canceled caller does not cancel it for
+        # the others.
+        return await asyncio.shield(in_flight[1])
+
+    return shared
+
+
+def _modified_version() -> int:
+    return ChangeFeed.seq
+
+
+async def load_ordered_items_incoming() -> tuple[ordered_item_t, ...]:
+    """Groups the unsupplied items in the incoming order queue by product."""
+    ordered_items: dict[int, ordered_item_t] = {}
+    orders_by_product: dict[int, list[dict[str, int | str]]] = {}
+    for order in IncomingQueue.orders():
+        ordered_at = _to_time(order.ordered_at)
+        for item in order.items:
+            if item.supplied_at is not None:
+                continue
+            if (orders := orders_by_product.get(item.product_id)) is None:
+                orders = orders_by_product[item.product_id] = []
+                ordered_items[item.product_id] = {
+                    "product_id": item.product_id,
+                    "name": item.name,
+                    "filename": item.filename,
+                    "orders": orders,
+                }
+            orders.append(
+                {
+                    "order_id": order.order_id,
+                    "count": item.count,
+                    "ordered_at": ordered_at,
+                }
+            )
+    return tuple(ordered_items[product_id] for product_id in sorted(ordered_items))
 
 
 class ordered_items_incoming:  # namespace
     @macro_template("ordered-items-incoming.html")
     @staticmethod
-    def page(ordered_items: list[ordered_item_t]): ...
+    def page(ordered_items: tuple[ordered_item_t, ...]): ...
 
     @macro_template("ordered-items-incoming.html", "component")
     @staticmethod
-    def component(ordered_items: list[ordered_item_t]): ...
+    def component(ordered_items: tuple[ordered_item_t, ...]): ...
 
     @macro_template("ordered-items-incoming.html", "component_with_sound")
     @staticmethod
-    def component_with_sound(ordered_items: list[ordered_item_t]): ...
+    def component_with_sound(ordered_items: tuple[ordered_item_t, ...]): ...
 
 
 type item_t = dict[str, int | str | None]
 type order_t = dict[str, int | list[item_t] | str | datetime | None]
 
 
-query_incoming: sqlalchemy.Select = (
-    # Query from the orders table
-    sqlmodel.select(Order.order_id)
-    .group_by(col(Order.order_id))
-    .order_by(col(Order.order_id).asc())
-    .add_columns(unixepoch(col(Order.ordered_at)))
-    # Filter out canceled/completed orders
-    .where(col(Order.canceled_at).is_(None) & col(Order.completed_at).is_(None))
-    # Query the list of ordered items
-    .select_from(sqlmodel.join(Order, OrderedItem))
-    .add_columns(col(OrderedItem.product_id), unixepoch(col(OrderedItem.supplied_at)))
-    .group_by(col(OrderedItem.product_id))
-    .order_by(col(OrderedItem.product_id).asc())
-    .add_columns(sqlmodel.func.count(col(OrderedItem.product_id)).label("count"))
-    # Query product name
-    .join(Product)
-    .add_columns(col(Product.name))
-)
-
-
 query_resolved: sqlalchemy.Select = (
     # Query from the orders table
     sqlmodel.select(Order.order_id)
@@ -162,31 +161,6 @@ query_resolved: sqlalchemy.Select = (
 )
 
 
-def callbacks_orders_incoming(
-    orders: list[order_t],
-) -> tuple[
-    Callable[[int, Mapping], None],
-    Callable[[Mapping], item_t],
-    Callable[[list[item_t]], None],
-]:
-    def init_cb(order_id: int, map: Mapping) -> None:
-        orders.append({"order_id": order_id, "ordered_at": _to_time(map["ordered_at"])})
-
-    def elem_cb(map: Mapping) -> item_t:
-        supplied_at = map["supplied_at"]
-        return {
-            "product_id": map["product_id"],
-            "count": map["count"],
-            "name": map["name"],
-            "supplied_at": _to_time(supplied_at) if supplied_at else None,
-        }
-
-    def list_cb(items: list[item_t]) -> None:
-        orders[-1]["items_"] = items
-
-    return init_cb, elem_cb, list_cb
-
-
 def callbacks_orders_resolved(
     orders: list[order_t],
 ) -> tuple[
@@ -239,25 +213,39 @@ def _orders_loader(
             Callable[[list[item_t]], None],
         ],
     ],
-) -> Callable[[], Awaitable[list[order_t]]]:
-    orders: list[order_t] = []
+) -> Callable[[], Awaitable[tuple[order_t, ...]]]:
+    query_str = str(query)
+
+    async def load() -> tuple[order_t, ...]:
+        orders: list[order_t] = []
+        init_cb, elem_cb, list_cb = callbacks(orders)
+        await _agen_query_executor(query_str, "order_id", init_cb, elem_cb, list_cb)
+        return tuple(orders)
+
+    return _single_flight(load, _modified_version)
 
-    init_cb, elem_cb, list_cb = callbacks(orders)
-    load_orders = partial(
-        _agen_query_executor, str(query), "order_id", init_cb, elem_cb, list_cb
-    )
 
-    async def load():
-        orders.clear()
-        await load_orders()
-        return orders
+def _incoming_order(order: IncomingOrder) -> order_t:
+    items: list[item_t] = [
+        {
+            "product_id": item.product_id,
+            "count": item.count,
+            "name": item.name,
+            "supplied_at": _to_time(item.supplied_at) if item.supplied_at else None,
+        }
+        for item in order.items
+    ]
+    return {
+        "order_id": order.order_id,
+        "ordered_at": _to_time(order.ordered_at),
+        "items_": items,
+    }
 
-    return load
+
+async def _load_incoming_queue() -> tuple[IncomingOrder, ...]:
+    return IncomingQueue.orders()
 
 
-load_incoming_orders = _orders_loader(
-    query_incoming.compile(), callbacks_orders_incoming
-)
 load_resolved_orders = _orders_loader(
     query_resolved.compile(), callbacks_orders_resolved
 )
@@ -266,6 +254,8 @@ load_resolved_orders = _orders_loader(
 async def load_one_resolved_order(order_id: int) -> order_t | None:
     query = query_resolved.where(col(Order.order_id) == order_id)
 
+    # Read through the writer so that the order that has just been resolved is
+    # rendered as written.
     rows_agen = database.iterate(query)
     if (row := await anext(rows_agen, None)) is None:
         return None
@@ -305,21 +295,72 @@ async def load_one_resolved_order(order_id: int) -> order_t | None:
 class incoming_orders:  # namespace
     @macro_template("incoming-orders.html")
     @staticmethod
-    def page(orders: list[order_t]): ...
+    def page(cards: tuple[Markup, ...]): ...
 
     @macro_template("incoming-orders.html", "component")
     @staticmethod
-    def component(orders: list[order_t]): ...
+    def component(cards: tuple[Markup, ...]): ...
 
     @macro_template("incoming-orders.html", "component_with_sound")
     @staticmethod
-    def component_with_sound(orders: list[order_t]): ...
+    def component_with_sound(cards: tuple[Markup, ...]): ...
+
+    @macro_template("incoming-orders.html", "card")
+    @staticmethod
+    def card(order: order_t, oob: bool = False): ...
+
+    @macro_template("incoming-orders.html", "added")
+    @staticmethod
+    def added(card_: Markup, after_order_id: int | None): ...
+
+    @macro_template("incoming-orders.html", "removed")
+    @staticmethod
+    def removed(order_id: int): ...
+
+    @macro_template("incoming-orders.html", "sound")
+    @staticmethod
+    def sound(): ...
+
+
+class _CardCache:
+    """
+    Rendered order cards, each kept until its order is modified.
+
+    Orders in `IncomingQueue` carry the version at which they were last
+    modified, so a card is rendered again only when its version changes and
+    an update costs as many renders as the orders it has changed. Cards don't
+    embed absolute URLs, so they are shared by every base URL.
+    """
+
+    def __init__(self):
+        self._cards: dict[tuple[int, bool], tuple[int, Markup]] = {}
+
+    def card(self, request: Request, order: IncomingOrder, oob: bool = False) -> Markup:
+        key = (order.order_id, oob)
+        if (cached := self._cards.get(key)) is not None and cached[0] == order.version:
+            return cached[1]
+        card = Markup(incoming_orders.card(request, _incoming_order(order), oob))
+        self._cards[key] = (order.version, card)
+        return card
+
+    def cards(
+        self, request: Request, orders: tuple[IncomingOrder, ...]
+    ) -> tuple[Markup, ...]:
+        cards = tuple(self.card(request, order) for order in orders)
+        # Forget the orders that have left the queue, keeping both variants
+        if len(self._cards) > 2 * len(orders):
+            order_ids = {order.order_id for order in orders}
+            self._cards = {k: v for k, v in self._cards.items() if k[0] in order_ids}
+        return cards
+
+
+_card_cache = _CardCache()
 
 
 class resolved_orders:  # namespace
     @macro_template("resolved-orders.html")
     @staticmethod
-    def page(orders: list[order_t]): ...
+    def page(orders: tuple[order_t, ...]): ...
 
     @macro_template("resolved-orders.html", "completed")
     @staticmethod
@@ -344,20 +385,39 @@ async def ordered_items_incoming_stream(
     return EventSourceResponse(_ordered_items_incoming_stream(request))
 
 
+def _render_ordered_items_incoming(
+    request: Request, snapshot: Snapshot[tuple[ordered_item_t, ...]]
+) -> str:
+    if snapshot.flag & (ModifiedFlag.INCOMING | ModifiedFlag.PUT_BACK):
+        template = ordered_items_incoming.component_with_sound
+    else:
+        template = ordered_items_incoming.component
+    return template(request, snapshot.value)
+
+
+# Let clients resume streams across short disconnections, such as Wi-Fi blips
+# or an access point restart, without being sent the full content again.
+_REPLAY = 64
+_LINGER = 30.0
+# Render bursts of changes, such as items supplied one after another, at once
+_COALESCE = STREAM_COALESCE_MS / 1000
+_MAX_LATENCY = STREAM_MAX_LATENCY_MS / 1000
+
+ordered_items_incoming_hub = Hub(
+    load_ordered_items_incoming,
+    _render_ordered_items_incoming,
+    ChangeFeed,
+    replay=_REPLAY,
+    linger=_LINGER,
+    coalesce=_COALESCE,
+    max_latency=_MAX_LATENCY,
+)
+
+
 async def _ordered_items_incoming_stream(request: Request):
-    ordered_items = await load_ordered_items_incoming()
-    content = ordered_items_incoming.component(request, ordered_items)
-    yield dict(data=content)
     try:
-        while True:
-            async with OrderTable.modified_cond_flag:
-                flag = await OrderTable.modified_cond_flag.wait()
-                if flag & (ModifiedFlag.INCOMING | ModifiedFlag.PUT_BACK):
-                    template = ordered_items_incoming.component_with_sound
-                else:
-                    template = ordered_items_incoming.component
-                ordered_items = await load_ordered_items_incoming()
-                yield dict(data=template(request, ordered_items))
+        async for message in ordered_items_incoming_hub.subscribe(request):
+            yield message
     except asyncio.CancelledError:
         yield dict(event="shutdown", data="")
     finally:
@@ -371,8 +431,8 @@ async def supply_products(order_id: int, product_id: int):
 
 @router.get("/orders/incoming", response_class=HTMLResponse)
 async def get_incoming_orders(request: Request):
-    orders = await load_incoming_orders()
-    return HTMLResponse(incoming_orders.page(request, orders))
+    cards = _card_cache.cards(request, IncomingQueue.orders())
+    return HTMLResponse(incoming_orders.page(request, cards))
 
 
 @router.get("/orders/incoming-stream", response_class=EventSourceResponse)
@@ -383,22 +443,59 @@ async def incoming_orders_stream(
     return EventSourceResponse(_incoming_orders_stream(request))
 
 
+def _render_incoming_orders(
+    request: Request, snapshot: Snapshot[tuple[IncomingOrder, ...]]
+) -> str:
+    if snapshot.flag & (ModifiedFlag.INCOMING | ModifiedFlag.PUT_BACK):
+        template = incoming_orders.component_with_sound
+    else:
+        template = incoming_orders.component
+    return template(request, _card_cache.cards(request, snapshot.value))
+
+
+def _render_incoming_orders_patch(
+    request: Request,
+    prev: Snapshot[tuple[IncomingOrder, ...]],
+    snapshot: Snapshot[tuple[IncomingOrder, ...]],
+) -> str:
+    """Renders out-of-band swaps for the orders added, updated or removed."""
+    prev_orders = {order.order_id: order for order in prev.value}
+    fragments: list[str] = []
+    after_order_id: int | None = None
+    for order in snapshot.value:
+        match prev_orders.pop(order.order_id, None):
+            case None:
+                card = _card_cache.card(request, order)
+                fragments.append(incoming_orders.added(request, card, after_order_id))
+            case prev_order if prev_order.version != order.version:
+                fragments.append(_card_cache.card(request, order, oob=True))
+        after_order_id = order.order_id
+    for order_id in prev_orders:
+        fragments.append(incoming_orders.removed(request, order_id))
+
+    if fragments and snapshot.flag & (ModifiedFlag.INCOMING | ModifiedFlag.PUT_BACK):
+        fragments.insert(0, incoming_orders.sound(request))
+    return "".join(fragments)
+
+
+incoming_orders_hub = Hub(
+    _load_incoming_queue,
+    _render_incoming_orders,
+    ChangeFeed,
+    render_patch=_render_incoming_orders_patch,
+    replay=_REPLAY,
+    linger=_LINGER,
+    coalesce=_COALESCE,
+    max_latency=_MAX_LATENCY,
+)
+
+
 async def _incoming_orders_stream(
     request: Request,
 ) -> AsyncGenerator[dict[str, str], None]:
-    orders = await load_incoming_orders()
-    content = incoming_orders.component(request, orders)
-    yield dict(data=content)
     try:
-        while True:
-            async with OrderTable.modified_cond_flag:
-                flag = await OrderTable.modified_cond_flag.wait()
-                if flag & (ModifiedFlag.INCOMING | ModifiedFlag.PUT_BACK):
-                    template = incoming_orders.component_with_sound
-                else:
-                    template = incoming_orders.component
-                orders = await load_incoming_orders()
-                yield dict(data=template(request, orders))
+        async for message in incoming_orders_hub.subscribe(request):
+            yield message
     except asyncio.CancelledError:
         yield dict(event="shutdown", data="")
     finally:
@@ -424,9 +521,10 @@ async def complete(
         await supply_all_and_complete(order_id)
         return
 
-    async with database.transaction():
-        await supply_all_and_complete(order_id)
-        maybe_order = await load_one_resolved_order(order_id)
+    # The store commits and publishes the change on its own, so the card is
+    # loaded afterwards rather than in an enclosing transaction
+    await supply_all_and_complete(order_id)
+    maybe_order = await load_one_resolved_order(order_id)
 
     if (order := maybe_order) is None:
         detail = f"Order {order_id} not found"
@@ -443,9 +541,8 @@ async def cancel(
         await OrderTable.cancel(order_id)
         return
 
-    async with database.transaction():
-        await OrderTable.cancel(order_id)
-        maybe_order = await load_one_resolved_order(order_id)
+    await OrderTable.cancel(order_id)
+    maybe_order = await load_one_resolved_order(order_id)
 
     if (order := maybe_order) is None:
         detail = f"Order {order_id} not found"
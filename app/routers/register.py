@@ -1,94 +1,94 @@
+import hashlib
+from dataclasses import dataclass
 from typing import Annotated
-from uuid import UUID, uuid4
+from uuid import UUID
 
-import pydantic
 from fastapi import (
     APIRouter,
     Cookie,
     Depends,
     Form,
+    Header,
     HTTPException,
     Request,
     Response,
     status,
 )
 from fastapi.responses import HTMLResponse
+from markupsafe import Markup
+from pydantic import Field
 
-from ..store import OrderedItemTable, OrderTable, Product, ProductTable
+from ..store import OrderSessions, Product, ProductTable, issue_order
+from ..store.product import Catalog
+from ..store.session import Metrics, OrderSession
 from ..templates import hx_post as tmp_hx_post
 from ..templates import macro_template
 
 router = APIRouter()
 
+MAX_QUANTITY = 99
+"""The most items of a product that a single request can add or delete."""
 
-class OrderSession(pydantic.BaseModel):
-    class CountedProduct(pydantic.BaseModel):
-        name: str
-        price: str
-        count: int = pydantic.Field(default=1)
 
-    items: dict[UUID, Product] = pydantic.Field(default_factory=dict)
-    counted_products: dict[int, CountedProduct] = pydantic.Field(default_factory=dict)
-    total_count: int = pydantic.Field(default=0)
-    total_price: int = pydantic.Field(default=0)
+@dataclass(frozen=True, slots=True)
+class SessionView:
+    """An order session with its products looked up from the catalog."""
 
-    def clear(self):
-        self.total_count = 0
-        self.total_price = 0
-        self.items = {}
-        self.counted_products = {}
+    items: tuple[tuple[Product, int], ...]
+    """Products with their counts, leaving out those deleted since picked."""
+    total_count: int
+    total_price: int
 
     def total_price_str(self) -> str:
         return Product.to_price_str(self.total_price)
 
-    def add(self, p: Product):
-        self.total_count += 1
-        self.total_price += p.price
-        self.items[uuid4()] = p
-        if p.product_id in self.counted_products:
-            self.counted_products[p.product_id].count += 1
-        else:
-            counted_product = self.CountedProduct(name=p.name, price=p.price_str())
-            self.counted_products[p.product_id] = counted_product
-
-    def delete(self, item_id: UUID):
-        if item_id in self.items:
-            self.total_count -= 1
-            product = self.items.pop(item_id)
-            self.total_price -= product.price
-            if self.counted_products[product.product_id].count == 1:
-                self.counted_products.pop(product.product_id)
-            else:
-                self.counted_products[product.product_id].count -= 1
+    def product_ids(self) -> list[int]:
+        return [p.product_id for p, count in self.items for _ in range(count)]
+
+
+async def _view(session: OrderSession) -> SessionView:
+    items: list[tuple[Product, int]] = []
+    for product_id, count in session.counts.items():
+        if (product := await ProductTable.by_product_id(product_id)) is not None:
+            items.append((product, count))
+    return SessionView(
+        items=tuple(items),
+        total_count=sum(count for _, count in items),
+        total_price=sum(product.price * count for product, count in items),
+    )
 
 
 @macro_template("register.html")
-def tmp_register(products: list[Product], session: OrderSession): ...
+def tmp_register(
+    products: tuple[Product, ...], order_session_fragment: Markup | str
+): ...
 
 
 @macro_template("register.html", "order_session")
-def tmp_session(session: OrderSession): ...
+def tmp_session(session: SessionView): ...
 
 
 @macro_template("register.html", "confirm_modal")
-def tmp_confirm_modal(session: OrderSession): ...
+def tmp_confirm_modal(session: SessionView): ...
 
 
 @macro_template("register.html", "issued_modal")
-def tmp_issued_modal(order_id: int, session: OrderSession): ...
+def tmp_issued_modal(order_id: int, session: SessionView): ...
+
+
+@macro_template("register.html", "deferred_modal")
+def tmp_deferred_modal(sessions: list[tuple[UUID, SessionView]]): ...
 
 
 @macro_template("register.html", "error_modal")
 def tmp_error_modal(message: str): ...
 
 
-# NOTE: Do NOT store this data in database because the data is transient and should be kept in memory
-order_sessions: dict[UUID, OrderSession] = {}
 SESSION_COOKIE_KEY = "session_key"
 
 
 async def order_session_dep(session_key: Annotated[UUID, Cookie()]) -> OrderSession:
-    if (order_session := order_sessions.get(session_key)) is None:
+    if (order_session := await OrderSessions.get(session_key)) is None:
         raise HTTPException(status_code=404, detail=f"Session {session_key} not found")
     return order_session
 
@@ -96,108 +96,215 @@ async def order_session_dep(session_key: Annotated[UUID, Cookie()]) -> OrderSess
 SessionDeps = Annotated[OrderSession, Depends(order_session_dep)]
 
 
+@dataclass(frozen=True, slots=True)
+class _Page:
+    head: str
+    tail: str
+    digest: hashlib.blake2b
+    """The digest of the page without the order session, to be continued."""
+
+    def etag(self, fragment: str) -> str:
+        digest = self.digest.copy()
+        digest.update(fragment.encode())
+        return f'"{digest.hexdigest()}"'
+
+
+class _PageCache:
+    """
+    The register page rendered once per catalog version, split around the
+    order session.
+
+    The product grid takes most of the page and is the same for every cashier,
+    so only the order session is rendered per request and spliced in. The grid
+    embeds absolute URLs built by `url_for`, so pages are kept per base URL.
+    """
+
+    _SLOT = "<!-- order-session -->"
+
+    def __init__(self, catalog: Catalog):
+        self._catalog = catalog
+        self._version = -1
+        self._pages: dict[str, _Page] = {}
+
+    async def get(self, request: Request) -> _Page:
+        # Read the version first so that a concurrent write can't get its
+        # products cached under a newer version
+        version = self._catalog.version
+        products = await self._catalog.products()
+        if version != self._version:
+            self._version, self._pages = version, {}
+        key = str(request.base_url)
+        if (page := self._pages.get(key)) is None:
+            html = tmp_register(request, products, Markup(self._SLOT))
+            head, tail = html.split(self._SLOT)
+            digest = hashlib.blake2b(html.encode(), digest_size=8)
+            page = self._pages[key] = _Page(head, tail, digest)
+        return page
+
+
+_page_cache = _PageCache(ProductTable.catalog)
+
+
 @router.get("/register", response_class=HTMLResponse)
 async def instruct_creation_of_new_session_or_get_existing_session(
-    request: Request, session_key: Annotated[UUID | None, Cookie()] = None
+    request: Request,
+    session_key: Annotated[UUID | None, Cookie()] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
 ):
-    if session_key is None or (session := order_sessions.get(session_key)) is None:
+    session = None if session_key is None else await OrderSessions.get(session_key)
+    if session is None:
         return HTMLResponse(
             tmp_hx_post(request, "/register"),
             status_code=status.HTTP_405_METHOD_NOT_ALLOWED,
             headers={"allow": "POST"},
         )
 
-    products = await ProductTable.select_all()
-    return HTMLResponse(tmp_register(request, products, session))
+    page = await _page_cache.get(request)
+    fragment = tmp_session(request, await _view(session))
+    etag = page.etag(fragment)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Cookie"}
+    if if_none_match == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return HTMLResponse(page.head + fragment + page.tail, headers=headers)
 
 
 @router.get("/register/confirm-modal", response_class=HTMLResponse)
 async def get_confirm_dialog(request: Request, session: SessionDeps):
-    if session.total_count == 0:
+    view = await _view(session)
+    if view.total_count == 0:
         error_msg = "商品が選択されていません"
         return HTMLResponse(tmp_error_modal(request, error_msg))
     else:
-        return HTMLResponse(tmp_confirm_modal(request, session))
+        return HTMLResponse(tmp_confirm_modal(request, view))
 
 
 @router.post("/register")
 async def create_new_session_or_place_order(
     request: Request, session_key: Annotated[UUID | None, Cookie()] = None
 ):
-    if session_key is None or (session := order_sessions.get(session_key)) is None:
-        session_key = _create_new_session()
+    session = None if session_key is None else await OrderSessions.get(session_key)
+    if session_key is None or session is None:
+        return _session_response(await OrderSessions.create())
 
-        LOCATION = "/register"
-        headers = {"location": LOCATION, "hx-location": LOCATION}
-        res = Response(LOCATION, status_code=status.HTTP_201_CREATED, headers=headers)
-        res.set_cookie(SESSION_COOKIE_KEY, str(session_key))
-        return res
-
-    if session.total_count == 0:
+    if (await _view(session)).total_count == 0:
         error_msg = "商品が選択されていません"
         return HTMLResponse(tmp_error_modal(request, error_msg))
 
-    order_sessions.pop(session_key)
-    res = await _place_order(request, session)
+    # Other processes may have changed the session, or even placed its order
+    if (session := await OrderSessions.pop(session_key)) is None:
+        error_msg = "この注文は確定済みです"
+        return HTMLResponse(tmp_error_modal(request, error_msg))
+    res = await _place_order(request, await _view(session))
     res.delete_cookie(SESSION_COOKIE_KEY)
     return res
 
 
-def _create_new_session() -> UUID:
-    session_key = uuid4()
-    order_sessions[session_key] = OrderSession()
-    return session_key
+def _session_response(session_key: UUID) -> Response:
+    """Moves the client to the register with the session of `session_key`."""
+    LOCATION = "/register"
+    headers = {"location": LOCATION, "hx-location": LOCATION}
+    res = Response(LOCATION, status_code=status.HTTP_201_CREATED, headers=headers)
+    res.set_cookie(SESSION_COOKIE_KEY, str(session_key))
+    return res
 
 
-async def _place_order(request: Request, session: SessionDeps) -> HTMLResponse:
-    product_ids = [item.product_id for item in session.items.values()]
-    order_id = await OrderedItemTable.issue(product_ids)
+async def _place_order(request: Request, view: SessionView) -> HTMLResponse:
     # TODO: add a branch for out of stock error
-    await OrderTable.insert(order_id)
-    return HTMLResponse(tmp_issued_modal(request, order_id, session))
+    order_id = await issue_order(view.product_ids())
+    return HTMLResponse(tmp_issued_modal(request, order_id, view))
 
 
 @router.post("/register/items")
 async def add_session_item(
-    request: Request, session: SessionDeps, product_id: Annotated[int, Form()]
+    request: Request,
+    session: SessionDeps,
+    product_id: Annotated[int, Form()],
+    quantity: Annotated[int, Form(ge=1, le=MAX_QUANTITY)] = 1,
 ) -> Response:
-    if (product := await ProductTable.by_product_id(product_id)) is None:
+    if await ProductTable.by_product_id(product_id) is None:
         raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
 
-    session.add(product)
-    return HTMLResponse(tmp_session(request, session))
+    session.add(product_id, quantity)
+    return HTMLResponse(tmp_session(request, await _view(session)))
+
+
+@router.patch("/register/items")
+async def apply_session_items(
+    request: Request,
+    session: SessionDeps,
+    product_id: Annotated[list[int], Form()],
+    quantity: Annotated[
+        list[Annotated[int, Field(ge=-MAX_QUANTITY, le=MAX_QUANTITY)]], Form()
+    ],
+) -> Response:
+    """
+    Adds the `quantity` of each `product_id`, or deletes if negative, given as
+    pairs of repeated form fields. Either all of them are applied or none.
+    """
+    if len(product_id) != len(quantity):
+        detail = "product_id and quantity must be given in pairs"
+        raise HTTPException(status_code=422, detail=detail)
+    for each_id in set(product_id):
+        if await ProductTable.by_product_id(each_id) is None:
+            raise HTTPException(status_code=404, detail=f"Product {each_id} not found")
+
+    session.apply(zip(product_id, quantity))
+    return HTMLResponse(tmp_session(request, await _view(session)))
 
 
-@router.delete("/register/items/{item_id}", response_class=HTMLResponse)
-async def delete_session_item(request: Request, session: SessionDeps, item_id: UUID):
-    session.delete(item_id)
-    return HTMLResponse(tmp_session(request, session))
+@router.delete("/register/items/{product_id}", response_class=HTMLResponse)
+async def delete_session_item(request: Request, session: SessionDeps, product_id: int):
+    session.delete(product_id)
+    return HTMLResponse(tmp_session(request, await _view(session)))
 
 
 @router.delete("/register/items")
 async def clear_session_items(request: Request, session: SessionDeps) -> Response:
     session.clear()
-    return HTMLResponse(tmp_session(request, session))
-
-
-# TODO: add proper path operation for order deferral
-# # TODO: Store this data in database
-# deferred_order_sessions: dict[int, OrderSession] = {}
-#
-#
-# @router.post("/register/deferred", response_class=HTMLResponse)
-# async def post_defer_session(request: Request, session_key: Annotated[UUID, Cookie()]):
-#     order_session = await order_session_dep(session_key)
-#     if order_session in deferred_order_sessions:
-#         raise HTTPException(
-#             status_code=status.HTTP_409_CONFLICT,
-#             detail=f"Deferred session already exists",
-#         )
-#     deferred_order_sessions.append(order_sessions.pop(session_key))
-#     # TODO: respond with a message about the success of the deferral action
-#     # message = "注文を保留しました"
-#     # res = HTMLResponse(
-#     #     tmp_session(request, OrderSession(), message=message)
-#     # )
-#     # res.delete_cookie(SESSION_COOKIE_KEY)
-#     # return res
+    return HTMLResponse(tmp_session(request, await _view(session)))
+
+
+@router.get("/register/metrics")
+async def get_session_metrics() -> Metrics:
+    return await OrderSessions.metrics()
+
+
+@router.post("/register/deferred")
+async def defer_session(
+    request: Request, session: SessionDeps, session_key: Annotated[UUID, Cookie()]
+) -> Response:
+    if (await _view(session)).total_count == 0:
+        error_msg = "商品が選択されていません"
+        return HTMLResponse(tmp_error_modal(request, error_msg))
+    if not await OrderSessions.defer(session_key):
+        error_msg = "保留できませんでした。もう一度お試しください"
+        return HTMLResponse(tmp_error_modal(request, error_msg))
+    return _session_response(await OrderSessions.create())
+
+
+@router.get("/register/deferred", response_class=HTMLResponse)
+async def get_deferred_modal(request: Request):
+    sessions = [(key, await _view(s)) for key, s in await OrderSessions.deferred()]
+    return HTMLResponse(tmp_deferred_modal(request, sessions))
+
+
+@router.post("/register/deferred/{deferred_key}")
+async def resume_deferred_session(
+    request: Request,
+    deferred_key: UUID,
+    session_key: Annotated[UUID | None, Cookie()] = None,
+) -> Response:
+    # Set the order in progress aside instead of abandoning it
+    session = None if session_key is None else await OrderSessions.get(session_key)
+    in_progress = session is not None and (await _view(session)).total_count > 0
+    if session_key is not None and in_progress:
+        if not await OrderSessions.defer(session_key):
+            error_msg = "保留できませんでした。もう一度お試しください"
+            return HTMLResponse(tmp_error_modal(request, error_msg))
+
+    if await OrderSessions.resume(deferred_key) is None:
+        if session_key is not None and in_progress:
+            await OrderSessions.resume(session_key)
+        detail = f"Deferred session {deferred_key} not found"
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=detail)
+    return _session_response(deferred_key)
@@ -1,22 +1,30 @@
-import csv
+import asyncio
+import hashlib
+import time
 from dataclasses import dataclass
-from datetime import datetime
-from functools import lru_cache
 from pathlib import Path
-from typing import Annotated, Literal, Mapping
+from typing import Annotated, AsyncGenerator, Literal
 
-import sqlalchemy
-import sqlmodel
-from fastapi import APIRouter, Header, Request
-from fastapi.responses import HTMLResponse
-from sqlmodel import col
+from fastapi import APIRouter, Header, Query, Request, Response, status
+from fastapi.responses import HTMLResponse, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
 
+from .. import export
+from ..broadcast import Hub, Snapshot
+from ..env import STREAM_COALESCE_MS, STREAM_MAX_LATENCY_MS
 from ..templates import macro_template
-from ..store import OrderedItem, Order, Product, database, unixepoch
+from ..store import (
+    ChangeFeed,
+    IncomingQueue,
+    Product,
+    ProductTable,
+    SalesRollup,
+    ServiceTimes,
+    reader,
+)
 
 router = APIRouter()
 
-CSV_OUTPUT_PATH = Path("./static/stat.csv")
 GRAPH_OUTPUT_PATH = Path("./static/sales.png")
 
 
@@ -47,184 +55,63 @@ class Stat:
 def tmp_stat(stat: Stat): ...
 
 
-@macro_template("wait-estimate.html")
-def tmp_wait_estimate_page(estimate: str, waiting_order_count: int): ...
-
-
-@macro_template("wait-estimate.html", "component")
-def tmp_wait_estimate_component(estimate: str, waiting_order_count: int): ...
+@macro_template("stat.html", "component")
+def tmp_stat_component(stat: Stat): ...
 
 
-def convert_unixepoch_to_localtime(unixepoch_time: int) -> str:
-    local_time = datetime.fromtimestamp(unixepoch_time).astimezone()
-    return local_time.strftime("%Y-%m-%d %H:%M:%S")
-
-
-def zero_if_null[T](v: T | None) -> T | Literal[0]:
-    """
-    Handles the case where aggregate functions return NULL when no matching rows
-    are found
-    """
-    return v if v is not None else 0
-
-
-# TODO: Use async operations for writing csv rows so that this function does not block
-async def export_orders():
-    query = """
-    SELECT 
-        orders.order_id,
-        ordered_items.item_no,
-        unixepoch(orders.ordered_at) AS ordered_at,
-        unixepoch(orders.completed_at) AS completed_at,
-        ordered_items.product_id,
-        products.name,
-        products.price
-    FROM
-        orders
-    INNER JOIN
-        ordered_items ON orders.order_id = ordered_items.order_id
-    INNER JOIN
-        products ON ordered_items.product_id = products.product_id
-    WHERE
-        orders.canceled_at IS NULL
-    ORDER BY
-        orders.order_id ASC;
-    """
+@macro_template("wait-estimate.html")
+def tmp_wait_estimate_page(
+    estimate: str, waiting_order_count: int, window_minutes: int
+): ...
 
-    with open(CSV_OUTPUT_PATH, "w", newline="") as csv_file:
-        csv_writer = csv.writer(csv_file)
-
-        async_gen = database.iterate(query)
-        if (row := await anext(async_gen, None)) is None:
-            return
-
-        headers = [key for key in dict(row).keys()]
-        csv_writer.writerow(headers)
-
-        csv_writer.writerow(_filtered_row(row))
-        async for row in async_gen:
-            csv_writer.writerow(_filtered_row(row))
-
-
-def _filtered_row(row: Mapping) -> list:
-    filtered_row = []
-    for column_name, value in dict(row).items():
-        if column_name in ("ordered_at", "completed_at") and value is not None:
-            value = convert_unixepoch_to_localtime(value)
-        filtered_row.append(value)
-    return filtered_row
-
-
-_ordered_today = sqlmodel.func.date(
-    col(Order.ordered_at), "localtime"
-) == sqlmodel.func.date("now", "localtime")
-TOTAL_SALES_QUERY: sqlalchemy.Compiled = (
-    sqlmodel.select(col(Product.product_id))
-    .select_from(sqlmodel.join(OrderedItem, Order))
-    .join(Product)
-    .add_columns(
-        sqlmodel.func.count(col(Product.product_id)).label("count"),
-        sqlmodel.func.count(col(Product.product_id))
-        .filter(_ordered_today)
-        .label("count_today"),
-        col(Product.name),
-        col(Product.filename),
-        col(Product.price),
-        sqlmodel.func.sum(col(Product.price)).label("total_sales"),
-        sqlmodel.func.sum(col(Product.price))
-        .filter(_ordered_today)
-        .label("total_sales_today"),
-        col(Product.no_stock),
-    )
-    .where(col(Order.canceled_at).is_(None))
-    .group_by(col(Product.product_id))
-    .compile(compile_kwargs={"literal_binds": True})
-)
 
+@macro_template("wait-estimate.html", "component")
+def tmp_wait_estimate_component(
+    estimate: str, waiting_order_count: int, window_minutes: int
+): ...
 
-class AvgServiceTimeQuery:
-    @classmethod
-    @lru_cache(1)
-    def all_and_recent(cls) -> sqlalchemy.Compiled:
-        return (
-            sqlmodel.select(
-                sqlmodel.func.avg(cls._service_time_diff).label("all"),
-                sqlmodel.func.avg(cls._last_30mins).label("recent"),
-            )
-            .where(col(Order.completed_at).isnot(None))
-            .compile()
-        )
 
-    @classmethod
-    @lru_cache(1)
-    def recent(cls) -> sqlalchemy.Compiled:
-        return (
-            sqlmodel.select(sqlmodel.func.avg(cls._last_30mins).label("recent"))
-            .where(col(Order.completed_at).isnot(None))
-            .compile()
-        )
-
-    _service_time_diff = unixepoch(col(Order.completed_at)) - unixepoch(
-        col(Order.ordered_at)
-    )
-    _elapsed_secs = sqlmodel.func.unixepoch() - unixepoch(col(Order.completed_at))
-    _last_30mins = sqlmodel.case(
-        (_elapsed_secs / sqlmodel.text("60") < sqlmodel.text("30"), _service_time_diff)
-    )
-
-    @staticmethod
-    def seconds_to_jpn_mmss(secs: int) -> str:
-        mm, ss = divmod(secs, 60)
-        return f"{mm} 分 {ss} 秒"
+def seconds_to_jpn_mmss(secs: int) -> str:
+    mm, ss = divmod(secs, 60)
+    return f"{mm} 分 {ss} 秒"
 
 
 async def construct_stat() -> Stat:
-    sales_summary_aggregated: dict[int, Stat.SalesSummary] = {}
+    sales_summary_list: list[Stat.SalesSummary] = []
     total_sales_all_time = 0
     total_sales_today = 0
     total_items_all_time = 0
     total_items_today = 0
 
-    async for row in database.iterate(str(TOTAL_SALES_QUERY)):
-        product_id = row["product_id"]
-        assert isinstance(product_id, int)
-
-        count, count_today, total_sales, total_sales_today_ = map(
-            zero_if_null,
-            (
-                row["count"],
-                row["count_today"],
-                row["total_sales"],
-                row["total_sales_today"],
-            ),
-        )
-
-        sales_summary_aggregated[product_id] = Stat.SalesSummary(
-            product_id=product_id,
-            name=row["name"],
-            filename=row["filename"],
-            price=Product.to_price_str(row["price"]),
-            count=count,
-            count_today=count_today,
+    # Prices are applied here as the rollup only counts items
+    for sales in await SalesRollup.sales():
+        if (product := await ProductTable.catalog.get(sales.product_id)) is None:
+            continue
+        total_sales = product.price * sales.count
+        total_sales_today_ = product.price * sales.count_today
+
+        sales_summary = Stat.SalesSummary(
+            product_id=sales.product_id,
+            name=product.name,
+            filename=product.filename,
+            price=product.price_str(),
+            count=sales.count,
+            count_today=sales.count_today,
             total_sales=Product.to_price_str(total_sales),
             total_sales_today=Product.to_price_str(total_sales_today_),
-            no_stock=row["no_stock"],
+            no_stock=product.no_stock,
         )
+        sales_summary_list.append(sales_summary)
 
         total_sales_all_time += total_sales
         total_sales_today += total_sales_today_
 
-        total_items_all_time += count
-        total_items_today += count_today
+        total_items_all_time += sales.count
+        total_items_today += sales.count_today
 
-    sales_summary_list = list(sales_summary_aggregated.values())
-
-    record = await database.fetch_one(str(AvgServiceTimeQuery.all_and_recent()))
-    assert record is not None
-    avg_service_time_all, avg_service_time_recent = (
-        AvgServiceTimeQuery.seconds_to_jpn_mmss(int(zero_if_null(record[0]))),
-        AvgServiceTimeQuery.seconds_to_jpn_mmss(int(zero_if_null(record[1]))),
-    )
+    avg_all, recent = await ServiceTimes.average(), await ServiceTimes.recent()
+    avg_service_time_all = seconds_to_jpn_mmss(int(avg_all))
+    avg_service_time_recent = seconds_to_jpn_mmss(int(recent.mean))
 
     return Stat(
         total_sales_all_time=Product.to_price_str(total_sales_all_time),
@@ -239,35 +126,179 @@ async def construct_stat() -> Stat:
 
 @router.get("/stat", response_class=HTMLResponse)
 async def get_stat(request: Request):
-    await export_orders()
     return HTMLResponse(tmp_stat(request, await construct_stat()))
 
 
-WAITING_ORDER_COUNT_QUERY: sqlalchemy.Compiled = (
-    sqlmodel.select(sqlmodel.func.count(col(Order.order_id)))
-    .where(col(Order.completed_at).is_(None) & col(Order.canceled_at).is_(None))
-    .compile()
-)
+@router.get("/stat/orders.{format}", response_class=StreamingResponse)
+async def get_orders_export(
+    format: export.Format, since: Annotated[int, Query(ge=0)] = 0
+):
+    """
+    Streams the ordered items of the orders that have not been canceled. Pass
+    the last order id of a previous export as `since` to fetch the rest only.
+    """
+    filename = "orders" if since == 0 else f"orders-since-{since}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}.{format}"'}
+    rows = export.fetch_orders(reader, since)
+    return StreamingResponse(
+        export.encode(rows, format), media_type=format.media_type, headers=headers
+    )
 
 
-@router.get("/wait-estimates", response_class=HTMLResponse)
-async def get_estimates(
-    request: Request, hx_request: Annotated[str | None, Header()] = None
+@router.get("/stat-stream", response_class=EventSourceResponse)
+async def stat_stream(
+    request: Request, accept: Annotated[Literal["text/event-stream"], Header()]
 ):
-    async with database.transaction():
-        estimate_record = await database.fetch_one(str(AvgServiceTimeQuery.recent()))
-        waiting_order_count = await database.fetch_val(str(WAITING_ORDER_COUNT_QUERY))
+    _ = accept
+    return EventSourceResponse(_stat_stream(request))
 
-    assert estimate_record is not None
-    estimate = int(zero_if_null(estimate_record[0]))
+
+def _render_stat(request: Request, snapshot: Snapshot[Stat]) -> str:
+    return tmp_stat_component(request, snapshot.value)
+
+
+# `construct_stat` reads the in-memory aggregates and the catalog only, so
+# every manager watching the page costs one render per burst of changes.
+stat_hub = Hub(
+    construct_stat,
+    _render_stat,
+    ChangeFeed,
+    coalesce=STREAM_COALESCE_MS / 1000,
+    max_latency=STREAM_MAX_LATENCY_MS / 1000,
+)
+
+
+async def _stat_stream(request: Request) -> AsyncGenerator[dict[str, str], None]:
+    try:
+        async for message in stat_hub.subscribe(request):
+            yield message
+    except asyncio.CancelledError:
+        yield dict(event="shutdown", data="")
+    finally:
+        yield dict(event="shutdown", data="")
+
+
+@dataclass(frozen=True, slots=True)
+class WaitEstimate:
+    estimate: str
+    waiting_order_count: int
+    window_minutes: int
+    etag: str
+
+
+async def compute_wait_estimate() -> WaitEstimate:
+    waiting_order_count = len(IncomingQueue)
+    recent = await ServiceTimes.recent()
+    estimate = int(recent.estimate(waiting_order_count))
 
     if estimate == 0:
         estimate_str = "待ち時間なし"
     else:
-        estimate_str = AvgServiceTimeQuery.seconds_to_jpn_mmss(estimate)
+        estimate_str = seconds_to_jpn_mmss(estimate)
+
+    window_minutes = int(ServiceTimes.window // 60)
+    values = (estimate_str, waiting_order_count, window_minutes)
+    digest = hashlib.blake2b(repr(values).encode(), digest_size=8).hexdigest()
+    return WaitEstimate(*values, etag=f'"{digest}"')
+
+
+class _WaitEstimateCache:
+    """
+    Keeps the wait estimate computed at the latest change to the orders.
+
+    The estimate is recomputed after `ttl` seconds even without changes, as
+    completions leave the window of `ServiceTimes` with time. `refresh`
+    recomputes it regardless, for the stream that reloads on its own schedule.
+    """
+
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._cached: tuple[int, float, WaitEstimate] | None = None
+
+    async def get(self) -> WaitEstimate:
+        version, now = ChangeFeed.seq, time.monotonic()
+        if self._cached is not None:
+            cached_version, computed_at, wait_estimate = self._cached
+            if cached_version == version and now - computed_at < self._ttl:
+                return wait_estimate
+        return await self.refresh()
+
+    async def refresh(self) -> WaitEstimate:
+        version, now = ChangeFeed.seq, time.monotonic()
+        wait_estimate = await compute_wait_estimate()
+        self._cached = (version, now, wait_estimate)
+        return wait_estimate
+
+
+WAIT_ESTIMATE_TTL = 30
+wait_estimate_cache = _WaitEstimateCache(ttl=WAIT_ESTIMATE_TTL)
+
+
+@router.get("/wait-estimates", response_class=HTMLResponse)
+async def get_estimates(
+    request: Request,
+    hx_request: Annotated[str | None, Header()] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+):
+    wait_estimate = await wait_estimate_cache.get()
 
     if hx_request == "true":
         template = tmp_wait_estimate_component
+        # The page and the component are different representations
+        etag = wait_estimate.etag[:-1] + '-c"'
     else:
         template = tmp_wait_estimate_page
-    return HTMLResponse(template(request, estimate_str, waiting_order_count))
+        etag = wait_estimate.etag
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "HX-Request"}
+    if if_none_match == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    content = template(
+        request,
+        wait_estimate.estimate,
+        wait_estimate.waiting_order_count,
+        wait_estimate.window_minutes,
+    )
+    return HTMLResponse(content, headers=headers)
+
+
+@router.get("/wait-estimates-stream", response_class=EventSourceResponse)
+async def wait_estimates_stream(
+    request: Request, accept: Annotated[Literal["text/event-stream"], Header()]
+):
+    _ = accept
+    return EventSourceResponse(_wait_estimates_stream(request))
+
+
+def _render_wait_estimate(request: Request, snapshot: Snapshot[WaitEstimate]) -> str:
+    wait_estimate = snapshot.value
+    return tmp_wait_estimate_component(
+        request,
+        wait_estimate.estimate,
+        wait_estimate.waiting_order_count,
+        wait_estimate.window_minutes,
+    )
+
+
+# Every display is pushed the same fragment, rendered once per burst of changes
+# and again when completions leave the window without changes
+wait_estimates_hub = Hub(
+    wait_estimate_cache.refresh,
+    _render_wait_estimate,
+    ChangeFeed,
+    coalesce=STREAM_COALESCE_MS / 1000,
+    max_latency=STREAM_MAX_LATENCY_MS / 1000,
+    interval=WAIT_ESTIMATE_TTL,
+)
+
+
+async def _wait_estimates_stream(
+    request: Request,
+) -> AsyncGenerator[dict[str, str], None]:
+    try:
+        async for message in wait_estimates_hub.subscribe(request):
+            yield message
+    except asyncio.CancelledError:
+        yield dict(event="shutdown", data="")
+    finally:
+        yield dict(event="shutdown", data="")
@@ -1,46 +1,20 @@
+import asyncio
+from dataclasses import replace
+
+import pytest
 import sqlparse
+from fastapi import Request
 from inline_snapshot import snapshot
 
-from .orders import query_incoming, query_ordered_items_incoming, query_resolved
+from ..store import IncomingItem, IncomingOrder
+from . import orders
+from .orders import _CardCache, _single_flight, query_resolved
 
 
 def format_sql(sql: object):
     return sqlparse.format(sql, keyword_case="upper", reindent=True, wrap_after=80)
 
 
-def test_incoming_ordered_items_query():
-    assert format_sql(str(query_ordered_items_incoming)) == snapshot(
-        """\
-SELECT ordered_items.order_id, ordered_items.product_id, count(ordered_items.product_id) AS COUNT,
-       products.name, products.filename, unixepoch(orders.ordered_at) AS ordered_at
-FROM ordered_items
-JOIN products ON products.product_id = ordered_items.product_id
-JOIN orders ON orders.order_id = ordered_items.order_id
-WHERE ordered_items.supplied_at IS NULL
-  AND orders.canceled_at IS NULL
-  AND orders.completed_at IS NULL
-GROUP BY ordered_items.order_id, ordered_items.product_id
-ORDER BY ordered_items.product_id ASC, ordered_items.order_id ASC\
-"""
-    )
-
-
-def test_incoming_orders_query():
-    assert format_sql(str(query_incoming)) == snapshot(
-        """\
-SELECT orders.order_id, unixepoch(orders.ordered_at) AS ordered_at, ordered_items.product_id,
-       unixepoch(ordered_items.supplied_at) AS supplied_at, count(ordered_items.product_id) AS COUNT, products.name
-FROM orders
-JOIN ordered_items ON orders.order_id = ordered_items.order_id
-JOIN products ON products.product_id = ordered_items.product_id
-WHERE orders.canceled_at IS NULL
-  AND orders.completed_at IS NULL
-GROUP BY orders.order_id, ordered_items.product_id
-ORDER BY orders.order_id ASC, ordered_items.product_id ASC\
-"""
-    )
-
-
 def test_resolved_orders_query():
     assert format_sql(str(query_resolved)) == snapshot(
         """\
@@ -56,3 +30,53 @@ GROUP BY orders.order_id, ordered_items.product_id
 ORDER BY orders.order_id ASC, ordered_items.product_id ASC\
 """
     )
+
+
+def test_single_flight_shares_loads_until_version_changes():
+    async def run():
+        version = 0
+        loads = 0
+
+        async def load() -> tuple[int, ...]:
+            nonlocal loads
+            loads += 1
+            current = loads
+            await asyncio.sleep(0)
+            return (current,)
+
+        shared = _single_flight(load, lambda: version)
+        first = await asyncio.gather(shared(), shared(), shared())
+        in_flight = asyncio.ensure_future(shared())
+        await asyncio.sleep(0)
+        version += 1
+        second = await asyncio.gather(in_flight, shared())
+        return first, second, loads
+
+    assert asyncio.run(run()) == snapshot(([(1,), (1,), (1,)], [(2,), (3,)], 3))
+
+
+def test_card_cache_renders_modified_orders_only(monkeypatch: pytest.MonkeyPatch):
+    rendered: list[tuple[int, bool]] = []
+    card = orders.incoming_orders.card
+
+    def counting_card(request: Request, order, oob: bool = False):
+        rendered.append((order["order_id"], oob))
+        return card(request, order, oob)
+
+    monkeypatch.setattr(orders.incoming_orders, "card", counting_card)
+
+    item = IncomingItem(1, "コーヒー", "coffee.png", 1, None)
+    queue = tuple(IncomingOrder(i, 0, (item,), version=1) for i in range(1, 101))
+    request = Request({"type": "http", "headers": []})
+    cache = _CardCache()
+
+    first = cache.cards(request, queue)
+    # Supplying an item of order 50 and resolving order 1
+    supplied = replace(queue[49], items=(replace(item, supplied_at=1),), version=2)
+    queue = (*queue[1:49], supplied, *queue[50:])
+    patch = cache.card(request, supplied, oob=True)
+    second = cache.cards(request, queue)
+
+    assert first[1:49] == second[:48] and first[50:] == second[49:]
+    assert 'hx-swap-oob="true"' in patch and "✓" in second[48]
+    assert rendered[100:] == snapshot([(50, True), (50, False)])
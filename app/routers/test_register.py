@@ -0,0 +1,146 @@
+import asyncio
+import re
+from uuid import uuid4
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from inline_snapshot import snapshot
+from starlette.routing import Mount, Router
+
+from ..store import Product
+from ..store.session import Store
+from . import register
+from .register import SessionView, _PageCache, tmp_session
+
+
+class _Catalog:
+    """Stands in for `store.product.Catalog`, counting the loads."""
+
+    def __init__(self):
+        self.version = 0
+        self.loads = 0
+
+    async def products(self) -> tuple[Product, ...]:
+        self.loads += 1
+        name = f"product-v{self.version}"
+        return (Product(product_id=1, name=name, filename="", price=100, no_stock=0),)
+
+
+def test_page_cache_renders_the_grid_once_per_catalog_version():
+    router = Router([Mount("/static", routes=[], name="static")])
+
+    def request(host: str) -> Request:
+        headers = [(b"host", host.encode())]
+        scope = {"type": "http", "scheme": "http", "server": (host, 80)}
+        return Request({**scope, "path": "/", "headers": headers, "router": router})
+
+    async def run():
+        catalog = _Catalog()
+        cache = _PageCache(catalog)  # pyright: ignore[reportArgumentType]
+        empty = tmp_session(request("a"), SessionView((), 0, 0))
+
+        page = await cache.get(request("a"))
+        same = await cache.get(request("a")) is page
+        other_host = await cache.get(request("b")) is page
+        etags = {page.etag(empty)}
+
+        picked = SessionView((((await catalog.products())[0], 1),), 1, 100)
+        etags.add(page.etag(tmp_session(request("a"), picked)))
+
+        catalog.version += 1
+        updated = await cache.get(request("a"))
+        etags.add(updated.etag(empty))
+        return (
+            same,
+            other_host,
+            "product-v0" in page.head,
+            "product-v1" in updated.head,
+            len(etags),
+        )
+
+    assert asyncio.run(run()) == snapshot((True, False, True, True, 3))
+
+
+class _ProductTable:
+    """Stands in for `store.ProductTable` with two products."""
+
+    async def by_product_id(self, product_id: int) -> Product | None:
+        if product_id not in (1, 2):
+            return None
+        name, price = f"product-{product_id}", 100 * product_id
+        return Product(
+            product_id=product_id, name=name, filename="", price=price, no_stock=0
+        )
+
+
+@pytest.fixture
+def client(monkeypatch: pytest.MonkeyPatch) -> TestClient:
+    monkeypatch.setattr(register, "ProductTable", _ProductTable())
+    monkeypatch.setattr(register, "OrderSessions", Store(ttl=60, maxsize=8))
+    app = FastAPI()
+    app.include_router(register.router)
+    client = TestClient(app)
+    client.cookies = client.post("/register").cookies
+    return client
+
+
+def _total_count(html: str) -> int:
+    match = re.search(r"(\d+) 点", html)
+    assert match is not None
+    return int(match.group(1))
+
+
+def test_resuming_defers_the_order_in_progress(client: TestClient):
+    client.post("/register/items", data={"product_id": 1})
+    first = client.cookies["session_key"]
+    client.cookies = client.post("/register/deferred").cookies
+    client.post("/register/items", data={"product_id": 2, "quantity": 2})
+    second = client.cookies["session_key"]
+
+    res = client.post(f"/register/deferred/{first}")
+    client.cookies = res.cookies
+    resumed = _total_count(client.get("/register/confirm-modal").text)
+    listed = client.get("/register/deferred").text
+    # Puts the order in progress back if there is nothing to resume
+    missing = client.post(f"/register/deferred/{uuid4()}").status_code
+    kept = _total_count(client.get("/register/confirm-modal").text)
+    relisted = first in client.get("/register/deferred").text
+
+    assert (res.status_code, resumed) == snapshot((201, 1))
+    assert (second in listed, first in listed) == snapshot((True, False))
+    assert (missing, kept, relisted) == snapshot((404, 1, False))
+
+
+def test_applying_items_is_all_or_none(client: TestClient):
+    client.post("/register/items", data={"product_id": 1, "quantity": 3})
+
+    def patch(product_ids: list[int], quantities: list[int]) -> tuple[int, int]:
+        data = {"product_id": product_ids, "quantity": quantities}
+        status_code = client.patch("/register/items", data=data).status_code
+        return status_code, _total_count(client.get("/register/confirm-modal").text)
+
+    unpaired = patch([1, 2], [1])
+    unknown = patch([2, 3], [5, 1])
+    applied = patch([1, 2, 2], [-2, 1, 1])
+    # Deleting more than picked leaves none of the product
+    overdeleted = patch([1], [-5])
+
+    assert (unpaired, unknown) == snapshot(((422, 3), (404, 3)))
+    assert (applied, overdeleted) == snapshot(((200, 3), (200, 2)))
+
+
+def test_quantities_are_bounded(client: TestClient):
+    client.post("/register/items", data={"product_id": 1})
+    too_many = str(register.MAX_QUANTITY + 1)
+    added = client.post("/register/items", data={"product_id": 1, "quantity": too_many})
+    data = {"product_id": [1, 2], "quantity": ["1", too_many]}
+    applied = client.patch("/register/items", data=data)
+    data = {"product_id": [1], "quantity": [f"-{too_many}"]}
+    deleted = client.patch("/register/items", data=data)
+    count = _total_count(client.get("/register/confirm-modal").text)
+
+    assert (added.status_code, applied.status_code, deleted.status_code) == snapshot(
+        (422, 422, 422)
+    )
+    assert count == snapshot(1)
@@ -1,66 +1,98 @@
-import sqlparse
+import asyncio
+import re
+from types import SimpleNamespace
+
+import pytest
+from fastapi import Request
 from inline_snapshot import snapshot
 
-from .stat import AvgServiceTimeQuery, WAITING_ORDER_COUNT_QUERY, TOTAL_SALES_QUERY
-
-
-def format_sql(sql: object):
-    return sqlparse.format(sql, keyword_case="upper", reindent=True, wrap_after=80)
-
-
-def test_total_sales_query():
-    assert format_sql(str(TOTAL_SALES_QUERY)) == snapshot(
-        """\
-SELECT products.product_id, count(products.product_id) AS COUNT,
-       count(products.product_id) FILTER (
-                                          WHERE date(orders.ordered_at,
-                                                  'localtime') = date('now',
-                                                                   'localtime')) AS count_today, products.name, products.filename, products.price,
-       sum(products.price) AS total_sales,
-       sum(products.price) FILTER (
-                                   WHERE date(orders.ordered_at,
-                                           'localtime') = date('now',
-                                                            'localtime')) AS total_sales_today, products.no_stock
-FROM ordered_items
-JOIN orders ON orders.order_id = ordered_items.order_id
-JOIN products ON products.product_id = ordered_items.product_id
-WHERE orders.canceled_at IS NULL
-GROUP BY products.product_id\
-"""
-    )
+from ..store import ChangeFeed, ModifiedFlag, Product
+from ..store.sales import ProductSales
+from ..store.service_time import Recent
+from . import stat
+from .stat import WaitEstimate, _WaitEstimateCache
 
 
-def test_avg_service_time_query_recent():
-    assert format_sql(str(AvgServiceTimeQuery.recent())) == snapshot(
-        """\
-SELECT avg(CASE
-               WHEN ((unixepoch() - unixepoch(orders.completed_at)) / CAST(60 AS NUMERIC) < 30) THEN unixepoch(orders.completed_at) - unixepoch(orders.ordered_at)
-           END) AS recent
-FROM orders
-WHERE orders.completed_at IS NOT NULL\
-"""
-    )
+def test_wait_estimate_cache_recomputes_once_per_change(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    computed: list[int] = []
+
+    async def compute_wait_estimate() -> WaitEstimate:
+        computed.append(ChangeFeed.seq)
+        return WaitEstimate("待ち時間なし", len(computed), 30, f'"{len(computed)}"')
 
+    monkeypatch.setattr(stat, "compute_wait_estimate", compute_wait_estimate)
 
-def test_avg_service_time_query():
-    assert format_sql(str(AvgServiceTimeQuery.all_and_recent())) == snapshot(
-        """\
-SELECT avg(unixepoch(orders.completed_at) - unixepoch(orders.ordered_at)) AS "all",
-       avg(CASE
-               WHEN ((unixepoch() - unixepoch(orders.completed_at)) / CAST(60 AS NUMERIC) < 30) THEN unixepoch(orders.completed_at) - unixepoch(orders.ordered_at)
-           END) AS recent
-FROM orders
-WHERE orders.completed_at IS NOT NULL\
-"""
+    async def run():
+        cache = _WaitEstimateCache(ttl=60)
+        etags = [(await cache.get()).etag for _ in range(3)]
+        ChangeFeed.append(ModifiedFlag.INCOMING, (1,))
+        etags += [(await cache.get()).etag for _ in range(3)]
+        expired = _WaitEstimateCache(ttl=0)
+        etags += [(await expired.get()).etag for _ in range(2)]
+        # Refreshing recomputes before the TTL and serves the result after
+        etags += [(await cache.refresh()).etag, (await cache.get()).etag]
+        return etags
+
+    assert asyncio.run(run()) == snapshot(
+        ['"1"', '"1"', '"1"', '"2"', '"2"', '"2"', '"3"', '"4"', '"5"', '"5"']
     )
+    assert len(computed) == 5
+
+
+class _Catalog:
+    async def get(self, product_id: int) -> Product | None:
+        name, price = f"product-{product_id}", 100 * product_id
+        return Product(
+            product_id=product_id, name=name, filename="", price=price, no_stock=None
+        )
+
+
+class _SalesRollup:
+    def __init__(self):
+        self.count = 1
+
+    async def sales(self) -> list[ProductSales]:
+        return [ProductSales(product_id=2, count=self.count, count_today=1)]
+
+
+class _ServiceTimes:
+    async def average(self) -> float:
+        return 90
+
+    async def recent(self) -> Recent:
+        return Recent(count=1, mean=60, p50=60, p90=60, interval=60)
+
+
+def test_stat_hub_pushes_stats_on_changes(monkeypatch: pytest.MonkeyPatch):
+    sales = _SalesRollup()
+    monkeypatch.setattr(stat, "ProductTable", SimpleNamespace(catalog=_Catalog()))
+    monkeypatch.setattr(stat, "SalesRollup", sales)
+    monkeypatch.setattr(stat, "ServiceTimes", _ServiceTimes())
 
+    async def run():
+        request = Request({"type": "http", "headers": [], "path": "/stat-stream"})
+        stream = stat.stat_hub.subscribe(request)
+        initial = await anext(stream)
+        sales.count = 3
+        ChangeFeed.append(ModifiedFlag.INCOMING, (1,))
+        updated = await anext(stream)
+        await stream.aclose()
+        return [
+            (message["event"], re.findall(r"¥[\d,]+|\d+ 分 \d+ 秒", message["data"]))
+            for message in (initial, updated)
+        ]
 
-def test_waiting_order_count_query():
-    assert format_sql(str(WAITING_ORDER_COUNT_QUERY)) == snapshot(
-        """\
-SELECT count(orders.order_id) AS count_1
-FROM orders
-WHERE orders.completed_at IS NULL
-  AND orders.canceled_at IS NULL\
-"""
+    assert asyncio.run(run()) == snapshot(
+        [
+            (
+                "message",
+                ["¥200", "¥200", "1 分 30 秒", "1 分 0 秒", "¥200", "¥200", "¥200"],
+            ),
+            (
+                "message",
+                ["¥600", "¥200", "1 分 30 秒", "1 分 0 秒", "¥200", "¥600", "¥200"],
+            ),
+        ]
     )
@@ -3,11 +3,23 @@ from datetime import datetime, timezone
 import sqlalchemy
 import sqlmodel
 from databases import Database
-from sqlalchemy import orm as sa_orm
+from sqlalchemy.dialects import sqlite
 from sqlmodel import col
 
-from . import order, ordered_item, product
-from ._helper import _colname
+from .. import env
+from . import (
+    _sqlite,
+    changes,
+    incoming,
+    order,
+    ordered_item,
+    product,
+    sales,
+    service_time,
+    session,
+)
+from ._helper import unixepoch
+from .incoming import IncomingItem, IncomingOrder  # noqa: F401
 from .order import ModifiedFlag, Order  # noqa: F401
 from .ordered_item import OrderedItem
 from .product import Product
@@ -15,11 +27,55 @@ from .product import Product
 from .base import TableBase
 
 DATABASE_URL = "sqlite:///db/app.db"
-database = Database(DATABASE_URL)
+database = Database(DATABASE_URL, factory=_sqlite.Connection)
+"""The single connection for writes, which SQLite serializes anyway."""
+reader = Database(DATABASE_URL, factory=_sqlite.ReadOnlyConnection)
+"""
+Read-only connections for loads that need not see uncommitted writes. Long
+reads don't hold up writes on `database` as the journal runs in WAL mode.
+"""
+_pools = (_sqlite.pooled(database, 1), _sqlite.pooled(reader, env.SQLITE_READERS))
 
-ProductTable = product.Table(database)
 OrderedItemTable = ordered_item.Table(database)
-OrderTable = order.Table(database)
+IncomingQueue = incoming.Queue(database)
+SalesRollup = sales.Rollup(database, reader)
+ServiceTimes = service_time.ServiceTimes(
+    reader, window=env.SERVICE_TIME_WINDOW_MINUTES * 60
+)
+
+
+ChangeFeed = changes.Feed()
+
+
+def _change_bus(name: str) -> changes.LocalBus:
+    match name:
+        case "local":
+            return changes.LocalBus(ChangeFeed)
+        case "sqlite":
+            interval = env.CHANGE_POLL_INTERVAL
+            return changes.SQLiteBus(ChangeFeed, database, interval, reader)
+        case _:
+            raise ValueError(f"Unknown change bus: {name!r}")
+
+
+ChangeBus = _change_bus(env.CHANGE_BUS)
+ProductTable = product.Table(database, IncomingQueue, ChangeBus)
+
+
+def _session_store(name: str) -> session.Store:
+    ttl, maxsize = env.SESSION_TTL_MINUTES * 60, env.SESSION_MAX_COUNT
+    match name:
+        case "local":
+            return session.Store(ttl, maxsize)
+        case "sqlite":
+            interval = env.SESSION_FLUSH_INTERVAL
+            return session.SQLiteStore(database, ttl, maxsize, interval, reader)
+        case _:
+            raise ValueError(f"Unknown session store: {name!r}")
+
+
+OrderSessions = _session_store(env.SESSION_STORE)
+OrderTable = order.Table(database, IncomingQueue, SalesRollup, ServiceTimes, ChangeBus)
 
 
 async def delete_product(product_id: int):
@@ -31,17 +87,26 @@ async def delete_product(product_id: int):
         query = sqlmodel.delete(OrderedItem).where(clause)
         await database.execute(query)
 
+    # Deleting ordered items can affect any unresolved order
+    await IncomingQueue.ainit()
+    SalesRollup.invalidate()
+    ProductTable.catalog.invalidate()
+    await ChangeBus.publish(ModifiedFlag.ORIGINAL | ModifiedFlag.CATALOG, None)
 
-# TODO: there should be a way to use the unixepoch function without this boiler plate
-def unixepoch(attr: sa_orm.Mapped) -> sqlalchemy.Label:
-    colname = _colname(attr)
-    alias = getattr(attr, "name")
-    return sqlalchemy.literal_column(f"unixepoch({colname})").label(alias)
+
+async def issue_order(product_ids: list[int]) -> int:
+    async with database.transaction():
+        order_id, ordered_at = await OrderTable._insert()
+        await OrderedItemTable._issue(order_id, product_ids)
+    SalesRollup.issue(order_id, ordered_at, product_ids)
+    await IncomingQueue.put(order_id)
+    await ChangeBus.publish(ModifiedFlag.INCOMING, (order_id,))
+    return order_id
 
 
 async def supply_and_complete_order_if_done(order_id: int, product_id: int):
     async with database.transaction():
-        await OrderedItemTable._supply(order_id, product_id)
+        supplied_at = await OrderedItemTable._supply(order_id, product_id)
 
         update_query = (
             sqlmodel.update(Order)
@@ -54,30 +119,42 @@ async def supply_and_complete_order_if_done(order_id: int, product_id: int):
                 .where(col(OrderedItem.order_id) == order_id)
                 .scalar_subquery()
             )
-            .returning(col(Order.order_id).isnot(None))
+            .returning(unixepoch(col(Order.ordered_at)))
         )
 
-        values = {"completed_at": datetime.now(timezone.utc)}
-        completed: bool | None = await database.fetch_val(update_query, values)
+        completed_at = datetime.now(timezone.utc)
+        values = {"completed_at": completed_at}
+        ordered_at: int | None = await database.fetch_val(update_query, values)
+
+    if ordered_at is None:
+        IncomingQueue.supply(order_id, product_id, supplied_at)
+    else:
+        ServiceTimes.complete(order_id, ordered_at, int(completed_at.timestamp()))
+        IncomingQueue.remove(order_id)
 
-    async with OrderTable.modified_cond_flag:
-        flag = ModifiedFlag.SUPPLIED
-        if completed is not None:
-            flag |= ModifiedFlag.RESOLVED
-        OrderTable.modified_cond_flag.notify_all(flag)
+    flag = ModifiedFlag.SUPPLIED
+    if ordered_at is not None:
+        flag |= ModifiedFlag.RESOLVED
+    await ChangeBus.publish(flag, (order_id,))
 
 
 async def supply_all_and_complete(order_id: int):
     async with database.transaction():
+        # Completing an order un-cancels it
+        order_sales = await SalesRollup.of_order(order_id)
         await OrderedItemTable._supply_all(order_id)
-        await OrderTable._complete(order_id)
-    async with OrderTable.modified_cond_flag:
-        FLAG = ModifiedFlag.SUPPLIED | ModifiedFlag.RESOLVED
-        OrderTable.modified_cond_flag.notify_all(FLAG)
+        times = await OrderTable._complete(order_id)
+    SalesRollup.update(order_sales, canceled=False)
+    if times is not None:
+        ServiceTimes.complete(order_id, *times)
+    IncomingQueue.remove(order_id)
+    FLAG = ModifiedFlag.SUPPLIED | ModifiedFlag.RESOLVED
+    await ChangeBus.publish(FLAG, (order_id,))
 
 
 async def _startup_db() -> None:
     await database.connect()
+    await reader.connect()
 
     # TODO:instruct the user to generate missing tables by running alembic
     # migrations instead of creating tables through the SQLAlchemy query. Right
@@ -88,13 +165,51 @@ async def _startup_db() -> None:
         schema = sqlalchemy.schema.CreateTable(table, if_not_exists=True)
         query = str(schema.compile())
         await database.execute(query)
+        for index in table.indexes:
+            schema = sqlalchemy.schema.CreateIndex(index, if_not_exists=True)
+            query = str(schema.compile(dialect=sqlite.dialect()))
+            await database.execute(query)
 
     await ProductTable.ainit()
-    await OrderedItemTable.ainit()
+    await IncomingQueue.ainit()
+    await SalesRollup.ainit()
+    await ServiceTimes.ainit()
+    await ChangeBus.start(_apply_remote_change)
+    await OrderSessions.start()
+
+
+async def _apply_remote_change(
+    flag: ModifiedFlag, order_ids: tuple[int, ...] | None
+) -> None:
+    if flag & ModifiedFlag.CATALOG:
+        ProductTable.catalog.invalidate()
+        if flag == ModifiedFlag.CATALOG:
+            await IncomingQueue.ainit()
+            return
+    if order_ids is None:
+        # Any order may have changed, so recount lazily
+        SalesRollup.invalidate()
+        ServiceTimes.invalidate()
+        await IncomingQueue.ainit()
+        return
+    # Only refresh what the change can affect. Supplying items alone affects
+    # neither the sales nor the service times.
+    resolved = ModifiedFlag.ORIGINAL | ModifiedFlag.RESOLVED | ModifiedFlag.PUT_BACK
+    for order_id in order_ids:
+        if flag != ModifiedFlag.SUPPLIED:
+            await SalesRollup.refresh(order_id)
+        if flag & resolved:
+            await ServiceTimes.refresh(order_id)
+        await IncomingQueue.put(order_id)
 
 
 async def _shutdown_db() -> None:
+    await OrderSessions.stop()
+    await ChangeBus.stop()
+    await reader.disconnect()
     await database.disconnect()
+    for pool in _pools:
+        await pool.close()
 
 
 startup_and_shutdown_db = (_startup_db, _shutdown_db)
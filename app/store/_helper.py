@@ -1,3 +1,4 @@
+import sqlalchemy
 from sqlalchemy import orm as sa_orm
 
 
@@ -10,3 +11,10 @@ def _colname(attr: sa_orm.Mapped) -> str:
     ```
     """
     return attr.label(None).__str__()
+
+
+# TODO: there should be a way to use the unixepoch function without this boiler plate
+def unixepoch(attr: sa_orm.Mapped) -> sqlalchemy.Label:
+    colname = _colname(attr)
+    alias = getattr(attr, "name")
+    return sqlalchemy.literal_column(f"unixepoch({colname})").label(alias)
@@ -0,0 +1,112 @@
+import asyncio
+import sqlite3
+
+import aiosqlite
+from databases import Database
+from databases.backends.sqlite import SQLiteBackend, SQLitePool
+
+from .. import env
+
+
+def _pragmas() -> list[str]:
+    # Pragma values can't be bound as parameters, so validate them instead.
+    keywords = {
+        "journal_mode": env.SQLITE_JOURNAL_MODE,
+        "synchronous": env.SQLITE_SYNCHRONOUS,
+        "temp_store": env.SQLITE_TEMP_STORE,
+    }
+    integers = {
+        "busy_timeout": env.SQLITE_BUSY_TIMEOUT,
+        "mmap_size": env.SQLITE_MMAP_SIZE,
+        "cache_size": env.SQLITE_CACHE_SIZE,
+    }
+
+    pragmas: list[str] = []
+    for name, value in keywords.items():
+        if value == "":
+            continue
+        if not value.isalnum():
+            raise ValueError(f"invalid value for PRAGMA {name}: {value!r}")
+        pragmas.append(f"PRAGMA {name} = {value}")
+    for name, value in integers.items():
+        if value == "":
+            continue
+        pragmas.append(f"PRAGMA {name} = {int(value)}")
+    return pragmas
+
+
+PRAGMAS = _pragmas()
+
+
+class Connection(sqlite3.Connection):
+    """
+    Applies `PRAGMAS` to every new connection.
+
+    Pass this class as the `factory` option of `databases.Database`, which is
+    forwarded to `sqlite3.connect` each time a connection is opened.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for pragma in PRAGMAS:
+            self.execute(pragma).close()
+
+
+class ReadOnlyConnection(Connection):
+    """A `Connection` that rejects any statement modifying the database."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.execute("PRAGMA query_only = ON").close()
+
+
+class Pool:
+    """
+    Keeps up to `size` connections open and hands them out in turn.
+
+    The pool of the `databases` SQLite backend opens a new connection, along
+    with its thread, on every acquisition and closes it on release. This pool
+    reuses them instead and makes callers wait once all of them are in use.
+    """
+
+    def __init__(self, pool: SQLitePool, size: int):
+        self._pool = pool
+        self._memref = pool._memref  # accessed by `SQLiteBackend.disconnect`
+        self._size = size
+        self._opened = 0
+        self._closed = False
+        self._idle: asyncio.LifoQueue[aiosqlite.Connection] = asyncio.LifoQueue()
+
+    async def acquire(self) -> aiosqlite.Connection:
+        if self._idle.empty() and self._opened < self._size:
+            self._opened += 1
+            try:
+                return await self._pool.acquire()
+            except BaseException:
+                self._opened -= 1
+                raise
+        return await self._idle.get()
+
+    async def release(self, connection: aiosqlite.Connection) -> None:
+        if self._closed:
+            self._opened -= 1
+            await self._pool.release(connection)
+        else:
+            self._idle.put_nowait(connection)
+
+    async def close(self) -> None:
+        """Closes the idle connections, and the rest once they are released."""
+        self._closed = True
+        while not self._idle.empty():
+            connection = self._idle.get_nowait()
+            self._opened -= 1
+            await self._pool.release(connection)
+
+
+def pooled(database: Database, size: int) -> Pool:
+    """Makes `database` share at most `size` connections among all tasks."""
+    backend = database._backend
+    assert isinstance(backend, SQLiteBackend)
+    pool = Pool(backend._pool, size)
+    backend._pool = pool  # pyright: ignore[reportAttributeAccessIssue]
+    return pool
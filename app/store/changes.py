@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Annotated, Awaitable, Callable, Iterable
+
+import sqlmodel
+from databases import Database
+from sqlmodel import col
+
+from .base import TableBase
+from .order import ModifiedFlag
+
+logger = logging.getLogger(__name__)
+
+
+class Change(TableBase, table=True):
+    # NOTE: there are no Pydantic ways to set the generated table's name, as per https://github.com/fastapi/sqlmodel/issues/159
+    __tablename__ = "changes"  # pyright: ignore[reportAssignmentType]
+
+    seq: int | None = sqlmodel.Field(default=None, primary_key=True)
+    flag: int
+    order_ids: str | None
+    """Comma-separated ids of the affected orders, or NULL for all the orders."""
+    origin: int
+    """The id of the process that made the change."""
+    changed_at: Annotated[
+        datetime,
+        sqlmodel.Field(
+            sa_column_kwargs={"server_default": sqlmodel.text("CURRENT_TIMESTAMP")}
+        ),
+    ]
+
+
+@dataclass(frozen=True, slots=True)
+class Entry:
+    seq: int
+    flag: ModifiedFlag
+    order_ids: tuple[int, ...] | None
+    """The ids of the affected orders, or None for all the orders."""
+
+
+class Feed:
+    """
+    In-memory log of the changes made to orders, numbered by a monotonic
+    sequence.
+
+    Consumers keep the last sequence number they have seen and catch up from
+    there with a `Cursor`, so changes made while they are busy are never lost.
+    Only the latest `maxlen` entries are retained.
+    """
+
+    seq: int
+    _entries: deque[Entry]
+    _changed: asyncio.Event
+
+    def __init__(self, maxlen: int = 1024):
+        self.seq = 0
+        self._entries = deque(maxlen=maxlen)
+        self._changed = asyncio.Event()
+
+    def append(self, flag: ModifiedFlag, order_ids: Iterable[int] | None) -> int:
+        self.seq += 1
+        ids = None if order_ids is None else tuple(order_ids)
+        self._entries.append(Entry(self.seq, flag, ids))
+        # Wake up everyone waiting for the current event, and let later waiters
+        # wait for a new one.
+        self._changed.set()
+        self._changed = asyncio.Event()
+        return self.seq
+
+    def since(self, seq: int) -> tuple[Entry, ...] | None:
+        """
+        Returns the entries after `seq`, or None if some of them are no longer
+        retained.
+        """
+        if seq >= self.seq:
+            return ()
+        if not self._entries or self._entries[0].seq > seq + 1:
+            return None
+        start = len(self._entries) - (self.seq - seq)
+        return tuple(self._entries[i] for i in range(start, len(self._entries)))
+
+    async def wait(self, seq: int) -> None:
+        """Waits until there are entries after `seq`."""
+        while self.seq <= seq:
+            await self._changed.wait()
+
+    def cursor(self) -> "Cursor":
+        return Cursor(self, self.seq)
+
+
+class Cursor:
+    """Reads the entries of a `Feed` in order, starting after `seq`."""
+
+    seq: int
+
+    def __init__(self, feed: Feed, seq: int):
+        self._feed = feed
+        self.seq = seq
+
+    async def next(self) -> ModifiedFlag:
+        """
+        Waits for new entries and returns their flags merged, which coalesces
+        bursts of changes into one.
+        """
+        await self._feed.wait(self.seq)
+        entries = self._feed.since(self.seq)
+        self.seq = self._feed.seq
+        if entries is None:
+            # Fell too far behind to tell what has changed
+            return ModifiedFlag.ORIGINAL
+        flag = entries[0].flag
+        for entry in entries[1:]:
+            flag |= entry.flag
+        return flag
+
+
+type RemoteHandler = Callable[[ModifiedFlag, tuple[int, ...] | None], Awaitable[None]]
+"""Applies the changes made to the given orders, or all if None, by others."""
+
+
+class LocalBus:
+    """Notifies changes to the streams in the current process only."""
+
+    _feed: Feed
+
+    def __init__(self, feed: Feed):
+        self._feed = feed
+
+    async def start(self, on_remote: RemoteHandler) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, flag: ModifiedFlag, order_ids: Iterable[int] | None):
+        """
+        Notifies that the orders with `order_ids`, or all the orders if None,
+        have been modified. Call this after the modification has been committed.
+        """
+        self._feed.append(flag, order_ids)
+
+
+class SQLiteBus(LocalBus):
+    """
+    Notifies changes to the streams in every process sharing the database.
+
+    Changes are appended to the `changes` table, which each process polls for
+    the ones made by others. Remote changes are handed to `on_remote` so that
+    in-memory state can catch up before the local streams are woken. Polling
+    only reads, so pass the read-only `reader` to keep it from queuing behind
+    writes on `database`.
+    """
+
+    PRUNE_EVERY = 1024
+    """Rows older than `RETENTION` are deleted once in this many changes."""
+    RETENTION = "-10 minutes"
+
+    _db: Database
+    _reader: Database
+    _interval: float
+    _origin: int
+    _last_seq: int
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        feed: Feed,
+        database: Database,
+        interval: float,
+        reader: Database | None = None,
+        origin: int | None = None,
+    ):
+        super().__init__(feed)
+        self._db = database
+        self._reader = database if reader is None else reader
+        self._interval = interval
+        self._origin = os.getpid() if origin is None else origin
+        self._last_seq = 0
+        self._task = None
+
+    async def start(self, on_remote: RemoteHandler) -> None:
+        query = sqlmodel.select(sqlmodel.func.max(col(Change.seq)))
+        self._last_seq = await self._reader.fetch_val(query) or 0
+        self._task = asyncio.create_task(self._poll_forever(on_remote))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def publish(self, flag: ModifiedFlag, order_ids: Iterable[int] | None):
+        order_ids = None if order_ids is None else tuple(order_ids)
+        values = {
+            "flag": flag.value,
+            "order_ids": None if order_ids is None else ",".join(map(str, order_ids)),
+            "origin": self._origin,
+        }
+        query = sqlmodel.insert(Change).returning(col(Change.seq))
+        seq: int = await self._db.fetch_val(query, values)
+        if seq % self.PRUNE_EVERY == 0:
+            clause = col(Change.changed_at) < sqlmodel.func.datetime(
+                "now", self.RETENTION
+            )
+            await self._db.execute(sqlmodel.delete(Change).where(clause))
+        self._feed.append(flag, order_ids)
+
+    async def poll(self, on_remote: RemoteHandler) -> None:
+        """Applies the changes made by other processes since the last poll."""
+        query = (
+            sqlmodel.select(Change)
+            .where(col(Change.seq) > self._last_seq)
+            .order_by(col(Change.seq).asc())
+        )
+        # Fetch all the rows first as `on_remote` may query the same connection
+        for row in await self._reader.fetch_all(query):
+            self._last_seq = row["seq"]
+            if row["origin"] == self._origin:
+                continue
+            flag, order_ids = ModifiedFlag(row["flag"]), row["order_ids"]
+            if order_ids is not None:
+                order_ids = tuple(int(i) for i in order_ids.split(",") if i)
+            await on_remote(flag, order_ids)
+            self._feed.append(flag, order_ids)
+
+    async def _poll_forever(self, on_remote: RemoteHandler) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.poll(on_remote)
+            except Exception:
+                logger.exception("Failed to poll changes from other processes")
@@ -0,0 +1,148 @@
+from dataclasses import dataclass, replace
+from datetime import datetime
+
+import sqlalchemy
+import sqlmodel
+from databases import Database
+from sqlmodel import col
+
+from ._helper import unixepoch
+from .order import Order
+from .ordered_item import OrderedItem
+from .product import Product
+
+
+@dataclass(frozen=True, slots=True)
+class IncomingItem:
+    product_id: int
+    name: str
+    filename: str
+    count: int
+    supplied_at: int | None
+
+
+@dataclass(frozen=True, slots=True)
+class IncomingOrder:
+    order_id: int
+    ordered_at: int
+    items: tuple[IncomingItem, ...]
+    version: int
+    """The queue version at which this order was last modified."""
+
+
+query_incoming: sqlalchemy.Select = (
+    # Query from the orders table
+    sqlmodel.select(Order.order_id)
+    .group_by(col(Order.order_id))
+    .order_by(col(Order.order_id).asc())
+    .add_columns(unixepoch(col(Order.ordered_at)))
+    # Filter out canceled/completed orders
+    .where(col(Order.canceled_at).is_(None) & col(Order.completed_at).is_(None))
+    # Query the list of ordered items
+    .select_from(sqlmodel.join(Order, OrderedItem))
+    .add_columns(col(OrderedItem.product_id), unixepoch(col(OrderedItem.supplied_at)))
+    .group_by(col(OrderedItem.product_id))
+    .order_by(col(OrderedItem.product_id).asc())
+    .add_columns(sqlmodel.func.count(col(OrderedItem.product_id)).label("count"))
+    # Query product name and image
+    .join(Product)
+    .add_columns(col(Product.name), col(Product.filename))
+)
+
+
+class Queue:
+    """
+    In-memory model of unresolved orders.
+
+    The queue is rebuilt from the database on startup and whenever products
+    change, since orders carry their names and images. Otherwise, the
+    operations that resolve or put back orders apply their changes to it
+    directly, so readers never have to run `query_incoming` again. Orders are
+    immutable and replaced on every change, which makes the tuple returned by
+    `orders()` a consistent snapshot.
+    """
+
+    _db: Database
+    _orders: dict[int, IncomingOrder]
+    _snapshot: tuple[IncomingOrder, ...] | None
+    version: int
+
+    def __init__(self, database: Database):
+        self._db = database
+        self._orders = {}
+        self._snapshot = None
+        self.version = 0
+
+    async def ainit(self) -> None:
+        orders = await self._select(query_incoming)
+        self._orders = {order.order_id: order for order in orders}
+        self._modified()
+
+    def orders(self) -> tuple[IncomingOrder, ...]:
+        if self._snapshot is None:
+            self._snapshot = tuple(self._orders.values())
+        return self._snapshot
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+    async def put(self, order_id: int) -> None:
+        """Loads an order that has been placed or put back into the queue."""
+        clause = col(Order.order_id) == order_id
+        match await self._select(query_incoming.where(clause)):
+            case [order]:
+                self._insert(order)
+            case _:
+                self.remove(order_id)
+
+    def remove(self, order_id: int) -> None:
+        if self._orders.pop(order_id, None) is not None:
+            self._modified()
+
+    def supply(self, order_id: int, product_id: int, supplied_at: datetime) -> None:
+        if (order := self._orders.get(order_id)) is None:
+            return
+        epoch = int(supplied_at.timestamp())
+        items = tuple(
+            replace(item, supplied_at=epoch) if item.product_id == product_id else item
+            for item in order.items
+        )
+        self._orders[order_id] = replace(order, items=items, version=self.version + 1)
+        self._modified()
+
+    def _insert(self, order: IncomingOrder) -> None:
+        order = replace(order, version=self.version + 1)
+        last_order_id = next(reversed(self._orders), None)
+        self._orders[order.order_id] = order
+        # Orders put back into the queue may precede the ones being processed
+        if last_order_id is not None and order.order_id < last_order_id:
+            self._orders = dict(sorted(self._orders.items()))
+        self._modified()
+
+    def _modified(self) -> None:
+        self.version += 1
+        self._snapshot = None
+
+    async def _select(self, query: sqlalchemy.Select) -> list[IncomingOrder]:
+        # Loaded orders are stamped with the version they are applied at
+        version = self.version + 1
+        orders: list[IncomingOrder] = []
+        order_id, ordered_at, items = None, 0, []
+        async for row in self._db.iterate(query):
+            if row["order_id"] != order_id:
+                if order_id is not None:
+                    orders.append(
+                        IncomingOrder(order_id, ordered_at, tuple(items), version)
+                    )
+                order_id, ordered_at, items = row["order_id"], row["ordered_at"], []
+            item = IncomingItem(
+                product_id=row["product_id"],
+                name=row["name"],
+                filename=row["filename"],
+                count=row["count"],
+                supplied_at=row["supplied_at"],
+            )
+            items.append(item)
+        if order_id is not None:
+            orders.append(IncomingOrder(order_id, ordered_at, tuple(items), version))
+        return orders
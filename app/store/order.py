@@ -1,22 +1,28 @@
-import asyncio
 from datetime import datetime, timezone
 from enum import Flag, auto
-from typing import Annotated
+from typing import TYPE_CHECKING, Annotated
 
 import sqlalchemy
 import sqlmodel
 from databases import Database
 from sqlmodel import col
 
+from ._helper import unixepoch
 from .base import TableBase
 
+if TYPE_CHECKING:
+    from .changes import LocalBus
+    from .incoming import Queue
+    from .sales import Rollup
+    from .service_time import ServiceTimes
+
 
 class Order(TableBase, table=True):
     # NOTE: there are no Pydantic ways to set the generated table's name, as per https://github.com/fastapi/sqlmodel/issues/159
     __tablename__ = "orders"  # pyright: ignore[reportAssignmentType]
 
     id: int | None = sqlmodel.Field(default=None, primary_key=True)
-    order_id: int
+    order_id: Annotated[int, sqlmodel.Field(unique=True, index=True)]
     ordered_at: Annotated[
         datetime,
         sqlmodel.Field(
@@ -24,10 +30,24 @@ class Order(TableBase, table=True):
         ),
     ]
     canceled_at: datetime | None = sqlmodel.Field(
-        default=None, sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True))
+        default=None,
+        sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True), index=True),
     )
     completed_at: datetime | None = sqlmodel.Field(
-        default=None, sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True))
+        default=None,
+        sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True), index=True),
+    )
+
+    __table_args__ = (
+        # Covers the lookups of unresolved orders, which are a small fraction of
+        # all the orders once the history grows.
+        sqlalchemy.Index(
+            "ix_orders_unresolved",
+            "order_id",
+            sqlite_where=sqlalchemy.text(
+                "canceled_at IS NULL AND completed_at IS NULL"
+            ),
+        ),
     )
 
 
@@ -37,45 +57,45 @@ class ModifiedFlag(Flag):
     SUPPLIED = auto()
     RESOLVED = auto()
     PUT_BACK = auto()
-
-
-class ModifiedCondFlag:
-    _condvar: asyncio.Condition
-    _flag: ModifiedFlag
-
-    def __init__(self):
-        self._condvar = asyncio.Condition()
-        self._flag = ModifiedFlag.ORIGINAL
-
-    async def __aenter__(self):
-        await self._condvar.__aenter__()
-
-    async def __aexit__(self, exc_type, exc, tb) -> None:
-        await self._condvar.__aexit__(exc_type, exc, tb)
-
-    async def wait(self) -> ModifiedFlag:
-        await self._condvar.wait()
-        flag = self._flag
-        if len(self._condvar._waiters) == 0:
-            self._flag = ModifiedFlag.ORIGINAL
-        return flag
-
-    def notify_all(self, flag: ModifiedFlag):
-        self._flag |= flag
-        self._condvar.notify_all()
+    CATALOG = auto()
+    """The products have been modified."""
 
 
 class Table:
-    modified_cond_flag = ModifiedCondFlag()
-
-    def __init__(self, database: Database):
+    def __init__(
+        self,
+        database: Database,
+        incoming: "Queue",
+        sales: "Rollup",
+        service_times: "ServiceTimes",
+        bus: "LocalBus",
+    ):
         self._db = database
+        self._incoming = incoming
+        self._sales = sales
+        self._service_times = service_times
+        self._bus = bus
+
+    async def _insert(self) -> tuple[int, datetime]:
+        """
+        Inserts an order with the next order id and returns the id and the time
+        of the order. Use `issue_order` to insert the ordered items in the same
+        transaction.
 
-    async def insert(self, order_id: int) -> None:
-        query = sqlmodel.insert(Order)
-        await self._db.execute(query, {"order_id": order_id})
-        async with self.modified_cond_flag:
-            self.modified_cond_flag.notify_all(ModifiedFlag.INCOMING)
+        The id is allocated by the insert statement itself, which holds the
+        write lock of the database, so it is unique across processes.
+        """
+        next_order_id = (
+            sqlmodel.func.coalesce(sqlmodel.func.max(col(Order.order_id)), 0) + 1
+        )
+        query = (
+            sqlmodel.insert(Order)
+            .from_select([col(Order.order_id)], sqlmodel.select(next_order_id))
+            .returning(col(Order.order_id), col(Order.ordered_at))
+        )
+        row = await self._db.fetch_one(query)
+        assert row is not None
+        return row["order_id"], row["ordered_at"].replace(tzinfo=timezone.utc)
 
     @staticmethod
     def _update(order_id: int) -> sqlalchemy.Update:
@@ -84,23 +104,37 @@ class Table:
 
     async def cancel(self, order_id: int) -> None:
         values = {"canceled_at": datetime.now(timezone.utc), "completed_at": None}
-        await self._db.execute(self._update(order_id), values)
-        async with self.modified_cond_flag:
-            self.modified_cond_flag.notify_all(ModifiedFlag.RESOLVED)
-
-    async def _complete(self, order_id: int) -> None:
+        async with self._db.transaction():
+            sales = await self._sales.of_order(order_id)
+            await self._db.execute(self._update(order_id), values)
+        self._sales.update(sales, canceled=True)
+        self._service_times.discard(order_id)
+        self._incoming.remove(order_id)
+        await self._bus.publish(ModifiedFlag.RESOLVED, (order_id,))
+
+    async def _complete(self, order_id: int) -> tuple[int, int] | None:
         """
-        Use `supply_all_and_complete` when the `supplied_at` fields of
-        `ordered_items` table should be updated as well.
+        Returns the order and completion times in unix epoch, or None if the
+        order doesn't exist. Use `supply_all_and_complete` when the
+        `supplied_at` fields of `ordered_items` table should be updated as well.
         """
-        values = {"canceled_at": None, "completed_at": datetime.now(timezone.utc)}
-        await self._db.execute(self._update(order_id), values)
+        completed_at = datetime.now(timezone.utc)
+        values = {"canceled_at": None, "completed_at": completed_at}
+        query = self._update(order_id).returning(unixepoch(col(Order.ordered_at)))
+        ordered_at: int | None = await self._db.fetch_val(query, values)
+        if ordered_at is None:
+            return None
+        return ordered_at, int(completed_at.timestamp())
 
     async def reset(self, order_id: int) -> None:
         values = {"canceled_at": None, "completed_at": None}
-        await self._db.execute(self._update(order_id), values)
-        async with self.modified_cond_flag:
-            self.modified_cond_flag.notify_all(ModifiedFlag.PUT_BACK)
+        async with self._db.transaction():
+            sales = await self._sales.of_order(order_id)
+            await self._db.execute(self._update(order_id), values)
+        self._sales.update(sales, canceled=False)
+        self._service_times.discard(order_id)
+        await self._incoming.put(order_id)
+        await self._bus.publish(ModifiedFlag.PUT_BACK, (order_id,))
 
     async def by_order_id(self, order_id: int) -> Order | None:
         query = sqlmodel.select(Order).where(Order.order_id == order_id)
@@ -17,11 +17,15 @@ class OrderedItem(TableBase, table=True):
 
     id: int | None = sqlmodel.Field(default=None, primary_key=True)
     order_id: Annotated[
-        int, sqlmodel.Field(foreign_key=_colname(sqlmodel.col(Order.order_id)))
+        int,
+        sqlmodel.Field(foreign_key=_colname(sqlmodel.col(Order.order_id)), index=True),
     ]
     item_no: int
     product_id: Annotated[
-        int, sqlmodel.Field(foreign_key=_colname(sqlmodel.col(Product.product_id)))
+        int,
+        sqlmodel.Field(
+            foreign_key=_colname(sqlmodel.col(Product.product_id)), index=True
+        ),
     ]
     supplied_at: datetime | None = sqlmodel.Field(
         default=None, sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True))
@@ -29,16 +33,11 @@ class OrderedItem(TableBase, table=True):
 
 
 class Table:
-    _last_order_id: int | None
     _db: Database
 
     def __init__(self, database: Database):
         self._db = database
 
-    async def ainit(self) -> None:
-        query = sqlmodel.func.max(OrderedItem.order_id).select()
-        self._last_order_id = await self._db.fetch_val(query)
-
     async def select_all(self) -> list[OrderedItem]:
         query = sqlmodel.select(OrderedItem)
         return [OrderedItem.model_validate(m) async for m in self._db.iterate(query)]
@@ -48,21 +47,23 @@ class Table:
         query = sqlmodel.select(OrderedItem).where(clause)
         return [OrderedItem.model_validate(m) async for m in self._db.iterate(query)]
 
-    async def issue(self, product_ids: list[int]) -> int:
-        order_id = (self._last_order_id or 0) + 1
+    async def _issue(self, order_id: int, product_ids: list[int]) -> None:
+        """
+        Use `issue_order` to insert the order along with its items.
+        """
         await self._db.execute_many(
             sqlmodel.insert(OrderedItem).values(order_id=order_id),
             [{"item_no": i, "product_id": pid} for i, pid in enumerate(product_ids)],
         )
-        self._last_order_id = order_id
-        return order_id
 
-    async def _supply(self, order_id: int, product_id: int):
+    async def _supply(self, order_id: int, product_id: int) -> datetime:
         query = sqlmodel.update(OrderedItem).where(
             (col(OrderedItem.order_id) == order_id)
             & (col(OrderedItem.product_id) == product_id)
         )
-        await self._db.execute(query, {"supplied_at": datetime.now(timezone.utc)})
+        supplied_at = datetime.now(timezone.utc)
+        await self._db.execute(query, {"supplied_at": supplied_at})
+        return supplied_at
 
     async def _supply_all(self, order_id: int):
         """
@@ -76,4 +77,3 @@ class Table:
     # NOTE: this function needs authorization since it destroys all receipts
     # async def clear(self) -> None:
     #     await self._db.execute(sqlmodel.delete(OrderedItem))
-    #     self._last_order_id = None
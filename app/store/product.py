@@ -1,11 +1,17 @@
 import csv
-from typing import Annotated, Iterable
+from typing import TYPE_CHECKING, Annotated, Iterable
 
+import sqlalchemy
 import sqlmodel
 from databases import Database
 from sqlmodel import col
 
 from .base import TableBase
+from .order import ModifiedFlag
+
+if TYPE_CHECKING:
+    from .changes import LocalBus
+    from .incoming import Queue
 
 
 class Product(TableBase, table=True):
@@ -13,7 +19,7 @@ class Product(TableBase, table=True):
     __tablename__ = "products"  # pyright: ignore[reportAssignmentType]
 
     id: int | None = sqlmodel.Field(default=None, primary_key=True)
-    product_id: int
+    product_id: Annotated[int, sqlmodel.Field(unique=True, index=True)]
     name: Annotated[str, sqlmodel.Field(max_length=40)]
     filename: Annotated[str, sqlmodel.Field(max_length=100)]
     price: int
@@ -27,14 +33,76 @@ class Product(TableBase, table=True):
         return f"¥{price:,}"
 
 
-class Table:
+query_all: sqlalchemy.Select = sqlmodel.select(Product).order_by(
+    col(Product.product_id).asc()
+)
+
+
+class Catalog:
+    """
+    In-memory products indexed by product id.
+
+    The products change only when the staff edit them, so they are loaded once
+    and served from memory until a write through `Table` or a change made by
+    another process invalidates them. Every invalidation bumps `version`, which
+    tells whether anything derived from the products is still current.
+    """
+
+    _db: Database
+    version: int
+    _products: tuple[Product, ...]
+    _index: dict[int, Product]
+    _stale: bool
+
     def __init__(self, database: Database):
         self._db = database
+        self.version = 0
+        self._products = ()
+        self._index = {}
+        self._stale = True
 
     async def ainit(self) -> None:
-        if not await self._empty():
-            return
-        await self.renew_from_static_csv()
+        version = self.version
+        rows = await self._db.fetch_all(query_all)
+        products = tuple(Product.model_validate(row) for row in rows)
+        self._products = products
+        self._index = {product.product_id: product for product in products}
+        self._stale = self.version != version
+
+    def invalidate(self) -> None:
+        self.version += 1
+        self._stale = True
+
+    async def products(self) -> tuple[Product, ...]:
+        """Returns all the products ordered by product id."""
+        if self._stale:
+            await self.ainit()
+        return self._products
+
+    async def get(self, product_id: int) -> Product | None:
+        if self._stale:
+            await self.ainit()
+        return self._index.get(product_id)
+
+
+class Table:
+    def __init__(self, database: Database, incoming: "Queue", bus: "LocalBus"):
+        self._db = database
+        self._incoming = incoming
+        self._bus = bus
+        self.catalog = Catalog(database)
+
+    async def ainit(self) -> None:
+        if await self._empty():
+            await self.renew_from_static_csv()
+        await self.catalog.ainit()
+
+    async def _changed(self) -> None:
+        """Invalidates the catalog after a write has been committed."""
+        self.catalog.invalidate()
+        # Incoming orders carry the names and images of their products
+        await self._incoming.ainit()
+        await self._bus.publish(ModifiedFlag.CATALOG, ())
 
     # TODO: This function is defined temporally for convenience and should be removed in the future.
     async def renew_from_static_csv(self, csv_file: str = "static/product-list.csv"):
@@ -57,6 +125,7 @@ class Table:
         async with self._db.transaction():
             await self._db.execute(sqlmodel.delete(Product))
             await self._insert_many(products)
+        await self._changed()
 
     async def _empty(self) -> bool:
         return await self._db.fetch_one(sqlmodel.select(Product)) is None
@@ -66,19 +135,17 @@ class Table:
         await self._db.execute_many(query, [p.model_dump() for p in products])
 
     async def select_all(self) -> list[Product]:
-        query = sqlmodel.select(Product).order_by(col(Product.product_id).asc())
-        return [Product.model_validate(m) async for m in self._db.iterate(query)]
+        return list(await self.catalog.products())
 
     async def by_product_id(self, product_id: int) -> Product | None:
-        query = sqlmodel.select(Product).where(Product.product_id == product_id)
-        row = await self._db.fetch_one(query)
-        return Product.model_validate(row) if row else None
+        return await self.catalog.get(product_id)
 
     async def insert(self, product: Product) -> Product | None:
         query = sqlmodel.insert(Product).returning(sqlmodel.literal_column("*"))
         maybe_record = await self._db.fetch_one(query, product.model_dump())
         if (record := maybe_record) is None:
             return None
+        await self._changed()
         return Product.model_validate(dict(record._mapping))
 
     async def update(self, product_id: int, new_product: Product) -> Product | None:
@@ -102,4 +169,5 @@ class Table:
         maybe_record = await self._db.fetch_one(query)
         if (record := maybe_record) is None:
             return None
+        await self._changed()
         return Product.model_validate(dict(record._mapping))
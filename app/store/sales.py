@@ -0,0 +1,171 @@
+from collections import Counter
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Iterable
+
+import sqlalchemy
+import sqlmodel
+from databases import Database
+from sqlmodel import col
+
+from ._helper import unixepoch
+from .order import Order
+from .ordered_item import OrderedItem
+
+_local_date = sqlmodel.func.date(col(Order.ordered_at), "localtime")
+
+query_daily_sales: sqlalchemy.Select = (
+    sqlmodel.select(col(OrderedItem.product_id), _local_date.label("date"))
+    .select_from(sqlmodel.join(OrderedItem, Order))
+    .add_columns(sqlmodel.func.count(col(OrderedItem.product_id)).label("count"))
+    .add_columns(col(Order.order_id))
+    .where(col(Order.canceled_at).is_(None))
+    .group_by(col(Order.order_id), col(OrderedItem.product_id))
+)
+
+query_order_sales: sqlalchemy.Select = (
+    sqlmodel.select(col(OrderedItem.product_id))
+    .select_from(sqlmodel.join(OrderedItem, Order))
+    .add_columns(sqlmodel.func.count(col(OrderedItem.product_id)).label("count"))
+    .add_columns(unixepoch(col(Order.ordered_at)))
+    .add_columns(col(Order.canceled_at).isnot(None).label("canceled"))
+    .group_by(col(OrderedItem.product_id))
+)
+
+
+@dataclass(frozen=True, slots=True)
+class OrderSales:
+    """The items of an order as counted in the rollup."""
+
+    order_id: int
+    date: date
+    counts: Counter[int]
+    canceled: bool
+
+
+@dataclass(frozen=True, slots=True)
+class ProductSales:
+    product_id: int
+    count: int
+    count_today: int
+
+
+class Rollup:
+    """
+    In-memory counts of the items sold per product and per local date, which
+    exclude canceled orders like the sales shown on the statistics page.
+
+    The counts are built from the database on startup and updated as orders
+    are issued, canceled and put back. Prices are applied on reads so that the
+    rollup stays valid across product updates. The ids of the counted orders
+    are kept as well, so that an order changed by another process is recounted
+    by comparing its state in the database with them. Rebuilds and recounts
+    read from `reader` so that they never hold up writes on `database`.
+    """
+
+    _db: Database
+    _reader: Database
+    _totals: Counter[int]
+    _daily: dict[date, Counter[int]]
+    _counted: set[int]
+    """The ids of the orders included in the counts, i.e. not canceled."""
+    _stale: bool
+    _generation: int
+    """Bumped on every change so that a rebuild can tell if it has missed any."""
+
+    def __init__(self, database: Database, reader: Database | None = None):
+        self._db = database
+        self._reader = database if reader is None else reader
+        self._totals = Counter()
+        self._daily = {}
+        self._counted = set()
+        self._stale = True
+        self._generation = 0
+
+    async def ainit(self) -> None:
+        generation = self._generation
+        totals: Counter[int] = Counter()
+        daily: dict[date, Counter[int]] = {}
+        counted: set[int] = set()
+        async for row in self._reader.iterate(query_daily_sales):
+            product_id, count = row["product_id"], row["count"]
+            totals[product_id] += count
+            daily.setdefault(date.fromisoformat(row["date"]), Counter())[
+                product_id
+            ] += count
+            counted.add(row["order_id"])
+        self._totals, self._daily, self._counted = totals, daily, counted
+        self._stale = self._generation != generation
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._stale = True
+
+    async def sales(self, today: date | None = None) -> list[ProductSales]:
+        """Returns the sales of the products sold at least once by product id."""
+        if self._stale:
+            await self.ainit()
+        counts_today = self._daily.get(today or date.today(), Counter())
+        return [
+            ProductSales(product_id, count, counts_today[product_id])
+            for product_id, count in sorted(self._totals.items())
+            if count > 0
+        ]
+
+    def issue(
+        self, order_id: int, ordered_at: datetime, product_ids: Iterable[int]
+    ) -> None:
+        day = ordered_at.astimezone().date()
+        self._count(OrderSales(order_id, day, Counter(product_ids), False), True)
+
+    async def of_order(self, order_id: int) -> OrderSales | None:
+        """
+        Fetches the items of an order before its cancellation state changes.
+        Call this in the same transaction as the change.
+        """
+        return await self._fetch(self._db, order_id)
+
+    def update(self, sales: OrderSales | None, canceled: bool) -> None:
+        """Applies the new cancellation state of an order fetched by `of_order`."""
+        if sales is not None:
+            self._count(sales, not canceled)
+
+    async def refresh(self, order_id: int) -> None:
+        """Applies the current state of an order changed by another process."""
+        if self._stale:
+            # Make sure a rebuild in progress doesn't miss the change
+            self.invalidate()
+            return
+        if (sales := await self._fetch(self._reader, order_id)) is not None:
+            self._count(sales, not sales.canceled)
+        elif order_id in self._counted:
+            # The items counted for the order are no longer known
+            self.invalidate()
+
+    async def _fetch(self, database: Database, order_id: int) -> OrderSales | None:
+        query = query_order_sales.where(col(Order.order_id) == order_id)
+        rows = await database.fetch_all(query)
+        if not rows:
+            return None
+        return OrderSales(
+            order_id=order_id,
+            date=datetime.fromtimestamp(rows[0]["ordered_at"]).date(),
+            counts=Counter({row["product_id"]: row["count"] for row in rows}),
+            canceled=bool(rows[0]["canceled"]),
+        )
+
+    def _count(self, sales: OrderSales, counted: bool) -> None:
+        """Adds or subtracts the items of an order unless already done."""
+        # Tell a rebuild in progress that it may have missed the change
+        self._generation += 1
+        if (sales.order_id in self._counted) == counted:
+            return
+        if counted:
+            self._counted.add(sales.order_id)
+        else:
+            self._counted.discard(sales.order_id)
+        sign = 1 if counted else -1
+        daily = self._daily.setdefault(sales.date, Counter())
+        for product_id, count in sales.counts.items():
+            self._totals[product_id] += sign * count
+            daily[product_id] += sign * count
@@ -0,0 +1,175 @@
+import bisect
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import sqlalchemy
+import sqlmodel
+from databases import Database
+from sqlmodel import col
+
+from ._helper import unixepoch
+from .order import Order
+
+query_completed: sqlalchemy.Select = (
+    sqlmodel.select(col(Order.order_id))
+    .add_columns(unixepoch(col(Order.ordered_at)), unixepoch(col(Order.completed_at)))
+    .where(col(Order.completed_at).isnot(None))
+    .order_by(col(Order.completed_at).asc())
+)
+
+
+@dataclass(frozen=True, slots=True)
+class Recent:
+    """Durations of the orders completed within the window, in seconds."""
+
+    count: int
+    mean: float
+    p50: int
+    p90: int
+    interval: float
+    """The average time between completions, or how fast the queue drains."""
+
+    def estimate(self, waiting: int) -> float:
+        """
+        Estimates how long an order placed now waits, given the number of the
+        orders waiting ahead of it. The queue is assumed to drain at the recent
+        pace, but an order is not expected to take less than usual.
+        """
+        if self.count == 0:
+            return 0
+        return max(self.p50, waiting * self.interval)
+
+
+class ServiceTimes:
+    """
+    In-memory durations from ordering to completion of the completed orders.
+
+    The average over all the orders is kept as a running sum. The orders
+    completed within the last `window` seconds are kept in completion order,
+    from which the oldest are dropped as time passes, along with their
+    durations in sorted order for percentiles. Either is read without scanning
+    the orders. Cancelling or putting back a completed order discards its
+    duration. Like `Rollup`, an order changed by another process is refreshed
+    from the database on its own. The database is only read, so pass the
+    read-only `reader` to keep reloads from holding up writes.
+    """
+
+    _db: Database
+    window: float
+    _all: dict[int, int]
+    _all_sum: int
+    _recent: OrderedDict[int, tuple[int, int]]
+    """Completion time and duration by order id, oldest completion first."""
+    _recent_sum: int
+    _recent_sorted: list[int]
+    _stale: bool
+    _generation: int
+
+    def __init__(self, database: Database, window: float = 30 * 60):
+        self._db = database
+        self.window = window
+        self._reset()
+        self._stale = True
+        self._generation = 0
+
+    def _reset(self) -> None:
+        self._all, self._all_sum = {}, 0
+        self._recent, self._recent_sum, self._recent_sorted = OrderedDict(), 0, []
+
+    async def ainit(self) -> None:
+        generation = self._generation
+        rows = await self._db.fetch_all(query_completed)
+        self._reset()
+        since = time.time() - self.window
+        for row in rows:
+            completed_at = row["completed_at"]
+            recent = completed_at > since
+            self._add(row["order_id"], row["ordered_at"], completed_at, recent)
+        self._stale = self._generation != generation
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._stale = True
+
+    async def average(self) -> float:
+        """Returns the average duration of all the completed orders in seconds."""
+        if self._stale:
+            await self.ainit()
+        return self._all_sum / len(self._all) if self._all else 0
+
+    async def recent(self, now: float | None = None) -> Recent:
+        if self._stale:
+            await self.ainit()
+        now = time.time() if now is None else now
+        self._expire(now)
+        if not (count := len(self._recent)):
+            return Recent(count=0, mean=0, p50=0, p90=0, interval=0)
+        first_completed_at, _ = next(iter(self._recent.values()))
+        last_completed_at, _ = next(reversed(self._recent.values()))
+        return Recent(
+            count=count,
+            mean=self._recent_sum / count,
+            p50=self._percentile(0.5),
+            p90=self._percentile(0.9),
+            interval=(last_completed_at - first_completed_at) / max(count - 1, 1),
+        )
+
+    def complete(self, order_id: int, ordered_at: int, completed_at: int) -> None:
+        self._generation += 1
+        self.discard(order_id)
+        self._add(order_id, ordered_at, completed_at)
+
+    async def refresh(self, order_id: int) -> None:
+        """Applies the current state of an order changed by another process."""
+        if self._stale:
+            # Make sure a reload in progress doesn't miss the change
+            self.invalidate()
+            return
+        query = query_completed.where(col(Order.order_id) == order_id)
+        row = await self._db.fetch_one(query)
+        self._generation += 1
+        self.discard(order_id)
+        if row is not None:
+            completed_at = row["completed_at"]
+            recent = completed_at > time.time() - self.window
+            self._add(order_id, row["ordered_at"], completed_at, recent)
+
+    def discard(self, order_id: int) -> None:
+        """Forgets the duration of an order that is no longer completed."""
+        if (duration := self._all.pop(order_id, None)) is None:
+            return
+        self._generation += 1
+        self._all_sum -= duration
+        if (recent := self._recent.pop(order_id, None)) is not None:
+            self._forget_recent(recent[1])
+
+    def _add(
+        self, order_id: int, ordered_at: int, completed_at: int, recent: bool = True
+    ) -> None:
+        duration = completed_at - ordered_at
+        self._all[order_id] = duration
+        self._all_sum += duration
+        if not recent:
+            return
+        self._recent[order_id] = (completed_at, duration)
+        self._recent_sum += duration
+        bisect.insort(self._recent_sorted, duration)
+
+    def _expire(self, now: float) -> None:
+        while self._recent:
+            order_id, (completed_at, duration) = next(iter(self._recent.items()))
+            if now - completed_at < self.window:
+                break
+            del self._recent[order_id]
+            self._forget_recent(duration)
+
+    def _forget_recent(self, duration: int) -> None:
+        self._recent_sum -= duration
+        del self._recent_sorted[bisect.bisect_left(self._recent_sorted, duration)]
+
+    def _percentile(self, q: float) -> int:
+        # The nearest-rank method, which always picks an actual duration
+        rank = math.ceil(q * len(self._recent_sorted))
+        return self._recent_sorted[max(rank, 1) - 1]
@@ -0,0 +1,574 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from typing import Callable, Iterable
+from uuid import UUID, uuid4
+
+import sqlmodel
+from databases import Database
+from sqlmodel import col
+
+from .base import TableBase
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class OrderSession:
+    """
+    The items picked at a register, kept as counts per product id in the order
+    the products were first picked. Names and prices are looked up from the
+    catalog when the session is shown.
+    """
+
+    counts: dict[int, int] = field(default_factory=dict)
+    total_count: int = 0
+    rev: int = 0
+    """Bumped on every change so that stores can tell which sessions to save."""
+
+    def add(self, product_id: int, quantity: int = 1) -> None:
+        if quantity <= 0:
+            return
+        self.counts[product_id] = self.counts.get(product_id, 0) + quantity
+        self.total_count += quantity
+        self.rev += 1
+
+    def delete(self, product_id: int, quantity: int = 1) -> None:
+        """Deletes up to `quantity` items of the product."""
+        if quantity <= 0 or (count := self.counts.get(product_id)) is None:
+            return
+        if count <= quantity:
+            del self.counts[product_id]
+            self.total_count -= count
+        else:
+            self.counts[product_id] = count - quantity
+            self.total_count -= quantity
+        self.rev += 1
+
+    def apply(self, deltas: Iterable[tuple[int, int]]) -> None:
+        """Adds or, if negative, deletes the quantities of the products."""
+        for product_id, quantity in deltas:
+            if quantity > 0:
+                self.add(product_id, quantity)
+            else:
+                self.delete(product_id, -quantity)
+
+    def clear(self) -> None:
+        self.counts.clear()
+        self.total_count = 0
+        self.rev += 1
+
+    def replace(self, counts: dict[int, int]) -> None:
+        """Takes the counts merged with those of other processes."""
+        self.counts = counts
+        self.total_count = sum(counts.values())
+
+
+def merge(remote: dict[int, int], base: dict[int, int], local: dict[int, int]):
+    """
+    Applies the changes made from `base` to `local` on top of `remote`, which
+    is `base` as changed by others in the meantime.
+    """
+    merged = dict(remote)
+    for product_id in base.keys() | local.keys():
+        delta = local.get(product_id, 0) - base.get(product_id, 0)
+        if delta == 0:
+            continue
+        if (count := merged.get(product_id, 0) + delta) > 0:
+            merged[product_id] = count
+        else:
+            merged.pop(product_id, None)
+    return merged
+
+
+def _dump_counts(counts: dict[int, int]) -> str:
+    return ",".join(f"{product_id}:{count}" for product_id, count in counts.items())
+
+
+def _load_counts(dump: str) -> dict[int, int]:
+    counts: dict[int, int] = {}
+    for pair in filter(None, dump.split(",")):
+        product_id, count = pair.split(":")
+        counts[int(product_id)] = int(count)
+    return counts
+
+
+@dataclass(frozen=True, slots=True)
+class Metrics:
+    sessions: int
+    """The number of the sessions held in memory."""
+    items: int
+    """The number of items picked in the sessions held in memory."""
+    bytes: int
+    """The estimated memory held by the sessions and their keys."""
+    deferred: int
+    created: int
+    expired: int
+    """The number of sessions evicted for being left untouched for `ttl`."""
+    evicted: int
+    """The number of the least recently used sessions evicted for `maxsize`."""
+
+
+class Store:
+    """
+    In-memory order sessions bounded in both age and number.
+
+    Sessions are kept from the least to the most recently used, so sessions
+    left untouched for `ttl` seconds, such as those of closed tabs or lost
+    cookies, are dropped from the front as others are accessed. Once there are
+    `maxsize` sessions, creating another evicts the least recently used one.
+
+    Deferred sessions are set aside until they are resumed, and are neither
+    expired nor evicted.
+    """
+
+    ttl: float
+    maxsize: int
+    _sessions: OrderedDict[UUID, tuple[float, OrderSession]]
+    """Sessions with the time of their last access, least recently used first."""
+    _deferred: OrderedDict[UUID, OrderSession]
+    _clock: Callable[[], float]
+
+    def __init__(
+        self,
+        ttl: float,
+        maxsize: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._sessions = OrderedDict()
+        self._deferred = OrderedDict()
+        self._clock = clock
+        self._created = self._expired = self._evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def create(self) -> UUID:
+        key = uuid4()
+        self._put(key, OrderSession())
+        self._created += 1
+        return key
+
+    async def get(self, key: UUID) -> OrderSession | None:
+        now = self._clock()
+        self._expire(now)
+        if (entry := self._sessions.get(key)) is None:
+            return None
+        self._sessions[key] = (now, entry[1])
+        self._sessions.move_to_end(key)
+        return entry[1]
+
+    async def pop(self, key: UUID) -> OrderSession | None:
+        """Removes a session to place its order."""
+        entry = self._sessions.pop(key, None)
+        return None if entry is None else entry[1]
+
+    async def defer(self, key: UUID) -> bool:
+        if (entry := self._sessions.pop(key, None)) is None:
+            return False
+        self._deferred[key] = entry[1]
+        return True
+
+    async def deferred(self) -> list[tuple[UUID, OrderSession]]:
+        """Returns the deferred sessions, the earliest deferred first."""
+        return list(self._deferred.items())
+
+    async def resume(self, key: UUID) -> OrderSession | None:
+        if (session := self._deferred.pop(key, None)) is None:
+            return None
+        self._put(key, session)
+        return session
+
+    async def metrics(self) -> Metrics:
+        self._expire(self._clock())
+        items, size = 0, sys.getsizeof(self._sessions)
+        for key, (_, session) in self._sessions.items():
+            items += session.total_count
+            size += sys.getsizeof(key) + sys.getsizeof(key.int)
+            size += sys.getsizeof(session) + sys.getsizeof(session.counts)
+        return Metrics(
+            sessions=len(self._sessions),
+            items=items,
+            bytes=size,
+            deferred=len(self._deferred),
+            created=self._created,
+            expired=self._expired,
+            evicted=self._evicted,
+        )
+
+    def _put(self, key: UUID, session: OrderSession) -> None:
+        now = self._clock()
+        self._expire(now)
+        while len(self._sessions) >= self.maxsize:
+            self._drop()
+            self._evicted += 1
+        self._sessions[key] = (now, session)
+
+    def _expire(self, now: float) -> None:
+        while self._sessions:
+            accessed_at, _ = next(iter(self._sessions.values()))
+            if now - accessed_at < self.ttl:
+                break
+            self._drop()
+            self._expired += 1
+
+    def _drop(self) -> None:
+        """Drops the least recently used session from memory."""
+        self._sessions.popitem(last=False)
+
+
+class SessionRow(TableBase, table=True):
+    # NOTE: there are no Pydantic ways to set the generated table's name, as per https://github.com/fastapi/sqlmodel/issues/159
+    __tablename__ = "order_sessions"  # pyright: ignore[reportAssignmentType]
+
+    key: str = sqlmodel.Field(primary_key=True)
+    counts: str
+    """Comma-separated pairs of a product id and its count joined by a colon."""
+    rev: int
+    """Bumped on every write, against which writes are checked for conflicts."""
+    seq: int = sqlmodel.Field(index=True)
+    """
+    Increases with every write, including each row of a batch, so that other
+    processes can poll the rows written since they last looked.
+    """
+    origin: int
+    """The id of the process that wrote the row last."""
+    modified_at: float
+    """When the session was last modified or read by any process."""
+    deferred_at: float | None = None
+
+
+@dataclass(slots=True)
+class _Synced:
+    """The state of a session as last read from or written to the database."""
+
+    rev: int
+    counts: dict[int, int]
+    local_rev: int
+    """The `OrderSession.rev` that `counts` corresponds to."""
+
+
+class SQLiteStore(Store):
+    """
+    Order sessions shared by every process through the database.
+
+    Sessions are served from memory as in `Store` and picking items never
+    waits for the database. Modified sessions are written in a batch every
+    `interval` seconds instead. Each row carries a revision, and when another
+    process has written a session since it was read, the local changes are
+    merged into the other's rather than overwriting them. Rows written by
+    others are polled at the same time so that the copies in memory are read
+    again on their next access.
+
+    Creating, placing, deferring and resuming sessions are written at once, so
+    a session is visible to other processes as soon as its cookie is issued
+    and an order is placed from one process only. Reading a session marks it
+    as touched, which is written along with the modified ones. Rows left
+    untouched for `ttl` seconds are deleted unless deferred, and survive
+    restarts otherwise. Polling only reads, so pass the read-only `reader` to
+    keep it from queuing behind writes on `database`.
+    """
+
+    PRUNE_EVERY = 600
+    """Expired rows are deleted once in this many syncs."""
+
+    _db: Database
+    _reader: Database
+    _interval: float
+    _origin: int
+    _synced: dict[UUID, _Synced]
+    _dropped: dict[UUID, OrderSession]
+    """Sessions dropped from memory before their changes are written."""
+    _touched: set[UUID]
+    """Sessions read since the last flush, whose rows are to be kept alive."""
+    _last_seq: int
+    _syncs: int
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        database: Database,
+        ttl: float,
+        maxsize: int,
+        interval: float,
+        reader: Database | None = None,
+        origin: int | None = None,
+    ):
+        super().__init__(ttl, maxsize)
+        self._db = database
+        self._reader = database if reader is None else reader
+        self._interval = interval
+        self._origin = os.getpid() if origin is None else origin
+        self._synced = {}
+        self._dropped = {}
+        self._touched = set()
+        self._last_seq = 0
+        self._syncs = 0
+        self._task = None
+
+    async def start(self) -> None:
+        query = sqlmodel.select(sqlmodel.func.max(col(SessionRow.seq)))
+        self._last_seq = await self._reader.fetch_val(query) or 0
+        self._task = asyncio.create_task(self._sync_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def create(self) -> UUID:
+        key = uuid4()
+        query = sqlmodel.insert(SessionRow).values(
+            key=str(key), rev=0, **self._written({})
+        )
+        await self._db.execute(query)
+        self._put(key, OrderSession())
+        self._synced[key] = _Synced(0, {}, 0)
+        self._created += 1
+        return key
+
+    async def get(self, key: UUID) -> OrderSession | None:
+        if (session := self._dropped.pop(key, None)) is not None:
+            self._put(key, session)
+        if (session := await super().get(key)) is not None:
+            self._touched.add(key)
+            return session
+        query = sqlmodel.select(SessionRow).where(
+            (col(SessionRow.key) == str(key)) & col(SessionRow.deferred_at).is_(None)
+        )
+        if (row := await self._db.fetch_one(query)) is None:
+            return None
+        self._touched.add(key)
+        return self._load(key, row["rev"], _load_counts(row["counts"]))
+
+    async def pop(self, key: UUID) -> OrderSession | None:
+        query = (
+            sqlmodel.delete(SessionRow)
+            .where(col(SessionRow.key) == str(key))
+            .where(col(SessionRow.deferred_at).is_(None))
+            .returning(col(SessionRow.counts))
+        )
+        row = await self._db.fetch_one(query)
+        session = await super().pop(key) or self._dropped.pop(key, None)
+        synced = self._synced.pop(key, None)
+        if row is None:
+            # Placed or deferred by another process already
+            return None
+        remote = _load_counts(row["counts"])
+        if session is None or synced is None:
+            return OrderSession(remote, sum(remote.values()))
+        session.replace(merge(remote, synced.counts, session.counts))
+        return session
+
+    async def defer(self, key: UUID) -> bool:
+        """
+        Defers a session, or returns False if its changes couldn't be written
+        as another process is writing it at the same time.
+        """
+        await self.flush()
+        if self._unwritten(key):
+            return False
+        query = (
+            sqlmodel.update(SessionRow)
+            .where(col(SessionRow.key) == str(key))
+            .where(col(SessionRow.deferred_at).is_(None))
+            .values(deferred_at=time.time(), seq=self._next_seq, origin=self._origin)
+            .returning(col(SessionRow.key))
+        )
+        deferred = await self._db.fetch_val(query) is not None
+        self._sessions.pop(key, None)
+        self._dropped.pop(key, None)
+        self._synced.pop(key, None)
+        return deferred
+
+    async def deferred(self) -> list[tuple[UUID, OrderSession]]:
+        query = (
+            sqlmodel.select(col(SessionRow.key), col(SessionRow.counts))
+            .where(col(SessionRow.deferred_at).isnot(None))
+            .order_by(col(SessionRow.deferred_at).asc())
+        )
+        sessions: list[tuple[UUID, OrderSession]] = []
+        for row in await self._db.fetch_all(query):
+            counts = _load_counts(row["counts"])
+            session = OrderSession(counts, sum(counts.values()))
+            sessions.append((UUID(row["key"]), session))
+        return sessions
+
+    async def resume(self, key: UUID) -> OrderSession | None:
+        query = (
+            sqlmodel.update(SessionRow)
+            .where(col(SessionRow.key) == str(key))
+            .where(col(SessionRow.deferred_at).isnot(None))
+            .values(deferred_at=None, modified_at=time.time())
+            .values(seq=self._next_seq, origin=self._origin)
+            .returning(col(SessionRow.rev), col(SessionRow.counts))
+        )
+        if (row := await self._db.fetch_one(query)) is None:
+            return None
+        return self._load(key, row["rev"], _load_counts(row["counts"]))
+
+    async def metrics(self) -> Metrics:
+        metrics = await super().metrics()
+        # Deferred sessions are kept in the database only
+        query = sqlmodel.select(sqlmodel.func.count()).where(
+            col(SessionRow.deferred_at).isnot(None)
+        )
+        return replace(metrics, deferred=await self._db.fetch_val(query))
+
+    async def flush(self) -> None:
+        """Writes the sessions modified since they were last written."""
+        await self._touch()
+        dirty: dict[UUID, tuple[OrderSession, int, dict[int, int]]] = {}
+        sessions = [(key, session) for key, (_, session) in self._sessions.items()]
+        for key, session in [*sessions, *self._dropped.items()]:
+            if self._unwritten(key, session):
+                dirty[key] = (session, session.rev, dict(session.counts))
+        if not dirty:
+            return
+
+        query = sqlmodel.select(
+            col(SessionRow.key), col(SessionRow.rev), col(SessionRow.counts)
+        ).where(col(SessionRow.key).in_([str(key) for key in dirty]))
+        remote = {UUID(row["key"]): row for row in await self._db.fetch_all(query)}
+
+        written: dict[UUID, _Synced | None] = {}
+        async with self._db.transaction():
+            for key, (_, local_rev, counts) in dirty.items():
+                if (row := remote.get(key)) is None:
+                    # Placed or deferred by another process
+                    written[key] = None
+                    continue
+                if (synced := self._synced.get(key)) is None:
+                    # Placed or deferred by this process while writing
+                    continue
+                if row["rev"] != synced.rev:
+                    counts = merge(_load_counts(row["counts"]), synced.counts, counts)
+                query = (
+                    sqlmodel.update(SessionRow)
+                    .where(col(SessionRow.key) == str(key))
+                    .where(col(SessionRow.rev) == row["rev"])
+                    .values(rev=row["rev"] + 1, **self._written(counts))
+                    .returning(col(SessionRow.rev))
+                )
+                # Written again by another process since read, retried next time
+                if (rev := await self._db.fetch_val(query)) is not None:
+                    written[key] = _Synced(rev, counts, local_rev)
+
+        for key, synced in written.items():
+            session, _, counts = dirty[key]
+            self._dropped.pop(key, None)
+            if synced is None:
+                self._sessions.pop(key, None)
+                self._synced.pop(key, None)
+                continue
+            if (entry := self._sessions.get(key)) is None or entry[1] is not session:
+                # No longer held, or placed or deferred while writing
+                if entry is None:
+                    self._synced.pop(key, None)
+                continue
+            if synced.counts != counts:
+                # Keep the changes made while writing on top of the merged ones
+                session.replace(merge(synced.counts, counts, session.counts))
+            self._synced[key] = synced
+
+    async def poll(self) -> None:
+        """Forgets the sessions in memory that other processes have written."""
+        query = (
+            sqlmodel.select(col(SessionRow.key), col(SessionRow.seq))
+            .where(col(SessionRow.seq) > self._last_seq)
+            .where(col(SessionRow.origin) != self._origin)
+        )
+        for row in await self._reader.fetch_all(query):
+            self._last_seq = max(self._last_seq, row["seq"])
+            key = UUID(row["key"])
+            if (entry := self._sessions.get(key)) is None:
+                continue
+            synced = self._synced.get(key)
+            # Unwritten changes are merged on the next flush instead
+            if synced is None or synced.local_rev == entry[1].rev:
+                self._sessions.pop(key)
+                self._synced.pop(key, None)
+
+    def _unwritten(self, key: UUID, session: OrderSession | None = None) -> bool:
+        """Tells if the session has changes yet to be written."""
+        if session is None:
+            entry = self._sessions.get(key)
+            session = entry[1] if entry is not None else self._dropped.get(key)
+        synced = self._synced.get(key)
+        return (
+            session is not None
+            and synced is not None
+            and synced.local_rev != session.rev
+        )
+
+    def _load(self, key: UUID, rev: int, counts: dict[int, int]) -> OrderSession:
+        session = OrderSession(dict(counts), sum(counts.values()))
+        self._put(key, session)
+        self._synced[key] = _Synced(rev, counts, session.rev)
+        return session
+
+    def _drop(self) -> None:
+        key, (_, session) = self._sessions.popitem(last=False)
+        if self._unwritten(key, session):
+            self._dropped[key] = session
+        else:
+            self._synced.pop(key, None)
+
+    @property
+    def _next_seq(self):
+        # Evaluated in the statement so that concurrent writers never share one
+        max_seq = sqlmodel.func.max(col(SessionRow.seq))
+        return sqlmodel.select(sqlmodel.func.coalesce(max_seq, 0) + 1).scalar_subquery()
+
+    def _written(self, counts: dict[int, int]) -> dict:
+        return {
+            "counts": _dump_counts(counts),
+            "seq": self._next_seq,
+            "origin": self._origin,
+            "modified_at": time.time(),
+        }
+
+    async def _touch(self) -> None:
+        if not self._touched:
+            return
+        keys, self._touched = [str(key) for key in self._touched], set()
+        # Not a modification, so leave `seq` for others to keep their copies
+        query = (
+            sqlmodel.update(SessionRow)
+            .where(col(SessionRow.key).in_(keys))
+            .values(modified_at=time.time())
+        )
+        await self._db.execute(query)
+
+    async def _prune(self) -> None:
+        expired = col(SessionRow.modified_at) < time.time() - self.ttl
+        clause = expired & col(SessionRow.deferred_at).is_(None)
+        # Sessions in memory may have been read after the last touch was written
+        held = [str(key) for key in (*self._sessions, *self._dropped)]
+        clause &= col(SessionRow.key).not_in(held)
+        await self._db.execute(sqlmodel.delete(SessionRow).where(clause))
+
+    async def _sync_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.flush()
+                await self.poll()
+                self._syncs += 1
+                if self._syncs % self.PRUNE_EVERY == 0:
+                    await self._prune()
+            except Exception:
+                logger.exception("Failed to sync order sessions")
@@ -0,0 +1,82 @@
+import asyncio
+
+from inline_snapshot import snapshot
+
+from ..conftest import Connect
+from .changes import Entry, Feed, SQLiteBus
+from .order import ModifiedFlag
+
+
+def test_feed_cursor_catches_up_on_missed_changes():
+    async def run():
+        feed = Feed(maxlen=2)
+        cursor = feed.cursor()
+
+        waiter = asyncio.create_task(cursor.next())
+        await asyncio.sleep(0)
+        feed.append(ModifiedFlag.INCOMING, (1,))
+        first = await waiter
+
+        # Made while the consumer is busy with the previous change
+        feed.append(ModifiedFlag.SUPPLIED, (1,))
+        feed.append(ModifiedFlag.PUT_BACK, (2,))
+        missed = await cursor.next()
+
+        stale = feed.since(0)
+        for _ in range(3):
+            feed.append(ModifiedFlag.RESOLVED, (3,))
+        overflowed = await cursor.next()
+        return first, missed, stale, overflowed, cursor.seq
+
+    assert asyncio.run(run()) == snapshot(
+        (
+            ModifiedFlag.INCOMING,
+            ModifiedFlag.SUPPLIED | ModifiedFlag.PUT_BACK,
+            None,
+            ModifiedFlag.ORIGINAL,
+            6,
+        )
+    )
+
+
+def test_sqlite_bus_applies_changes_from_other_processes(connect: Connect):
+    async def run():
+        database, reader = await connect(), await connect()
+
+        this, other = Feed(), Feed()
+        # Polls through a connection of its own, as with the reader pool
+        this_bus = SQLiteBus(this, database, 60, reader, origin=1)
+        other_bus = SQLiteBus(other, database, 60, origin=2)
+        applied: list[tuple[ModifiedFlag, tuple[int, ...] | None]] = []
+
+        async def on_remote(flag: ModifiedFlag, order_ids: tuple[int, ...] | None):
+            applied.append((flag, order_ids))
+
+        await other_bus.publish(ModifiedFlag.INCOMING, (1,))
+        await this_bus.start(on_remote)
+        await this_bus.publish(ModifiedFlag.INCOMING, (2,))
+        await other_bus.publish(ModifiedFlag.SUPPLIED, (3, 4))
+        await other_bus.publish(ModifiedFlag.ORIGINAL, None)
+        await other_bus.publish(ModifiedFlag.CATALOG, ())
+        await this_bus.poll(on_remote)
+
+        await this_bus.stop()
+        await reader.disconnect()
+        await database.disconnect()
+        return applied, this.since(0)
+
+    assert asyncio.run(run()) == snapshot(
+        (
+            [
+                (ModifiedFlag.SUPPLIED, (3, 4)),
+                (ModifiedFlag.ORIGINAL, None),
+                (ModifiedFlag.CATALOG, ()),
+            ],
+            (
+                Entry(seq=1, flag=ModifiedFlag.INCOMING, order_ids=(2,)),
+                Entry(seq=2, flag=ModifiedFlag.SUPPLIED, order_ids=(3, 4)),
+                Entry(seq=3, flag=ModifiedFlag.ORIGINAL, order_ids=None),
+                Entry(seq=4, flag=ModifiedFlag.CATALOG, order_ids=()),
+            ),
+        )
+    )
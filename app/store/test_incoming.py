@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime
+
+import sqlparse
+from inline_snapshot import snapshot
+
+from .incoming import IncomingItem, IncomingOrder, Queue, query_incoming
+
+
+def format_sql(sql: object):
+    return sqlparse.format(sql, keyword_case="upper", reindent=True, wrap_after=80)
+
+
+def test_incoming_orders_query():
+    assert format_sql(str(query_incoming)) == snapshot("""\
+SELECT orders.order_id, unixepoch(orders.ordered_at) AS ordered_at, ordered_items.product_id,
+       unixepoch(ordered_items.supplied_at) AS supplied_at, count(ordered_items.product_id) AS COUNT, products.name, products.filename
+FROM orders
+JOIN ordered_items ON orders.order_id = ordered_items.order_id
+JOIN products ON products.product_id = ordered_items.product_id
+WHERE orders.canceled_at IS NULL
+  AND orders.completed_at IS NULL
+GROUP BY orders.order_id, ordered_items.product_id
+ORDER BY orders.order_id ASC, ordered_items.product_id ASC\
+""")
+
+
+class _Rows:
+    """Stands in for `databases.Database`, serving rows for `Queue.put`."""
+
+    def __init__(self, rows: dict[int, list[dict]]):
+        self.rows = rows
+
+    async def iterate(self, query):
+        order_id = query.compile().params.get("order_id_1")
+        for row in self.rows.get(order_id, []):
+            yield row
+
+
+def _row(order_id: int, product_id: int, count: int = 1) -> dict:
+    return {
+        "order_id": order_id,
+        "ordered_at": 0,
+        "product_id": product_id,
+        "supplied_at": None,
+        "count": count,
+        "name": f"p{product_id}",
+        "filename": f"p{product_id}.png",
+    }
+
+
+def _ids(queue: Queue) -> list[tuple[int, int]]:
+    return [(order.order_id, order.version) for order in queue.orders()]
+
+
+def test_queue_applies_deltas_in_order():
+    rows = {1: [_row(1, 1, 2), _row(1, 2)], 2: [_row(2, 1)], 3: [_row(3, 3)]}
+    queue = Queue(_Rows(rows))  # pyright: ignore[reportArgumentType]
+
+    async def run():
+        for order_id in (2, 3):
+            await queue.put(order_id)
+        # An order put back is sorted among the others
+        await queue.put(1)
+
+    asyncio.run(run())
+    assert _ids(queue) == snapshot([(1, 3), (2, 1), (3, 2)])
+
+    snapshot_before = queue.orders()
+    queue.supply(1, 2, datetime.fromtimestamp(60))
+    assert queue.orders()[0] == snapshot(
+        IncomingOrder(
+            order_id=1,
+            ordered_at=0,
+            items=(
+                IncomingItem(
+                    product_id=1,
+                    name="p1",
+                    filename="p1.png",
+                    count=2,
+                    supplied_at=None,
+                ),
+                IncomingItem(
+                    product_id=2,
+                    name="p2",
+                    filename="p2.png",
+                    count=1,
+                    supplied_at=60,
+                ),
+            ),
+            version=4,
+        )
+    )
+    assert snapshot_before[0].version == 3
+
+    queue.remove(2)
+    queue.remove(2)
+    assert _ids(queue) == snapshot([(1, 4), (3, 2)])
+    assert queue.version == snapshot(5)
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+from databases import Database
+from inline_snapshot import snapshot
+
+from .. import store
+from ..conftest import Connect
+from . import incoming, order, ordered_item, sales, service_time
+from .changes import Feed, LocalBus
+
+
+def test_issue_order_writes_the_order_and_its_items_together(
+    connect: Connect, monkeypatch: pytest.MonkeyPatch
+):
+    async def rows(database: Database) -> list[tuple[int, int]]:
+        query = (
+            "SELECT orders.order_id, count(item_no) FROM orders"
+            " LEFT JOIN ordered_items USING (order_id) GROUP BY orders.order_id"
+        )
+        return [(row[0], row[1]) for row in await database.fetch_all(query)]
+
+    async def run():
+        database = await connect()
+        queue = incoming.Queue(database)
+        rollup = sales.Rollup(database)
+        service_times = service_time.ServiceTimes(database)
+        bus = LocalBus(Feed())
+        items = ordered_item.Table(database)
+        orders = order.Table(database, queue, rollup, service_times, bus)
+        for name, value in [
+            ("database", database),
+            ("IncomingQueue", queue),
+            ("SalesRollup", rollup),
+            ("ChangeBus", bus),
+            ("OrderedItemTable", items),
+            ("OrderTable", orders),
+        ]:
+            monkeypatch.setattr(store, name, value)
+
+        order_ids = [await store.issue_order([1, 2]), await store.issue_order([3])]
+        issued = await rows(database)
+
+        issue = items._issue
+
+        async def issue_then_fail(order_id: int, product_ids: list[int]) -> None:
+            await issue(order_id, product_ids)
+            raise RuntimeError("disk I/O error")
+
+        monkeypatch.setattr(items, "_issue", issue_then_fail)
+        with pytest.raises(RuntimeError):
+            await store.issue_order([1])
+        rolled_back = await rows(database)
+
+        await database.disconnect()
+        return order_ids, issued, rolled_back
+
+    assert asyncio.run(run()) == snapshot(([1, 2], [(1, 2), (2, 1)], [(1, 2), (2, 1)]))
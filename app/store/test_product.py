@@ -1,6 +1,12 @@
-from .product import Product
+import asyncio
+
 from inline_snapshot import snapshot
 
+from ..conftest import Connect
+from .changes import Feed, LocalBus
+from .incoming import Queue
+from .product import Product, Table
+
 
 def test_to_price_str() -> None:
     assert Product.to_price_str(0) == snapshot("¥0")
@@ -14,3 +20,65 @@ def test_to_price_str() -> None:
     assert Product.to_price_str(10000000) == snapshot("¥10,000,000")
     assert Product.to_price_str(100000000) == snapshot("¥100,000,000")
     assert Product.to_price_str(1000000000) == snapshot("¥1,000,000,000")
+
+
+def test_catalog_serves_products_from_memory_until_written(connect: Connect):
+    async def run():
+        database = await connect()
+        feed = Feed()
+        table = Table(database, Queue(database), LocalBus(feed))
+
+        def product(product_id: int, name: str) -> Product:
+            return Product(
+                product_id=product_id, name=name, filename="", price=100, no_stock=None
+            )
+
+        await table.insert(product(2, "coffee"))
+        await table.insert(product(1, "tea"))
+        version = table.catalog.version
+        names = [p.name for p in await table.select_all()]
+
+        # Served without a query even if the table is changed behind its back
+        await database.execute("UPDATE products SET name = 'water'")
+        cached = await table.by_product_id(1)
+        assert cached is not None and table.catalog.version == version
+
+        await table.update(2, product(3, "latte"))
+        updated = [(p.product_id, p.name) for p in await table.select_all()]
+
+        await database.disconnect()
+        return names, cached.name, updated, feed.seq
+
+    assert asyncio.run(run()) == snapshot(
+        (["tea", "coffee"], "tea", [(1, "water"), (3, "latte")], 3)
+    )
+
+
+def test_product_changes_refresh_incoming_orders(connect: Connect):
+    async def run():
+        database = await connect()
+        queue = Queue(database)
+        table = Table(database, queue, LocalBus(Feed()))
+
+        def product(name: str, filename: str) -> Product:
+            return Product(
+                product_id=1, name=name, filename=filename, price=100, no_stock=None
+            )
+
+        await table.insert(product("coffee", "coffee.png"))
+        await database.execute("INSERT INTO orders (order_id) VALUES (1)")
+        await database.execute(
+            "INSERT INTO ordered_items (order_id, item_no, product_id) VALUES (1, 0, 1)"
+        )
+        await queue.ainit()
+        (order,) = queue.orders()
+        version = order.version
+
+        await table.update(1, product("latte", "latte.png"))
+        (order,) = queue.orders()
+
+        await database.disconnect()
+        items = [(item.name, item.filename) for item in order.items]
+        return items, order.version > version
+
+    assert asyncio.run(run()) == snapshot(([("latte", "latte.png")], True))
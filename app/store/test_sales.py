@@ -0,0 +1,162 @@
+import asyncio
+from collections import Counter
+from datetime import date
+
+import sqlparse
+from databases import Database
+from inline_snapshot import snapshot
+
+from ..conftest import Connect
+from . import incoming, order, ordered_item
+from .changes import Feed, LocalBus
+from .sales import OrderSales, ProductSales, Rollup, query_daily_sales
+from .service_time import ServiceTimes
+
+
+def format_sql(sql: object):
+    return sqlparse.format(sql, keyword_case="upper", reindent=True, wrap_after=80)
+
+
+def test_daily_sales_query():
+    assert format_sql(str(query_daily_sales)) == snapshot("""\
+SELECT ordered_items.product_id, date(orders.ordered_at,
+                                   :date_1) AS date,
+       count(ordered_items.product_id) AS COUNT, orders.order_id
+FROM ordered_items
+JOIN orders ON orders.order_id = ordered_items.order_id
+WHERE orders.canceled_at IS NULL
+GROUP BY orders.order_id, ordered_items.product_id\
+""")
+
+
+def test_rollup_follows_cancels_and_resets(connect: Connect):
+    async def run():
+        database = await connect()
+        rollup = Rollup(database)
+        queue = incoming.Queue(database)
+        service_times = ServiceTimes(database)
+        orders = order.Table(database, queue, rollup, service_times, LocalBus(Feed()))
+        items = ordered_item.Table(database)
+        await rollup.ainit()
+
+        for product_ids in ([1, 1, 2], [2, 3]):
+            async with database.transaction():
+                order_id, ordered_at = await orders._insert()
+                await items._issue(order_id, product_ids)
+            rollup.issue(order_id, ordered_at, product_ids)
+        issued = await rollup.sales()
+
+        # Canceling twice only counts once
+        await orders.cancel(1)
+        await orders.cancel(1)
+        canceled = await rollup.sales()
+        await orders.reset(1)
+        reset = await rollup.sales()
+
+        rebuilt = Rollup(database)
+        await rebuilt.ainit()
+        consistent = await rebuilt.sales() == reset
+
+        await database.disconnect()
+        return issued, canceled, reset, consistent
+
+    issued, canceled, reset, consistent = asyncio.run(run())
+    assert issued == reset
+    assert consistent
+    assert (issued, canceled) == snapshot(
+        (
+            [
+                ProductSales(product_id=1, count=2, count_today=2),
+                ProductSales(product_id=2, count=2, count_today=2),
+                ProductSales(product_id=3, count=1, count_today=1),
+            ],
+            [
+                ProductSales(product_id=2, count=1, count_today=1),
+                ProductSales(product_id=3, count=1, count_today=1),
+            ],
+        )
+    )
+
+
+def test_rollup_counts_today_separately():
+    rollup = Rollup(Database("sqlite://"))
+    rollup._stale = False
+    rollup._count(OrderSales(1, date(2024, 1, 1), Counter({1: 2}), False), True)
+    rollup._count(OrderSales(2, date(2024, 1, 2), Counter({1: 1, 2: 1}), False), True)
+
+    assert asyncio.run(rollup.sales(date(2024, 1, 2))) == snapshot(
+        [
+            ProductSales(product_id=1, count=3, count_today=1),
+            ProductSales(product_id=2, count=1, count_today=1),
+        ]
+    )
+
+
+def test_refresh_applies_orders_changed_elsewhere(connect: Connect):
+    async def run():
+        database = await connect()
+        rollup, service_times = Rollup(database), ServiceTimes(database)
+        queue = incoming.Queue(database)
+        orders = order.Table(database, queue, rollup, service_times, LocalBus(Feed()))
+        items = ordered_item.Table(database)
+        # Stands in for another process sharing the database
+        remote_rollup, remote_times = Rollup(database), ServiceTimes(database)
+        await remote_rollup.ainit()
+        await remote_times.ainit()
+
+        async def refresh(order_id: int):
+            await remote_rollup.refresh(order_id)
+            await remote_times.refresh(order_id)
+            # Refreshing again changes nothing
+            await remote_rollup.refresh(order_id)
+            return await remote_rollup.sales(), len(remote_times._all)
+
+        for product_ids in ([1, 1, 2], [2, 3]):
+            async with database.transaction():
+                order_id, _ = await orders._insert()
+                await items._issue(order_id, product_ids)
+        issued = await refresh(1), await refresh(2)
+        await orders.cancel(1)
+        canceled = await refresh(1)
+        async with database.transaction():
+            await orders._complete(2)
+        completed = await refresh(2)
+
+        await rollup.ainit()
+        consistent = await rollup.sales() == completed[0]
+        fresh = not remote_rollup._stale and not remote_times._stale
+
+        await database.disconnect()
+        return issued, canceled, completed[1], consistent, fresh
+
+    assert asyncio.run(run()) == snapshot(
+        (
+            (
+                (
+                    [
+                        ProductSales(product_id=1, count=2, count_today=2),
+                        ProductSales(product_id=2, count=1, count_today=1),
+                    ],
+                    0,
+                ),
+                (
+                    [
+                        ProductSales(product_id=1, count=2, count_today=2),
+                        ProductSales(product_id=2, count=2, count_today=2),
+                        ProductSales(product_id=3, count=1, count_today=1),
+                    ],
+                    0,
+                ),
+            ),
+            (
+                [
+                    ProductSales(product_id=2, count=1, count_today=1),
+                    ProductSales(product_id=3, count=1, count_today=1),
+                ],
+                0,
+            ),
+            1,
+            True,
+            True,
+        )
+    )
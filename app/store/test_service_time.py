@@ -0,0 +1,49 @@
+import asyncio
+
+from databases import Database
+from inline_snapshot import snapshot
+
+from .service_time import Recent, ServiceTimes
+
+
+def test_service_times_follow_completions_within_window():
+    service_times = ServiceTimes(Database("sqlite://"), window=60)
+    service_times._stale = False
+
+    def read(now: float):
+        recent = asyncio.run(service_times.recent(now))
+        return asyncio.run(service_times.average()), recent.mean, recent.count
+
+    service_times.complete(1, ordered_at=0, completed_at=100)
+    service_times.complete(2, ordered_at=50, completed_at=150)
+    service_times.complete(3, ordered_at=100, completed_at=190)
+    both = read(now=200)
+    # Completed orders put back no longer count
+    service_times.discard(3)
+    discarded = read(now=200)
+    # Re-completing an order replaces its duration
+    service_times.complete(2, ordered_at=50, completed_at=230)
+    expired = read(now=240)
+
+    assert (both, discarded, expired) == snapshot(
+        ((96.66666666666667, 95.0, 2), (100.0, 100.0, 1), (140.0, 180.0, 1))
+    )
+
+
+def test_service_times_percentiles_and_estimate():
+    service_times = ServiceTimes(Database("sqlite://"), window=3600)
+    service_times._stale = False
+    durations = [300, 60, 120, 90, 600, 180, 150, 240, 100, 200]
+    for order_id, duration in enumerate(durations, start=1):
+        completed_at = order_id * 60
+        service_times.complete(order_id, completed_at - duration, completed_at)
+    recent = asyncio.run(service_times.recent(now=660))
+
+    # An order has been completed every 60 seconds
+    estimates = [recent.estimate(waiting) for waiting in (0, 3, 10)]
+    assert (recent, estimates) == snapshot(
+        (
+            Recent(count=10, mean=204.0, p50=150, p90=300, interval=60.0),
+            [150, 180.0, 600.0],
+        )
+    )
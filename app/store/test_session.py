@@ -0,0 +1,200 @@
+import asyncio
+
+from inline_snapshot import snapshot
+
+from ..conftest import Connect
+from .session import OrderSession, SQLiteStore, Store, merge
+
+
+def test_order_session_counts_items_per_product():
+    session = OrderSession()
+    for product_id in (3, 1, 3, 3):
+        session.add(product_id)
+    session.delete(1)
+    session.delete(3)
+    session.delete(2)
+    assert (session.counts, session.total_count) == snapshot(({3: 2}, 2))
+
+    session.apply([(1, 5), (3, -1), (2, 0), (1, -2), (4, 1), (4, -3)])
+    assert (session.counts, session.total_count) == snapshot(({3: 1, 1: 3}, 4))
+
+
+def test_store_evicts_expired_and_least_recently_used_sessions():
+    now = 0.0
+    store = Store(ttl=60, maxsize=2, clock=lambda: now)
+
+    async def run():
+        nonlocal now
+        first, second = await store.create(), await store.create()
+        now = 30
+        assert await store.get(first) is not None
+        # Evicts `second`, which has been used less recently than `first`
+        third = await store.create()
+        evicted = await store.get(second)
+
+        now = 80
+        kept = await store.get(first)
+
+        now = 95
+        # `third` has been left untouched since 30
+        expired = await store.get(third)
+
+        metrics = await store.metrics()
+        counters = (metrics.created, metrics.expired, metrics.evicted)
+        return evicted, kept is not None, expired, len(store), counters
+
+    assert asyncio.run(run()) == snapshot((None, True, None, 1, (3, 1, 1)))
+
+
+def test_merge_applies_local_changes_on_remote_ones():
+    base = {1: 2, 2: 1}
+    remote = {1: 3, 2: 1, 3: 1}
+    local = {1: 1, 4: 2}
+    assert merge(remote, base, local) == snapshot({1: 2, 3: 1, 4: 2})
+
+
+def test_sqlite_store_shares_sessions_across_processes(connect: Connect):
+    async def run():
+        database = await connect()
+        this = SQLiteStore(database, ttl=60, maxsize=8, interval=60, origin=1)
+        other = SQLiteStore(database, ttl=60, maxsize=8, interval=60, origin=2)
+
+        key = await this.create()
+        session = await this.get(key)
+        assert session is not None
+        session.add(1)
+        # Not written until flushed
+        unflushed = await other.get(key)
+        assert unflushed is not None
+        await this.flush()
+
+        # Both pick items before either is written
+        unflushed.add(2)
+        session.add(1)
+        await other.flush()
+        await this.flush()
+        await this.poll()
+        merged = dict(session.counts)
+
+        await other.poll()
+        reloaded = await other.get(key)
+        assert reloaded is not None and reloaded is not unflushed
+
+        deferred = await other.defer(key)
+        listed = [(k == key, s.counts) for k, s in await this.deferred()]
+        placed_while_deferred = await this.pop(key)
+        resumed = await this.resume(key)
+
+        # Survives a restart
+        restarted = SQLiteStore(database, ttl=60, maxsize=8, interval=60, origin=3)
+        placed = await restarted.pop(key)
+        placed_twice = await this.pop(key)
+
+        await database.disconnect()
+        return (
+            merged,
+            reloaded.counts,
+            deferred,
+            listed,
+            placed_while_deferred,
+            resumed and resumed.counts,
+            placed and placed.counts,
+            placed_twice,
+        )
+
+    assert asyncio.run(run()) == snapshot(
+        (
+            {1: 2, 2: 1},
+            {1: 2, 2: 1},
+            True,
+            [(True, {1: 2, 2: 1})],
+            None,
+            {1: 2, 2: 1},
+            {1: 2, 2: 1},
+            None,
+        )
+    )
+
+
+def test_sqlite_store_keeps_sessions_in_use_from_pruning(connect: Connect):
+    async def run():
+        database = await connect()
+        this = SQLiteStore(database, ttl=60, maxsize=8, interval=60, origin=1)
+        other = SQLiteStore(database, ttl=60, maxsize=8, interval=60, origin=2)
+        idle, read, held = [await this.create() for _ in range(3)]
+        await database.execute("UPDATE order_sessions SET modified_at = 0")
+
+        # Reading a session touches its row on the next flush
+        assert await other.get(read) is not None
+        await other.flush()
+        # Sessions held in memory are kept even if untouched for long
+        this._sessions.pop(idle)
+        this._sessions.pop(read)
+        await this._prune()
+
+        query = "SELECT key FROM order_sessions"
+        kept = {row["key"] for row in await database.fetch_all(query)}
+        await database.disconnect()
+        return str(idle) in kept, str(read) in kept, str(held) in kept
+
+    assert asyncio.run(run()) == snapshot((False, True, True))
+
+
+def test_sqlite_store_refuses_to_defer_unwritten_changes(connect: Connect):
+    async def run():
+        database = await connect()
+        this = SQLiteStore(database, ttl=60, maxsize=8, interval=60, origin=1)
+        key = await this.create()
+        session = await this.get(key)
+        assert session is not None
+        session.add(1)
+
+        fetch_all = database.fetch_all
+
+        async def fetch_all_then_written_by_other(query, values=None):
+            rows = await fetch_all(query, values)
+            # Another process writes the rows between the read and the write
+            await database.execute("UPDATE order_sessions SET rev = rev + 1")
+            return rows
+
+        database.fetch_all = fetch_all_then_written_by_other
+        refused = await this.defer(key)
+        kept = await this.get(key) is session
+
+        database.fetch_all = fetch_all
+        deferred = await this.defer(key)
+        listed = [s.counts for _, s in await this.deferred()]
+        await database.disconnect()
+        return refused, kept, deferred, listed
+
+    assert asyncio.run(run()) == snapshot((False, True, True, [{1: 1}]))
+
+
+def test_sqlite_store_flushes_sessions_placed_while_writing(connect: Connect):
+    async def run():
+        database = await connect()
+        this = SQLiteStore(database, ttl=60, maxsize=8, interval=60, origin=1)
+        key = await this.create()
+        session = await this.get(key)
+        assert session is not None
+        session.add(1)
+
+        fetch_all = database.fetch_all
+        placed: list[OrderSession | None] = []
+
+        async def fetch_all_then_placed(query, values=None):
+            rows = await fetch_all(query, values)
+            # The order is placed between the read and the write
+            placed.append(await this.pop(key))
+            return rows
+
+        database.fetch_all = fetch_all_then_placed
+        await this.flush()
+        database.fetch_all = fetch_all
+
+        counts = [p.counts if p is not None else None for p in placed]
+        left = (len(this), key in this._synced, await this.get(key))
+        await database.disconnect()
+        return counts, left
+
+    assert asyncio.run(run()) == snapshot(([{1: 1}], (0, False, None)))
@@ -0,0 +1,56 @@
+import asyncio
+import sqlite3
+from pathlib import Path
+
+from inline_snapshot import snapshot
+
+from ._sqlite import PRAGMAS, Connection, Pool
+
+
+def test_pragmas():
+    assert PRAGMAS == snapshot(
+        [
+            "PRAGMA journal_mode = WAL",
+            "PRAGMA synchronous = NORMAL",
+            "PRAGMA temp_store = MEMORY",
+            "PRAGMA busy_timeout = 5000",
+            "PRAGMA mmap_size = 268435456",
+            "PRAGMA cache_size = -16000",
+        ]
+    )
+
+
+def test_connection_applies_pragmas(tmp_path: Path):
+    conn = sqlite3.connect(tmp_path / "test.db", factory=Connection)
+    names = ("journal_mode", "synchronous", "busy_timeout", "temp_store")
+    values = [conn.execute(f"PRAGMA {name}").fetchone()[0] for name in names]
+    conn.close()
+    assert values == snapshot(["wal", 1, 5000, 2])
+
+
+def test_pool_reuses_connections_up_to_size():
+    class _Opener:
+        _memref = None
+
+        def __init__(self):
+            self.opened = 0
+
+        async def acquire(self):
+            self.opened += 1
+            return self.opened
+
+        async def release(self, connection): ...
+
+    async def run():
+        opener = _Opener()
+        pool = Pool(opener, 2)  # pyright: ignore[reportArgumentType]
+        a, b = await pool.acquire(), await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire())
+        await asyncio.sleep(0)
+        waiting = not waiter.done()
+        await pool.release(b)
+        c = await waiter
+        await pool.release(a)
+        return [a, b, c, await pool.acquire()], waiting, opener.opened
+
+    assert asyncio.run(run()) == snapshot(([1, 2, 2, 1], True, 2))
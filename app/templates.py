@@ -1,4 +1,5 @@
 import os
+from contextvars import ContextVar
 from functools import wraps
 from pathlib import Path
 from typing import Any, Callable, Protocol
@@ -8,24 +9,38 @@ from fastapi import Request
 from fastapi.datastructures import URL
 from jinja2.ext import debug as debug_ext
 
-from .env import DEBUG
+from .env import DEBUG, TEMPLATE_CACHE_DIR
 
 TEMPLATES_DIR = Path("app/templates")
 
 
+def _bytecode_cache() -> jinja2.BytecodeCache | None:
+    if not TEMPLATE_CACHE_DIR:
+        return None
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    return jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+
 env = jinja2.Environment(
     extensions=[debug_ext] if DEBUG else [],
     undefined=jinja2.StrictUndefined,
     autoescape=True,
     loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+    # Templates only change during development
+    auto_reload=DEBUG,
+    bytecode_cache=_bytecode_cache(),
 )
 env.globals.setdefault("DEBUG", DEBUG)
 
+_request: ContextVar[Request] = ContextVar("request")
+"""
+The request being rendered for. Template modules are built once and shared by
+every request, so request-scoped values can't be their globals.
+"""
 
-@jinja2.pass_context
-def _url_for(context: dict[str, Any], name: str, /, **path_params: Any) -> URL:
-    request: Request = context["request"]
-    return request.url_for(name, **path_params)
+
+def _url_for(name: str, /, **path_params: Any) -> URL:
+    return _request.get().url_for(name, **path_params)
 
 
 env.globals.setdefault("url_for", _url_for)
@@ -49,14 +64,32 @@ def macro_template[**P](
     if macro_name is None:
         macro_name = hyphen_path_to_underscore_stem(name)
 
+    template: jinja2.Template | None = None
+    macro: jinja2.runtime.Macro | None = None
+
+    def load_macro() -> jinja2.runtime.Macro:
+        nonlocal template, macro
+        # Look up the template again only when it may have been modified
+        if macro is not None and not env.auto_reload:
+            return macro
+        latest = env.get_template(name)
+        if latest is template and macro is not None:
+            return macro
+        loaded = getattr(latest.module, macro_name)
+        is_macro = isinstance(loaded, jinja2.runtime.Macro)
+        assert is_macro, f"{loaded} is not a jinja2.runtime.Macro instance"
+        template, macro = latest, loaded
+        return loaded
+
     def type_signature(fn: _MacroArgHints[P]) -> _RenderMacroWithRequest[P]:
         @wraps(fn)
         def with_request(request: Request, *args: P.args, **kwargs: P.kwargs) -> str:
-            template = env.get_template(name, globals={"request": request})
-            macro = getattr(template.module, macro_name)
-            is_macro = isinstance(macro, jinja2.runtime.Macro)
-            assert is_macro, f"{macro} is not a jinja2.runtime.Macro instance"
-            return macro(*args, **kwargs)
+            macro = load_macro()
+            token = _request.set(request)
+            try:
+                return macro(*args, **kwargs)
+            finally:
+                _request.reset(token)
 
         return with_request
 
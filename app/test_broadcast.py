@@ -0,0 +1,302 @@
+import asyncio
+
+from fastapi import Request
+from inline_snapshot import snapshot
+
+from .broadcast import Hub, Snapshot
+from .store import ModifiedFlag
+from .store.changes import Feed
+
+
+def _request(host: str = "testserver", last_event_id: str | None = None) -> Request:
+    headers = [(b"host", host.encode())]
+    if last_event_id is not None:
+        headers.append((b"last-event-id", last_event_id.encode()))
+    scope = {
+        "type": "http",
+        "scheme": "http",
+        "server": (host, 80),
+        "path": "/",
+        "root_path": "",
+        "headers": headers,
+    }
+    return Request(scope)
+
+
+class _Source:
+    def __init__(self):
+        self.loads = 0
+        self.renders = 0
+        self.feed = Feed()
+
+    async def load(self) -> int:
+        self.loads += 1
+        return self.loads
+
+    def render(self, request: Request, snapshot: Snapshot[int]) -> str:
+        self.renders += 1
+        return f"{request.base_url.hostname}:{snapshot.value}:{snapshot.flag.name}"
+
+    async def change(self, flag: ModifiedFlag, times: int = 1) -> None:
+        """Makes `times` changes, each of which is loaded before the next."""
+        for _ in range(times):
+            loads = self.loads + 1
+            self.feed.append(flag, None)
+            while self.loads < loads:
+                await asyncio.sleep(0)
+
+
+def test_hub_loads_and_renders_once_per_change():
+    async def run():
+        source = _Source()
+        hub = Hub(source.load, source.render, source.feed)
+        subscribers = [hub.subscribe(_request()) for _ in range(3)]
+
+        initial = [(await anext(s))["data"] for s in subscribers]
+        source.feed.append(ModifiedFlag.INCOMING, None)
+        updated = [(await anext(s))["data"] for s in subscribers]
+
+        for s in subscribers:
+            await s.aclose()
+        return initial, updated, source.loads, source.renders
+
+    assert asyncio.run(run()) == snapshot(
+        (
+            ["testserver:1:ORIGINAL", "testserver:1:ORIGINAL", "testserver:1:ORIGINAL"],
+            ["testserver:2:INCOMING", "testserver:2:INCOMING", "testserver:2:INCOMING"],
+            2,
+            2,
+        )
+    )
+
+
+def test_hub_renders_per_base_url():
+    async def run():
+        source = _Source()
+        hub = Hub(source.load, source.render, source.feed)
+        a, b = hub.subscribe(_request("a.local")), hub.subscribe(_request("b.local"))
+        contents = [(await anext(a))["data"], (await anext(b))["data"]]
+        await a.aclose()
+        await b.aclose()
+        return contents, source.loads
+
+    assert asyncio.run(run()) == snapshot(
+        (["a.local:1:ORIGINAL", "b.local:1:ORIGINAL"], 1)
+    )
+
+
+def test_hub_drops_stale_fragments_for_slow_subscribers():
+    async def run():
+        source = _Source()
+        hub = Hub(source.load, source.render, source.feed, maxsize=2)
+        slow = hub.subscribe(_request())
+        await anext(slow)
+
+        await source.change(ModifiedFlag.SUPPLIED, times=5)
+
+        received = [(await anext(slow))["data"], (await anext(slow))["data"]]
+        await slow.aclose()
+        return received
+
+    assert asyncio.run(run()) == snapshot(
+        ["testserver:5:SUPPLIED", "testserver:6:SUPPLIED"]
+    )
+
+
+def test_hub_coalesces_bursts_of_changes():
+    async def run():
+        source = _Source()
+        hub = Hub(source.load, source.render, source.feed)
+        subscriber = hub.subscribe(_request())
+        await anext(subscriber)
+
+        source.feed.append(ModifiedFlag.INCOMING, (1,))
+        source.feed.append(ModifiedFlag.SUPPLIED, (2,))
+        updated = (await anext(subscriber))["data"]
+
+        await subscriber.aclose()
+        return updated, source.loads
+
+    assert asyncio.run(run()) == snapshot(("testserver:2:INCOMING|SUPPLIED", 2))
+
+
+def test_hub_resyncs_subscribers_falling_behind_patches():
+    def render_patch(request: Request, prev: Snapshot[int], new: Snapshot[int]):
+        return f"{prev.value}->{new.value}" if new.value % 3 else ""
+
+    async def run():
+        source = _Source()
+        hub = Hub(
+            source.load,
+            source.render,
+            source.feed,
+            render_patch=render_patch,
+            maxsize=2,
+        )
+        subscriber = hub.subscribe(_request())
+        received = [await anext(subscriber)]
+
+        await source.change(ModifiedFlag.SUPPLIED)
+        received.append(await anext(subscriber))
+        # An empty patch is not sent at all
+        await source.change(ModifiedFlag.SUPPLIED, times=2)
+        received.append(await anext(subscriber))
+        # Overflowing patches are replaced by the full content
+        await source.change(ModifiedFlag.SUPPLIED, times=4)
+        received.append(await anext(subscriber))
+
+        await subscriber.aclose()
+        return [{"event": m["event"], "data": m["data"]} for m in received]
+
+    assert asyncio.run(run()) == snapshot(
+        [
+            {"event": "message", "data": "testserver:1:ORIGINAL"},
+            {"event": "patch", "data": "1->2"},
+            {"event": "patch", "data": "3->4"},
+            {"event": "message", "data": "testserver:8:ORIGINAL"},
+        ]
+    )
+
+
+def test_hub_resumes_streams_from_last_event_id():
+    def render_patch(request: Request, prev: Snapshot[int], new: Snapshot[int]):
+        return f"{prev.value}->{new.value}"
+
+    async def run():
+        source = _Source()
+        hub = Hub(
+            source.load,
+            source.render,
+            source.feed,
+            render_patch=render_patch,
+            replay=2,
+            linger=60,
+        )
+        subscriber = hub.subscribe(_request())
+        last_event_id = (await anext(subscriber))["id"]
+        await subscriber.aclose()
+
+        async def resume(last_event_id: str) -> list[str]:
+            subscriber = hub.subscribe(_request(last_event_id=last_event_id))
+            source.feed.append(ModifiedFlag.SUPPLIED, None)
+            received = [await anext(subscriber), await anext(subscriber)]
+            await subscriber.aclose()
+            return [m["data"] for m in received]
+
+        # Changes made while disconnected are replayed
+        await source.change(ModifiedFlag.SUPPLIED)
+        resumed = await resume(last_event_id)
+        # Falls back to the full content once the missed events are dropped
+        await source.change(ModifiedFlag.SUPPLIED, times=2)
+        fallback = await resume(last_event_id)
+        unknown = await resume("unknown.0")
+
+        return resumed, fallback, unknown, source.loads
+
+    assert asyncio.run(run()) == snapshot(
+        (
+            ["1->2", "2->3"],
+            ["testserver:5:ORIGINAL", "5->6"],
+            ["testserver:6:ORIGINAL", "6->7"],
+            7,
+        )
+    )
+
+
+def test_hub_coalesces_changes_within_window_up_to_max_latency():
+    async def run():
+        source = _Source()
+        hub = Hub(
+            source.load, source.render, source.feed, coalesce=0.1, max_latency=0.3
+        )
+        subscriber = hub.subscribe(_request())
+        await anext(subscriber)
+
+        async def change_every(interval: float, times: int):
+            for _ in range(times):
+                source.feed.append(ModifiedFlag.SUPPLIED, None)
+                await asyncio.sleep(interval)
+
+        await change_every(0.01, 3)
+        merged = (await anext(subscriber))["data"]
+
+        # The window is cut short while changes keep arriving
+        changes = asyncio.create_task(change_every(0.01, 200))
+        await anext(subscriber)
+        bounded = not changes.done()
+        changes.cancel()
+
+        await subscriber.aclose()
+        return merged, bounded
+
+    assert asyncio.run(run()) == snapshot(("testserver:2:SUPPLIED", True))
+
+
+def test_hub_keeps_pumping_after_a_failed_load():
+    async def run():
+        source = _Source()
+        load = source.load
+
+        async def load_failing_once() -> int:
+            value = await load()
+            if value == 2:
+                raise RuntimeError("database is locked")
+            return value
+
+        hub = Hub(load_failing_once, source.render, source.feed)
+        subscriber = hub.subscribe(_request())
+        received = [(await anext(subscriber))["data"]]
+
+        await source.change(ModifiedFlag.SUPPLIED)
+        await source.change(ModifiedFlag.RESOLVED)
+        received.append((await anext(subscriber))["data"])
+
+        await subscriber.aclose()
+        return received
+
+    assert asyncio.run(run()) == snapshot(
+        ["testserver:1:ORIGINAL", "testserver:3:RESOLVED"]
+    )
+
+
+def test_hub_reloads_on_interval_and_pushes_only_new_values():
+    async def run():
+        source = _Source()
+        load = source.load
+
+        async def load_changing_on_third() -> int:
+            return 2 if await load() >= 3 else 1
+
+        hub = Hub(
+            load_changing_on_third,
+            source.render,
+            source.feed,
+            replay=4,
+            interval=0.01,
+        )
+        subscriber = hub.subscribe(_request())
+        events = [await anext(subscriber), await anext(subscriber)]
+        received = [event["data"] for event in events]
+
+        # Subscribers joining later are sent the reloaded value
+        late = hub.subscribe(_request())
+        received.append((await anext(late))["data"])
+        # Reconnecting subscribers are sent what they have missed
+        resumed = hub.subscribe(_request(last_event_id=events[0]["id"]))
+        received.append((await anext(resumed))["data"])
+
+        for s in (resumed, late, subscriber):
+            await s.aclose()
+        return received, events[0]["id"] != events[1]["id"]
+
+    assert asyncio.run(run()) == snapshot(
+        (
+            [
+                "testserver:1:ORIGINAL",
+                "testserver:2:None",
+                "testserver:2:ORIGINAL",
+                "testserver:2:None",
+            ],
+            True,
+        )
+    )
@@ -0,0 +1,147 @@
+import asyncio
+import gzip
+import json
+import time
+from datetime import datetime
+
+from inline_snapshot import snapshot
+
+from .conftest import Connect
+from .export import Format, TimestampFormatter, encode, fetch_orders
+
+
+def _rows(count: int):
+    ordered_at = int(datetime(2024, 11, 2, 10, 30).timestamp())
+
+    async def rows():
+        for order_id in range(1, count + 1):
+            yield {
+                "order_id": order_id,
+                "item_no": 0,
+                "ordered_at": ordered_at + order_id * 45,
+                "completed_at": None if order_id % 2 else ordered_at + 600,
+                "product_id": 5,
+                "name": "Coffee, hot",
+                "price": 150,
+            }
+
+    return rows()
+
+
+def _export(format: Format, count: int = 3) -> list[str]:
+    async def run() -> list[str | bytes]:
+        return [chunk async for chunk in encode(_rows(count), format, batch_size=2)]
+
+    chunks = asyncio.run(run())
+    texts = [chunk for chunk in chunks if isinstance(chunk, str)]
+    if texts or not chunks:
+        return texts
+    data = b"".join(chunk for chunk in chunks if isinstance(chunk, bytes))
+    return [gzip.decompress(data).decode()]
+
+
+def test_timestamp_formatter_matches_strftime():
+    formatter = TimestampFormatter(maxsize=2)
+    start = int(datetime(2024, 11, 2, 23, 58).timestamp())
+    epochs = range(start, start + 300, 7)
+    expected = [
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(epoch)) for epoch in epochs
+    ]
+    assert formatter.format_many(epochs) == expected
+    assert formatter(None) is None
+
+
+def test_export_csv():
+    assert _export(Format.CSV) == snapshot(
+        [
+            "order_id,item_no,ordered_at,completed_at,product_id,name,price\r\n",
+            """\
+1,0,2024-11-02 10:30:45,,5,"Coffee, hot",150\r
+2,0,2024-11-02 10:31:30,2024-11-02 10:40:00,5,"Coffee, hot",150\r
+""",
+            '3,0,2024-11-02 10:32:15,,5,"Coffee, hot",150\r\n',
+        ]
+    )
+    assert _export(Format.CSV_GZIP) == ["".join(_export(Format.CSV))]
+
+
+def test_export_json_lines():
+    assert _export(Format.JSON_LINES) == snapshot(
+        [
+            """\
+{"order_id": 1, "item_no": 0, "ordered_at": "2024-11-02 10:30:45", "completed_at": null, "product_id": 5, "name": "Coffee, hot", "price": 150}
+{"order_id": 2, "item_no": 0, "ordered_at": "2024-11-02 10:31:30", "completed_at": "2024-11-02 10:40:00", "product_id": 5, "name": "Coffee, hot", "price": 150}
+""",
+            '{"order_id": 3, "item_no": 0, "ordered_at": "2024-11-02 10:32:15", "completed_at": null, "product_id": 5, "name": "Coffee, hot", "price": 150}\n',
+        ]
+    )
+
+
+def test_export_columnar():
+    [content] = _export(Format.COLUMNAR)
+    batches = [json.loads(line) for line in content.splitlines()]
+    # Timestamps are kept in unix epoch, which depends on the local time zone
+    base = int(datetime(2024, 11, 2, 10, 30).timestamp())
+    for batch in batches:
+        for name in ("ordered_at", "completed_at"):
+            batch[name] = [None if t is None else t - base for t in batch[name]]
+
+    assert batches == snapshot(
+        [
+            {
+                "order_id": [1, 2],
+                "item_no": [0, 0],
+                "ordered_at": [45, 90],
+                "completed_at": [None, 600],
+                "product_id": [5, 5],
+                "name": ["Coffee, hot", "Coffee, hot"],
+                "price": [150, 150],
+            },
+            {
+                "order_id": [3],
+                "item_no": [0],
+                "ordered_at": [135],
+                "completed_at": [None],
+                "product_id": [5],
+                "name": ["Coffee, hot"],
+                "price": [150],
+            },
+        ]
+    )
+
+
+def test_export_no_rows():
+    assert _export(Format.CSV, count=0) == snapshot(
+        ["order_id,item_no,ordered_at,completed_at,product_id,name,price\r\n"]
+    )
+    assert _export(Format.COLUMNAR, count=0) == snapshot([""])
+
+
+def test_fetch_orders_in_batches(connect: Connect):
+    async def run():
+        database = await connect()
+        await database.execute(
+            "INSERT INTO products VALUES (1, 1, 'coffee', '', 150, NULL)"
+        )
+        for order_id, count in ((1, 1), (2, 3), (3, 1), (4, 2)):
+            await database.execute(f"INSERT INTO orders (order_id) VALUES ({order_id})")
+            for item_no in range(count):
+                await database.execute(
+                    "INSERT INTO ordered_items (order_id, item_no, product_id)"
+                    f" VALUES ({order_id}, {item_no}, 1)"
+                )
+        await database.execute(
+            "UPDATE orders SET canceled_at = CURRENT_TIMESTAMP WHERE order_id = 3"
+        )
+
+        async def keys(since: int) -> list[tuple[int, int]]:
+            rows = fetch_orders(database, since, batch_size=2)
+            return [(row["order_id"], row["item_no"]) async for row in rows]
+
+        everything, rest = await keys(0), await keys(2)
+        await database.disconnect()
+        return everything, rest
+
+    assert asyncio.run(run()) == snapshot(
+        ([(1, 0), (2, 0), (2, 1), (2, 2), (4, 0), (4, 1)], [(4, 0), (4, 1)])
+    )
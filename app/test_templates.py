@@ -3,8 +3,10 @@ from pathlib import Path
 from typing import Any, Generator
 
 import jinja2
+from fastapi import Request
 from inline_snapshot import snapshot
 from jinja2.ext import debug
+from starlette.routing import Mount, Router
 
 from . import templates
 
@@ -34,6 +36,28 @@ def test_hyphen_path_to_underscore_stem_should_convert_hyphens_to_underscores():
     assert outputs == snapshot(["sold_items", "privacy_settings", "privacy_settings"])
 
 
+def test_macro_template_builds_urls_for_each_request():
+    router = Router([Mount("/static", routes=[], name="static")])
+
+    def request(host: str) -> Request:
+        headers = [(b"host", host.encode())]
+        return Request({"type": "http", "headers": headers, "router": router})
+
+    favicon_urls = [
+        templates.layout(request(host), caller=lambda: "")
+        .split('href="')[1]
+        .split('"')[0]
+        for host in ("a.local", "b.local", "a.local")
+    ]
+    assert favicon_urls == snapshot(
+        [
+            "http://a.local/static/favicon.ico",
+            "http://b.local/static/favicon.ico",
+            "http://a.local/static/favicon.ico",
+        ]
+    )
+
+
 def test_templates_and_corresponding_macros_have_the_same_name():
     for name in loader.list_templates():
         module = env.get_template(name, globals=debug_global.copy()).module
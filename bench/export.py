@@ -0,0 +1,77 @@
+"""
+Measures the throughput of each export format on synthetic rows.
+
+```
+uv run python -m bench.export [ROWS]
+```
+"""
+
+import asyncio
+import csv
+import io
+import sys
+import time
+from datetime import datetime
+
+from app.export import Format, encode
+
+
+def _rows(count: int) -> list[dict]:
+    start = int(time.time()) - 3 * 24 * 60 * 60
+    return [
+        {
+            "order_id": i // 3,
+            "item_no": i % 3,
+            "ordered_at": start + i * 20,
+            "completed_at": start + i * 20 + 300 if i % 5 else None,
+            "product_id": i % 12,
+            "name": f"商品 {i % 12}",
+            "price": 150 + i % 12 * 10,
+        }
+        for i in range(count)
+    ]
+
+
+async def _aiter(rows: list[dict]):
+    for row in rows:
+        yield row
+
+
+async def _per_row_csv(rows: list[dict]) -> int:
+    """The former export, which formatted timestamps row by row."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    async for row in _aiter(rows):
+        values = []
+        for name, value in row.items():
+            if name in ("ordered_at", "completed_at") and value is not None:
+                local_time = datetime.fromtimestamp(value).astimezone()
+                value = local_time.strftime("%Y-%m-%d %H:%M:%S")
+            values.append(value)
+        writer.writerow(values)
+    return len(buffer.getvalue().encode())
+
+
+async def _export(rows: list[dict], format: Format) -> int:
+    size = 0
+    async for chunk in encode(_aiter(rows), format):
+        size += len(chunk if isinstance(chunk, bytes) else chunk.encode())
+    return size
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    rows = _rows(count)
+    cases = [("csv (per row)", lambda: _per_row_csv(rows))]
+    cases += [(str(format), lambda f=format: _export(rows, f)) for format in Format]
+
+    print(f"{'format':<18}{'rows/s':>12}{'bytes':>14}")
+    for name, run in cases:
+        started = time.perf_counter()
+        size = asyncio.run(run())
+        elapsed = time.perf_counter() - started
+        print(f"{name:<18}{count / elapsed:>12,.0f}{size:>14,}")
+
+
+if __name__ == "__main__":
+    main()
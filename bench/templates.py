@@ -0,0 +1,96 @@
+"""
+Measures the throughput of rendering macros through `macro_template`, against
+looking up the template and its module on every render as it used to.
+
+```
+uv run python -m bench.templates [SECONDS]
+```
+"""
+
+import sys
+import time
+from typing import Callable
+
+from fastapi import Request
+from starlette.routing import Mount, Router
+
+from app import templates
+from app.routers.stat import Stat, tmp_stat, tmp_stat_component
+
+
+def _request() -> Request:
+    router = Router([Mount("/static", routes=[], name="static")])
+    headers = [(b"host", b"murchace.local")]
+    return Request({"type": "http", "headers": headers, "router": router})
+
+
+def _stat() -> Stat:
+    sales = [
+        Stat.SalesSummary(
+            product_id=i,
+            name=f"商品 {i}",
+            filename=f"{i}.png",
+            price="¥150",
+            count=100 + i,
+            count_today=10 + i,
+            total_sales="¥15,000",
+            total_sales_today="¥1,500",
+            no_stock=None,
+        )
+        for i in range(12)
+    ]
+    return Stat("¥180,000", "¥18,000", 1200, 120, sales, "5 分 0 秒", "4 分 30 秒")
+
+
+def _legacy(name: str, macro_name: str) -> Callable[..., str]:
+    def render(request: Request, *args) -> str:
+        # Templates used to be checked for modifications on every lookup
+        templates.env.auto_reload = True
+        try:
+            template = templates.env.get_template(name, globals={"request": request})
+            return getattr(template.module, macro_name)(*args)
+        finally:
+            templates.env.auto_reload = auto_reload
+
+    auto_reload = templates.env.auto_reload
+    return render
+
+
+def _measure(render: Callable[[], str], seconds: float) -> float:
+    count, started = 0, time.perf_counter()
+    while (elapsed := time.perf_counter() - started) < seconds:
+        for _ in range(100):
+            render()
+        count += 100
+    return count / elapsed
+
+
+def main() -> None:
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    request, stat = _request(), _stat()
+    # The former lookup passed the request through globals instead
+    templates._request.set(request)
+    cases = {
+        "stat page": (_legacy("stat.html", "stat"), tmp_stat, (stat,)),
+        "stat component": (
+            _legacy("stat.html", "component"),
+            tmp_stat_component,
+            (stat,),
+        ),
+        "hx-post page": (
+            _legacy("hx-post.html", "hx_post"),
+            templates.hx_post,
+            ("/",),
+        ),
+    }
+
+    print(f"{'macro':<18}{'before':>12}{'after':>12}  renders/s")
+    for name, (before, after, args) in cases.items():
+        rates = [
+            _measure(lambda r=r: r(request, *args), seconds) for r in (before, after)
+        ]
+        print(f"{name:<18}{rates[0]:>12,.0f}{rates[1]:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
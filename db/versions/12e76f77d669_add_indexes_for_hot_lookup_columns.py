@@ -0,0 +1,69 @@
+"""Add indexes for hot lookup columns
+
+Revision ID: 12e76f77d669
+Revises: b260a0b3e3c6
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "12e76f77d669"
+down_revision: Union[str, None] = "b260a0b3e3c6"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("ordered_items", schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f("ix_ordered_items_order_id"), ["order_id"], unique=False
+        )
+        batch_op.create_index(
+            batch_op.f("ix_ordered_items_product_id"), ["product_id"], unique=False
+        )
+
+    with op.batch_alter_table("orders", schema=None) as batch_op:
+        # Also required for the foreign key from `ordered_items` to be valid
+        batch_op.create_index(
+            batch_op.f("ix_orders_order_id"), ["order_id"], unique=True
+        )
+        batch_op.create_index(
+            batch_op.f("ix_orders_canceled_at"), ["canceled_at"], unique=False
+        )
+        batch_op.create_index(
+            batch_op.f("ix_orders_completed_at"), ["completed_at"], unique=False
+        )
+        batch_op.create_index(
+            "ix_orders_unresolved",
+            ["order_id"],
+            unique=False,
+            sqlite_where=sa.text("canceled_at IS NULL AND completed_at IS NULL"),
+        )
+
+    with op.batch_alter_table("products", schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f("ix_products_product_id"), ["product_id"], unique=True
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("products", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_products_product_id"))
+
+    with op.batch_alter_table("orders", schema=None) as batch_op:
+        batch_op.drop_index(
+            "ix_orders_unresolved",
+            sqlite_where=sa.text("canceled_at IS NULL AND completed_at IS NULL"),
+        )
+        batch_op.drop_index(batch_op.f("ix_orders_order_id"))
+        batch_op.drop_index(batch_op.f("ix_orders_completed_at"))
+        batch_op.drop_index(batch_op.f("ix_orders_canceled_at"))
+
+    with op.batch_alter_table("ordered_items", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_ordered_items_product_id"))
+        batch_op.drop_index(batch_op.f("ix_ordered_items_order_id"))
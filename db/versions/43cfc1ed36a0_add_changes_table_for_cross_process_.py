@@ -0,0 +1,40 @@
+"""Add changes table for cross-process notifications
+
+Revision ID: 43cfc1ed36a0
+Revises: 12e76f77d669
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+
+# revision identifiers, used by Alembic.
+revision: str = "43cfc1ed36a0"
+down_revision: Union[str, None] = "12e76f77d669"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "changes",
+        sa.Column("seq", sa.Integer(), nullable=False),
+        sa.Column("flag", sa.Integer(), nullable=False),
+        sa.Column("order_ids", sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+        sa.Column("origin", sa.Integer(), nullable=False),
+        sa.Column(
+            "changed_at",
+            sa.DateTime(),
+            server_default=sa.text("(CURRENT_TIMESTAMP)"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("seq", name=op.f("pk_changes")),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("changes")
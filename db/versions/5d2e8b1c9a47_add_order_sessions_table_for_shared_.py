@@ -0,0 +1,44 @@
+"""Add order_sessions table for shared register sessions
+
+Revision ID: 5d2e8b1c9a47
+Revises: 43cfc1ed36a0
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5d2e8b1c9a47"
+down_revision: Union[str, None] = "43cfc1ed36a0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "order_sessions",
+        sa.Column("key", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("counts", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("rev", sa.Integer(), nullable=False),
+        sa.Column("seq", sa.Integer(), nullable=False),
+        sa.Column("origin", sa.Integer(), nullable=False),
+        sa.Column("modified_at", sa.Float(), nullable=False),
+        sa.Column("deferred_at", sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint("key", name=op.f("pk_order_sessions")),
+    )
+    with op.batch_alter_table("order_sessions", schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f("ix_order_sessions_seq"), ["seq"], unique=False
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("order_sessions", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_order_sessions_seq"))
+
+    op.drop_table("order_sessions")
@@ -101,3 +101,13 @@ def task_snapshot_review() -> TaskDictGen:
 
     yield {"basename": "snapshot-review", "actions": [cmd], "pos_arg": "files_or_dirs"}
     yield {"basename": "sr", "actions": [cmd], "pos_arg": "files_or_dirs"}
+
+
+def task_bench() -> TaskDict:
+    """Measure the throughput of the sales data exports and template renders."""
+    return {
+        "actions": [
+            [*UV_RUN, "python", "-m", "bench.export"],
+            [*UV_RUN, "python", "-m", "bench.templates"],
+        ]
+    }